@@ -0,0 +1,75 @@
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable, Optional
+
+from .schemas import BaseAppSocketMessage
+
+
+class BroadcastEncoder:
+    """
+    Encodes a message once and hands the same immutable bytes to every subscriber.
+
+    Entries are keyed on the identity of the message plus a caller-supplied version: if the message
+    (or anything it embeds, such as the TestRunDetail in a TestRunDetailUpdateMessage) is mutated
+    then the version must be bumped. Messages sent without a version aren't cached at all. We hold a
+    reference to the message for as long as it's cached so its id can't be recycled by another object.
+
+    The cache is bounded by the total size of the encoded payloads, evicting the least recently used.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._cache: OrderedDict[tuple[int, int], tuple[BaseAppSocketMessage, bytes]] = OrderedDict()
+
+    def encode(self, msg: BaseAppSocketMessage, version: Optional[int] = None) -> bytes:
+        if version is None:
+            self.misses += 1
+            return msg.json_bytes()
+
+        key = (id(msg), version)
+        entry = self._cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        payload = msg.json_bytes()
+        if len(payload) <= self.max_bytes:
+            self._cache[key] = (msg, payload)
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self.size -= len(evicted)
+        return payload
+
+    def clear(self):
+        self._cache.clear()
+        self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._cache), 'bytes': self.size}
+
+
+broadcast_encoder = BroadcastEncoder()
+
+
+async def broadcast(msg: BaseAppSocketMessage,
+                    senders: Iterable[Callable[[bytes], Awaitable]],
+                    version: Optional[int] = None,
+                    encoder: BroadcastEncoder = None):
+    """
+    Send a message to many sockets, encoding it only once.
+
+    :param msg: message to send
+    :param senders: send callable for each subscriber e.g websocket.send_bytes
+    :param version: version of the message, which must be bumped whenever it's modified. If omitted
+                    the message is encoded afresh (but still only once for all the senders)
+    :param encoder: defaults to the shared broadcast_encoder
+    :return: list of results (or exceptions) from each sender
+    """
+    payload = (encoder or broadcast_encoder).encode(msg, version)
+    return await asyncio.gather(*[send(payload) for send in senders], return_exceptions=True)
@@ -0,0 +1,117 @@
+import json
+from typing import Any, Optional
+
+from pydantic import ValidationError
+from pydantic.json import pydantic_encoder
+from redis.asyncio import Redis as AsyncRedis
+
+from .redisutils import async_redis
+from .schemas import TestRunBuildState
+
+# set completed to true, returning 1 if we changed it or 0 if it was already completed
+MARK_COMPLETED_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'completed') == 'true' then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'completed', 'true')
+return 1
+"""
+
+
+def get_buildstate_key(trid: int):
+    return f'testrun:{trid}:buildstate'
+
+
+def get_buildstate_specs_key(trid: int):
+    return f'testrun:{trid}:buildstate:specs'
+
+
+def encode_field(value: Any) -> str:
+    return json.dumps(value, default=pydantic_encoder)
+
+
+class BuildStateStore:
+    """
+    Stores a TestRunBuildState as a Redis hash (one JSON-encoded value per field) with the specs in a
+    separate list, so individual fields can be updated atomically without a read-modify-write of the
+    whole state, and the (potentially very long) list of specs is only loaded when it's needed.
+    """
+
+    def __init__(self, redis: AsyncRedis = None):
+        self._redis = redis
+        self._mark_completed = None
+
+    @property
+    def redis(self) -> AsyncRedis:
+        return self._redis or async_redis()
+
+    async def save(self, state: TestRunBuildState):
+        """
+        Replace the entire state
+        """
+        key = get_buildstate_key(state.testrun_id)
+        specs_key = get_buildstate_specs_key(state.testrun_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key, specs_key)
+            pipe.hset(key, mapping={name: encode_field(value)
+                                    for name, value in state.dict(exclude={'specs'}).items()})
+            if state.specs:
+                pipe.rpush(specs_key, *state.specs)
+            await pipe.execute()
+
+    async def load(self, trid: int, with_specs: bool = False) -> Optional[TestRunBuildState]:
+        """
+        Load the state. The specs are left empty unless with_specs is set: use get_specs to fetch them
+        separately
+        """
+        values = await self.redis.hgetall(get_buildstate_key(trid))
+        if not values:
+            return None
+        state = TestRunBuildState.parse_obj({name: json.loads(value) for name, value in values.items()})
+        if with_specs:
+            state.specs = await self.get_specs(trid)
+        return state
+
+    async def get_specs(self, trid: int) -> list[str]:
+        return await self.redis.lrange(get_buildstate_specs_key(trid), 0, -1)
+
+    async def set_specs(self, trid: int, specs: list[str]):
+        specs_key = get_buildstate_specs_key(trid)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(specs_key)
+            if specs:
+                pipe.rpush(specs_key, *specs)
+            await pipe.execute()
+
+    async def remove_spec(self, trid: int, spec: str) -> int:
+        return await self.redis.lrem(get_buildstate_specs_key(trid), 0, spec)
+
+    async def update(self, trid: int, **fields):
+        """
+        Update one or more fields (other than specs) atomically
+        """
+        if 'specs' in fields:
+            raise ValueError('Use set_specs to update the specs')
+        values = {}
+        for name, value in fields.items():
+            field = TestRunBuildState.__fields__[name]
+            value, errors = field.validate(value, {}, loc=name, cls=TestRunBuildState)
+            if errors:
+                raise ValidationError([errors], TestRunBuildState)
+            values[name] = encode_field(value)
+        await self.redis.hset(get_buildstate_key(trid), mapping=values)
+
+    async def incr_run_job_index(self, trid: int, amount: int = 1) -> int:
+        return await self.redis.hincrby(get_buildstate_key(trid), 'run_job_index', amount)
+
+    async def mark_completed(self, trid: int) -> bool:
+        """
+        Mark the run as completed. Returns False if it had already been completed, so only one caller
+        will see True
+        """
+        if not self._mark_completed:
+            self._mark_completed = self.redis.register_script(MARK_COMPLETED_SCRIPT)
+        return bool(await self._mark_completed(keys=[get_buildstate_key(trid)]))
+
+    async def delete(self, trid: int):
+        await self.redis.delete(get_buildstate_key(trid), get_buildstate_specs_key(trid))
@@ -1,28 +1,166 @@
 from __future__ import annotations
 
+import enum
+import os
+import queue
+import threading
 import traceback
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional, TYPE_CHECKING
 
-import google.cloud.logging
-import httpx
 from loguru import logger
 
+from .enums import LogLevel, loglevelToInt
+
+if TYPE_CHECKING:
+    import httpx
+
+# google.cloud.logging and httpx are slow to import, and aren't needed at all off GCP, so they're
+# only imported when we need them
+
+WARNING_LEVEL = logger.level('WARNING').no
+
+
+def record_level(record) -> int:
+    """
+    Map a loguru record onto our loglevelToInt scale
+    """
+    try:
+        return loglevelToInt[LogLevel(record['level'].name.lower())]
+    except ValueError:
+        no = record['level'].no
+        if no < 20:
+            return loglevelToInt[LogLevel.debug]
+        if no < WARNING_LEVEL:
+            return loglevelToInt[LogLevel.info]
+        if no < 40:
+            return loglevelToInt[LogLevel.warning]
+        return loglevelToInt[LogLevel.error]
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+
+    def take(self) -> bool:
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class LogRateLimiter:
+    """
+    Rate limits and de-duplicates log records before they're sent to a cloud sink.
+
+    Each level (from loglevelToInt) below warning gets its own token bucket of rate records per second.
+    A message repeated at the same level within dedupe_window seconds is suppressed. Once the window
+    expires (or the message is evicted to make room for others) the number of suppressed repeats is
+    reported via summaries(). Warnings and errors always pass.
+
+    This is thread-safe, so summaries can be collected from a background thread.
+    """
+
+    def __init__(self, rates: dict[int, float] = None, burst_seconds: float = 5, dedupe_window: float = 10,
+                 max_tracked: int = 1000):
+        rates = rates or {loglevelToInt[LogLevel.debug]: 10, loglevelToInt[LogLevel.info]: 100}
+        self.buckets = {level: TokenBucket(rate, max(int(rate * burst_seconds), 1))
+                        for level, rate in rates.items()}
+        self.dedupe_window = dedupe_window
+        self.max_tracked = max_tracked
+        self.rate_limited = 0
+        self.deduplicated = 0
+        self._lock = threading.Lock()
+        # (level, message) -> [time first sent, suppressed count, level name], oldest first
+        self._seen: OrderedDict[tuple[int, str], list] = OrderedDict()
+        # (level name, message, suppressed count) waiting to be reported
+        self._summaries: list[tuple[str, str, int]] = []
+
+    def check(self, record) -> bool:
+        """
+        :return: True if the record should be sent
+        """
+        level = record_level(record)
+        if level >= loglevelToInt[LogLevel.warning]:
+            return True
+
+        key = (level, record['message'])
+        with self._lock:
+            now = monotonic()
+            self._expire(now)
+            seen = self._seen.get(key)
+            if seen:
+                seen[1] += 1
+                self.deduplicated += 1
+                return False
+
+            bucket = self.buckets.get(level)
+            if bucket and not bucket.take():
+                self.rate_limited += 1
+                return False
+
+            self._seen[key] = [now, 0, record['level'].name]
+            if len(self._seen) > self.max_tracked:
+                self._add_summary(*self._seen.popitem(last=False))
+            return True
+
+    def _expire(self, now: float):
+        while self._seen:
+            key, seen = next(iter(self._seen.items()))
+            if now - seen[0] < self.dedupe_window:
+                return
+            self._seen.popitem(last=False)
+            self._add_summary(key, seen)
+
+    def _add_summary(self, key: tuple[int, str], seen: list):
+        if seen[1]:
+            self._summaries.append((seen[2], key[1], seen[1]))
+
+    def summaries(self, flush: bool = False) -> list[tuple[str, str, int]]:
+        """
+        Take the suppressed repeat counts for messages whose window has expired
+
+        :param flush: report every message with suppressed repeats, whether or not its window has expired
+        :return: list of (level name, message, suppressed count)
+        """
+        with self._lock:
+            if flush:
+                for key, seen in self._seen.items():
+                    self._add_summary(key, seen)
+                self._seen.clear()
+            else:
+                self._expire(monotonic())
+            ret, self._summaries = self._summaries, []
+        return ret
+
+    def metrics(self) -> dict[str, int]:
+        return {'rate_limited': self.rate_limited, 'deduplicated': self.deduplicated}
+
 
 class StackDriverSink:
-    def __init__(self, logger_name='cykube'):
+    def __init__(self, logger_name='cykube', rate_limiter: LogRateLimiter = None):
+        import google.cloud.logging
+
+        self.rate_limiter = rate_limiter
         self.logging_client = google.cloud.logging.Client()
         self.logger = self.logging_client.logger(logger_name)
         with open('/etc/hostname') as f:
             self.hostname = f.read().strip()
 
-    def write(self, message):
+    def format_record(self, record) -> tuple[dict, dict]:
         """
         Loguru stackdriver logging
         source: https://github.com/Delgan/loguru/blob/master/loguru/_handler.py
-        """
-        record = message.record
 
-        if 'kube-probe' in record["message"]:
-            return
+        :return: tuple of structured log entry and log_struct kwargs
+        """
         log_info = {
             "exception": (None if record["exception"] is None
                           else ''.join(traceback.format_exception(None,
@@ -37,23 +175,265 @@ class StackDriverSink:
             for k, v in record["extra"].items():
                 log_info[k] = v
 
-        self.logger.log_struct(log_info,
-                               severity=record['level'].name,
-                               source_location={'file': record['file'].name,
-                                                'function': record["function"],
-                                                'line': record["line"]})
+        return log_info, dict(severity=record['level'].name,
+                              source_location={'file': record['file'].name,
+                                               'function': record["function"],
+                                               'line': record["line"]})
 
+    def accept(self, record) -> Optional[tuple[dict, dict]]:
+        """
+        Filter and format a record
 
-def configure_stackdriver_logging(name: str):
-    # if we're running in GCP, use structured logging
+        :return: tuple of structured log entry and log_struct kwargs, or None if it should be skipped
+        """
+        if 'kube-probe' in record["message"]:
+            return None
+        if self.rate_limiter and not self.rate_limiter.check(record):
+            return None
+        return self.format_record(record)
+
+    def summary_entries(self, flush: bool = False) -> list[tuple[dict, dict]]:
+        """
+        Entries reporting the repeats suppressed by the rate limiter
+        """
+        if not self.rate_limiter:
+            return []
+        return [({'message': f'{message} [repeated {count} times]', 'repeated': count, 'pod': self.hostname},
+                 dict(severity=severity))
+                for severity, message, count in self.rate_limiter.summaries(flush)]
+
+    def write(self, message):
+        entry = self.accept(message.record)
+        for log_info, kwargs in ([entry] if entry else []) + self.summary_entries():
+            self.logger.log_struct(log_info, **kwargs)
+
+
+class OverflowPolicy(str, enum.Enum):
+    drop = 'drop'
+    sample = 'sample'
+
+
+class BatchingStackDriverSink(StackDriverSink):
+    """
+    Queues log entries and ships them in batches from a background thread, so logging never blocks on a
+    Cloud Logging API call.
+
+    Entries are flushed once batch_size are queued or every flush_interval seconds. If the queue fills up
+    new entries are dropped. With the sample overflow policy we also start sampling (keeping one in
+    sample_rate) entries below WARNING once the queue is more than half full, which keeps room for the
+    warnings and errors. The queue is drained when the sink is stopped (loguru does this on exit).
+    """
+
+    def __init__(self, logger_name='cykube', max_queue: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 1.0, overflow: OverflowPolicy = OverflowPolicy.drop,
+                 sample_rate: int = 10, rate_limiter: LogRateLimiter = None):
+        super().__init__(logger_name, rate_limiter)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.sampled_out = 0
+        self.sent = 0
+        self.failed = 0
+        self._sample_counter = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stackdriver-flusher', daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def metrics(self) -> dict[str, int]:
+        ret = {'queue_depth': self.queue_depth,
+               'dropped': self.dropped,
+               'sampled_out': self.sampled_out,
+               'sent': self.sent,
+               'failed': self.failed}
+        if self.rate_limiter:
+            ret.update(self.rate_limiter.metrics())
+        return ret
+
+    def _should_sample_out(self, record) -> bool:
+        if self.overflow != OverflowPolicy.sample or record['level'].no >= WARNING_LEVEL \
+                or self.queue.qsize() < self.queue.maxsize // 2:
+            return False
+        self._sample_counter += 1
+        return self._sample_counter % self.sample_rate != 0
+
+    def write(self, message):
+        record = message.record
+
+        if self._should_sample_out(record):
+            self.sampled_out += 1
+            return
+        entry = self.accept(record)
+        if entry:
+            self._enqueue(entry)
+
+    def _enqueue(self, entry: tuple[dict, dict]):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while not self._stopping.is_set():
+            # report suppressed repeats even if the message never appears again
+            for entry in self.summary_entries():
+                self._enqueue(entry)
+            self._flush_batch(block=True)
+
+    def _flush_batch(self, block: bool) -> int:
+        entries = []
+        deadline = monotonic() + self.flush_interval
+        while len(entries) < self.batch_size:
+            timeout = deadline - monotonic()
+            try:
+                if block and timeout > 0:
+                    entries.append(self.queue.get(timeout=timeout))
+                else:
+                    entries.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if entries:
+            try:
+                batch = self.logger.batch()
+                for log_info, kwargs in entries:
+                    batch.log_struct(log_info, **kwargs)
+                batch.commit()
+                self.sent += len(entries)
+            except Exception:
+                self.failed += len(entries)
+        return len(entries)
+
+    def stop(self):
+        """
+        Stop the background thread and flush anything left in the queue
+        """
+        self._stopping.set()
+        self._thread.join()
+        for entry in self.summary_entries(flush=True):
+            self._enqueue(entry)
+        while self._flush_batch(block=False):
+            pass
+
+
+GCP_METADATA_EMAIL_URL = 'http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/email'
+GCP_METADATA_TIMEOUT = 1.0
+GCP_METADATA_CONNECT_TIMEOUT = 0.25
+GCP_DETECT_CACHE = os.environ.get('GCP_DETECT_CACHE', '/tmp/cykubed-gcp-detected')
+DMI_PRODUCT_NAME = '/sys/class/dmi/id/product_name'
+
+
+def _detect_gcp_locally() -> Optional[bool]:
+    """
+    Try to work out whether we're on GCP without touching the network: an explicit ON_GCP override,
+    a previously cached result, or the DMI product name (which is "Google Compute Engine" on GCE and GKE
+    nodes).
+
+    :return: None if we can't tell
+    """
+    override = os.environ.get('ON_GCP')
+    if override is not None:
+        return override.lower() in ('1', 'true', 'yes')
+    try:
+        with open(GCP_DETECT_CACHE) as f:
+            return f.read().strip() == '1'
+    except OSError:
+        pass
+    try:
+        with open(DMI_PRODUCT_NAME) as f:
+            if 'Google' not in f.read():
+                return False
+    except OSError:
+        pass
+    return None
+
+
+def _cache_gcp_detection(on_gcp: bool) -> bool:
+    try:
+        with open(GCP_DETECT_CACHE, 'w') as f:
+            f.write('1' if on_gcp else '0')
+    except OSError:
+        pass
+    return on_gcp
+
+
+def _is_gcp_metadata_response(resp: httpx.Response) -> bool:
+    return resp.status_code == 200 and resp.headers.get('metadata-flavor') == 'Google' \
+        and resp.text.endswith('gserviceaccount.com')
+
+
+def _check_metadata_response(resp: httpx.Response) -> bool:
+    on_gcp = _is_gcp_metadata_response(resp)
+    if on_gcp or resp.headers.get('metadata-flavor') != 'Google':
+        # a definitive answer: either the metadata server, or something else entirely. An error from the
+        # metadata server itself (e.g while the pod is starting) isn't cached, so we'll try again next time
+        _cache_gcp_detection(on_gcp)
+    return on_gcp
+
+
+def is_running_on_gcp() -> bool:
+    on_gcp = _detect_gcp_locally()
+    if on_gcp is not None:
+        return on_gcp
+    import httpx
+
+    try:
+        resp = httpx.get(GCP_METADATA_EMAIL_URL, headers={'Metadata-Flavor': 'Google'},
+                         timeout=httpx.Timeout(GCP_METADATA_TIMEOUT, connect=GCP_METADATA_CONNECT_TIMEOUT))
+        return _check_metadata_response(resp)
+    except httpx.TimeoutException:
+        # the metadata server can be slow to respond just after a pod starts, so don't cache a timeout
+        return False
+    except httpx.HTTPError:
+        # e.g metadata.google.internal doesn't resolve, so we're not on GCP
+        return _cache_gcp_detection(False)
+
+
+async def async_is_running_on_gcp() -> bool:
+    on_gcp = _detect_gcp_locally()
+    if on_gcp is not None:
+        return on_gcp
+    import httpx
+
+    try:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(GCP_METADATA_TIMEOUT,
+                                                           connect=GCP_METADATA_CONNECT_TIMEOUT)) as client:
+            resp = await client.get(GCP_METADATA_EMAIL_URL, headers={'Metadata-Flavor': 'Google'})
+        return _check_metadata_response(resp)
+    except httpx.TimeoutException:
+        # the metadata server can be slow to respond just after a pod starts, so don't cache a timeout
+        return False
+    except httpx.HTTPError:
+        # e.g metadata.google.internal doesn't resolve, so we're not on GCP
+        return _cache_gcp_detection(False)
+
+
+def _add_stackdriver_sink(name: str, batched: bool, rate_limiter: Optional[LogRateLimiter]):
     try:
-        resp = httpx.get('http://metadata.google.internal')
-        if resp.status_code == 200 and resp.headers['metadata-flavor'] == 'Google':
-            resp = httpx.get('http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/email',
-                             headers={'Metadata-Flavor': 'Google'})
-            if resp.status_code == 200 and resp.text.endswith('gserviceaccount.com'):
-                logger.add(StackDriverSink(name))
-                client = google.cloud.logging.Client()
-                client.setup_logging()
+        import google.cloud.logging
+
+        if batched:
+            logger.add(BatchingStackDriverSink(name, rate_limiter=rate_limiter))
+        else:
+            logger.add(StackDriverSink(name, rate_limiter))
+        client = google.cloud.logging.Client()
+        client.setup_logging()
     except:
         pass
+
+
+def configure_stackdriver_logging(name: str, batched: bool = True, rate_limiter: LogRateLimiter = None):
+    # if we're running in GCP, use structured logging
+    if is_running_on_gcp():
+        _add_stackdriver_sink(name, batched, rate_limiter)
+
+
+async def async_configure_stackdriver_logging(name: str, batched: bool = True,
+                                              rate_limiter: LogRateLimiter = None):
+    if await async_is_running_on_gcp():
+        _add_stackdriver_sink(name, batched, rate_limiter)
@@ -0,0 +1,314 @@
+from array import array
+from collections.abc import Sequence
+from typing import Iterable, Iterator, Optional, Union
+
+from .enums import TestResultStatus
+from .schemas import SpecTests, SpecTestsDelta, SpecTest, TestResult, TestResultError
+
+STATUSES = list(TestResultStatus)
+STATUS_CODES = {status: i for i, status in enumerate(STATUSES)}
+
+# sentinel used in place of None in the integer columns
+NO_VALUE = -1
+
+# the dict() arguments that we pass down to each test
+TEST_DICT_ARGS = ('by_alias', 'exclude_unset', 'exclude_defaults', 'exclude_none')
+
+
+def _status_code(status: Union[TestResultStatus, str]) -> int:
+    try:
+        return STATUS_CODES[status]
+    except KeyError:
+        raise ValueError(f'{status!r} is not a valid TestResultStatus') from None
+
+
+class CompactTests(Sequence):
+    """
+    Column store for the tests of a CompactSpecTests. Rather than one Pydantic model per result we keep a
+    column per field: statuses and browsers are interned as small ints, retries and durations live in
+    typed arrays, and the (rare) errors and screenshots are kept in a side table keyed on the result index.
+    The results of each test are chained together, so results added by a merge don't need to be contiguous.
+
+    This behaves as a read-only sequence of SpecTest: each test (and its results) is only built when it's
+    accessed, and isn't kept, so modifying it has no effect.
+    """
+
+    def __init__(self, tests: Iterable[Union[SpecTest, dict]] = ()):
+        # one entry per test
+        self.titles: list[str] = []
+        self.contexts: list[Optional[str]] = []
+        self.lines = array('l')
+        self.test_statuses = array('B')
+        self.first_result = array('l')
+        self.last_result = array('l')
+
+        # one entry per result
+        self.result_browser = array('B')
+        self.result_status = array('B')
+        self.result_retry = array('H')
+        self.result_duration = array('l')
+        self.next_result = array('l')
+
+        # side tables, keyed on result index
+        self.errors: dict[int, list[TestResultError]] = {}
+        self.screenshots: dict[int, list[str]] = {}
+
+        self.browsers: list[str] = []
+        self._browser_codes: dict[str, int] = {}
+        self._index: dict[tuple[Optional[str], str], int] = {}
+
+        for test in tests:
+            self.append(test)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._test(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('test index out of range')
+        return self._test(idx)
+
+    def __iter__(self) -> Iterator[SpecTest]:
+        for idx in range(len(self)):
+            yield self._test(idx)
+
+    def __repr__(self):
+        return f'CompactTests({len(self)} tests, {len(self.result_status)} results)'
+
+    def _browser_code(self, browser: str) -> int:
+        code = self._browser_codes.get(browser)
+        if code is None:
+            code = self._browser_codes[browser] = len(self.browsers)
+            self.browsers.append(browser)
+        return code
+
+    def append(self, test: Union[SpecTest, dict]) -> int:
+        if isinstance(test, dict):
+            return self._append_dict(test)
+        idx = self._add_test(test.title, test.context, test.line, STATUS_CODES[test.status])
+        self.extend_results(idx, test.results)
+        return idx
+
+    def _append_dict(self, test: dict) -> int:
+        """
+        Add a test straight from its dict (e.g parsed JSON) into the columns, rather than building the
+        SpecTest and TestResult models only to throw them away. Only the errors are parsed into models.
+        """
+        idx = self._add_test(test['title'], test.get('context'), test.get('line'), _status_code(test['status']))
+        for result in test['results']:
+            if isinstance(result, TestResult):
+                self.extend_results(idx, [result])
+                continue
+            errors = result.get('errors')
+            self._add_result(idx, self._browser_code(result['browser']), _status_code(result['status']),
+                             result.get('retry', 0), result.get('duration'), result.get('failure_screenshots'),
+                             None if errors is None else [TestResultError.validate(error) for error in errors])
+        return idx
+
+    def extend_results(self, idx: int, results: Iterable[TestResult]):
+        """
+        Add results to the test with the given index
+        """
+        for result in results:
+            self._add_result(idx, self._browser_code(result.browser), STATUS_CODES[result.status],
+                             result.retry, result.duration, result.failure_screenshots, result.errors)
+
+    def set_status(self, idx: int, status: TestResultStatus):
+        self.test_statuses[idx] = STATUS_CODES[status]
+
+    def _add_test(self, title: str, context: Optional[str], line: Optional[int], status: int) -> int:
+        idx = len(self.titles)
+        self.titles.append(title)
+        self.contexts.append(context)
+        self.lines.append(NO_VALUE if line is None else line)
+        self.test_statuses.append(status)
+        self.first_result.append(NO_VALUE)
+        self.last_result.append(NO_VALUE)
+        self._index.setdefault((context, title), idx)
+        return idx
+
+    def _add_result(self, test_idx: int, browser: int, status: int, retry: int, duration: Optional[int],
+                    screenshots: Optional[list[str]], errors: Optional[list[TestResultError]]):
+        idx = len(self.result_status)
+        self.result_browser.append(browser)
+        self.result_status.append(status)
+        self.result_retry.append(retry)
+        self.result_duration.append(NO_VALUE if duration is None else duration)
+        self.next_result.append(NO_VALUE)
+        if screenshots is not None:
+            self.screenshots[idx] = screenshots
+        if errors is not None:
+            self.errors[idx] = errors
+
+        last = self.last_result[test_idx]
+        if last == NO_VALUE:
+            self.first_result[test_idx] = idx
+        else:
+            self.next_result[last] = idx
+        self.last_result[test_idx] = idx
+
+    def _result_indices(self, test_idx: int) -> Iterator[int]:
+        idx = self.first_result[test_idx]
+        while idx != NO_VALUE:
+            yield idx
+            idx = self.next_result[idx]
+
+    def _result(self, idx: int) -> TestResult:
+        duration = self.result_duration[idx]
+        return TestResult.construct(browser=self.browsers[self.result_browser[idx]],
+                                    status=STATUSES[self.result_status[idx]],
+                                    retry=self.result_retry[idx],
+                                    duration=None if duration == NO_VALUE else duration,
+                                    failure_screenshots=self.screenshots.get(idx),
+                                    errors=self.errors.get(idx))
+
+    def _test(self, idx: int) -> SpecTest:
+        line = self.lines[idx]
+        return SpecTest.construct(title=self.titles[idx],
+                                  context=self.contexts[idx],
+                                  line=None if line == NO_VALUE else line,
+                                  status=STATUSES[self.test_statuses[idx]],
+                                  results=[self._result(i) for i in self._result_indices(idx)])
+
+    def _merge_status(self, idx: int, status: int):
+        if status == STATUS_CODES[TestResultStatus.passed]:
+            return
+        if status == STATUS_CODES[TestResultStatus.failed]:
+            self.test_statuses[idx] = status
+        elif self.test_statuses[idx] != STATUS_CODES[TestResultStatus.failed]:
+            # must be flakey
+            self.test_statuses[idx] = STATUS_CODES[TestResultStatus.flakey]
+
+    def merge(self, tests: Iterable[SpecTest]):
+        """
+        Same semantics as SpecTests.merge. Merging another CompactTests copies the columns directly
+        """
+        if isinstance(tests, CompactTests):
+            self._merge_compact(tests)
+            return
+        for test in tests:
+            idx = self._index.get((test.context, test.title))
+            if idx is None:
+                self.append(test)
+                continue
+            self._merge_status(idx, STATUS_CODES[test.status])
+            self.extend_results(idx, test.results)
+
+    def _merge_compact(self, other: 'CompactTests'):
+        browsers = [self._browser_code(browser) for browser in other.browsers]
+        for other_idx in range(len(other)):
+            title = other.titles[other_idx]
+            context = other.contexts[other_idx]
+            status = other.test_statuses[other_idx]
+            idx = self._index.get((context, title))
+            if idx is None:
+                line = other.lines[other_idx]
+                idx = self._add_test(title, context, None if line == NO_VALUE else line, status)
+            else:
+                self._merge_status(idx, status)
+            for i in other._result_indices(other_idx):
+                duration = other.result_duration[i]
+                self._add_result(idx, browsers[other.result_browser[i]], other.result_status[i],
+                                 other.result_retry[i], None if duration == NO_VALUE else duration,
+                                 other.screenshots.get(i), other.errors.get(i))
+
+    def count(self) -> tuple[int, int, int]:
+        failed_code = STATUS_CODES[TestResultStatus.failed]
+        flakey_code = STATUS_CODES[TestResultStatus.flakey]
+        passed_code = STATUS_CODES[TestResultStatus.passed]
+        failed = 0
+        flakes = 0
+        total = 0
+        for test_idx, test_status in enumerate(self.test_statuses):
+            all_browsers = set()
+            browsers = set()
+            for idx in self._result_indices(test_idx):
+                browser = self.result_browser[idx]
+                all_browsers.add(browser)
+                status = self.result_status[idx]
+                if status == failed_code or (status == passed_code and self.result_retry[idx] > 0):
+                    browsers.add(browser)
+            total += len(all_browsers)
+            if test_status == failed_code:
+                failed += len(browsers)
+            elif test_status == flakey_code:
+                flakes += len(browsers)
+        return total, flakes, failed
+
+    def get_filtered_test_results(self, status: TestResultStatus) -> list[TestResult]:
+        code = STATUS_CODES[status]
+        return [self._result(idx)
+                for test_idx in range(len(self)) for idx in self._result_indices(test_idx)
+                if self.result_status[idx] == code]
+
+
+class CompactSpecTests(SpecTests):
+    """
+    Memory-efficient SpecTests backend for large runs, which holds the tests in a CompactTests column
+    store rather than as a tree of models. It can be used anywhere a SpecTests can (e.g SpecFile.result),
+    and serializes to the same JSON.
+
+    The tests are read-only: use merge to add to them.
+    """
+
+    def __init__(self, **data):
+        tests = data.pop('tests', ())
+        super().__init__(**data)
+        self.tests = tests
+
+    def __setattr__(self, name, value):
+        if name == 'tests' and not isinstance(value, CompactTests):
+            value = CompactTests(value)
+        super().__setattr__(name, value)
+
+    @classmethod
+    def from_spectests(cls, spectests: SpecTests) -> 'CompactSpecTests':
+        return cls(tests=CompactTests(spectests.tests), video=spectests.video, timeout=spectests.timeout)
+
+    def to_spectests(self) -> SpecTests:
+        return SpecTests(tests=list(self.tests), video=self.video, timeout=self.timeout)
+
+    def copy(self, **kwargs):
+        spectests = super().copy(**kwargs)
+        if not isinstance(spectests.tests, CompactTests):
+            # replaced via update
+            spectests.tests = spectests.tests
+        return spectests
+
+    def dict(self, **kwargs):
+        data = super().dict(**kwargs)
+        if 'tests' in data:
+            test_kwargs = {name: kwargs[name] for name in TEST_DICT_ARGS if name in kwargs}
+            data['tests'] = [test.dict(**test_kwargs) for test in data['tests']]
+        return data
+
+    def json(self, *, include=None, exclude=None, by_alias: bool = False, exclude_unset: bool = False,
+             exclude_defaults: bool = False, exclude_none: bool = False, encoder=None, **dumps_kwargs) -> str:
+        data = self.dict(include=include, exclude=exclude, by_alias=by_alias, exclude_unset=exclude_unset,
+                         exclude_defaults=exclude_defaults, exclude_none=exclude_none)
+        return self.__config__.json_dumps(data, default=encoder or self.__json_encoder__, **dumps_kwargs)
+
+    def recount(self):
+        # nothing is cached
+        pass
+
+    def count(self):
+        return self.tests.count()
+
+    def get_filtered_test_results(self, status: TestResultStatus) -> list[TestResult]:
+        return self.tests.get_filtered_test_results(status)
+
+    def merge(self, spectests: SpecTests):
+        self.tests.merge(spectests.tests)
+
+    def apply_delta(self, delta: SpecTestsDelta):
+        for idx, results in delta.results.items():
+            self.tests.extend_results(idx, results)
+        for idx, status in delta.statuses.items():
+            self.tests.set_status(idx, status)
+        for test in delta.tests:
+            self.tests.append(test)
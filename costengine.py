@@ -0,0 +1,101 @@
+from typing import Iterable, Optional
+
+import numpy as np
+
+from .jobstats import pod_resources
+from .schemas import BaseProject, KubernetesPlatformPricingModel, PodDuration
+
+# columns of the pricing table
+CPU_NORMAL, CPU_SPOT, MEMORY_NORMAL, MEMORY_SPOT, EPHEMERAL = range(5)
+
+
+def pricing_table(models: list[KubernetesPlatformPricingModel]) -> np.ndarray:
+    """
+    Build an (n, 5) array of hourly prices from the pricing models. Missing spot prices fall back to
+    the normal price, and any other missing price to zero
+    """
+    table = np.array([[m.cpu_normal_price, m.cpu_spot_price, m.memory_normal_price, m.memory_spot_price,
+                       m.ephemeral_price] for m in models], dtype=float).reshape(-1, 5)
+    table[:, CPU_SPOT] = np.where(np.isnan(table[:, CPU_SPOT]), table[:, CPU_NORMAL], table[:, CPU_SPOT])
+    table[:, MEMORY_SPOT] = np.where(np.isnan(table[:, MEMORY_SPOT]), table[:, MEMORY_NORMAL],
+                                     table[:, MEMORY_SPOT])
+    return np.nan_to_num(table)
+
+
+class PodRecords:
+    """
+    Column arrays describing a set of pods: one entry per pod
+    """
+
+    def __init__(self, testrun_ids, organisation_ids, durations, cpu, memory, ephemeral, is_spot, pricing_idx):
+        self.testrun_ids = np.asarray(testrun_ids, dtype=np.int64)
+        self.organisation_ids = np.asarray(organisation_ids, dtype=np.int64)
+        self.durations = np.asarray(durations, dtype=float)
+        self.cpu = np.asarray(cpu, dtype=float)
+        self.memory = np.asarray(memory, dtype=float)
+        self.ephemeral = np.asarray(ephemeral, dtype=float)
+        self.is_spot = np.asarray(is_spot, dtype=bool)
+        self.pricing_idx = np.asarray(pricing_idx, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.testrun_ids)
+
+    @classmethod
+    def from_pods(cls, pods: Iterable[tuple[int, BaseProject, PodDuration, int]]) -> 'PodRecords':
+        """
+        :param pods: tuples of (testrun ID, project, pod duration, index into the pricing table)
+        """
+        rows = []
+        for testrun_id, project, pod, pricing_idx in pods:
+            cpu, memory, ephemeral = pod_resources(project, pod.job_type)
+            rows.append((testrun_id, project.organisation_id, pod.duration, cpu, memory, ephemeral,
+                         pod.is_spot, pricing_idx))
+        if not rows:
+            return cls(*[[]] * 8)
+        return cls(*zip(*rows))
+
+
+class CostReport:
+    def __init__(self, testrun_ids: np.ndarray, testrun_costs: np.ndarray,
+                 organisation_ids: np.ndarray, organisation_costs: np.ndarray):
+        self.testrun_ids = testrun_ids
+        self.testrun_costs = testrun_costs
+        self.organisation_ids = organisation_ids
+        self.organisation_costs = organisation_costs
+
+    @property
+    def total(self) -> float:
+        return float(self.testrun_costs.sum())
+
+    def by_testrun(self) -> dict[int, float]:
+        return dict(zip(self.testrun_ids.tolist(), self.testrun_costs.tolist()))
+
+    def by_organisation(self) -> dict[int, float]:
+        return dict(zip(self.organisation_ids.tolist(), self.organisation_costs.tolist()))
+
+
+def pod_costs(records: PodRecords, table: np.ndarray, spot: Optional[bool] = None) -> np.ndarray:
+    """
+    Cost in USD of each pod.
+
+    :param spot: what-if override: True to price every pod as spot, False to price every pod as normal,
+                 or None to use each pod's actual is_spot
+    """
+    is_spot = records.is_spot if spot is None else np.full(len(records), spot)
+    prices = table[records.pricing_idx]
+    cpu_price = np.where(is_spot, prices[:, CPU_SPOT], prices[:, CPU_NORMAL])
+    memory_price = np.where(is_spot, prices[:, MEMORY_SPOT], prices[:, MEMORY_NORMAL])
+    hourly = records.cpu * cpu_price + records.memory * memory_price + records.ephemeral * prices[:, EPHEMERAL]
+    return records.durations * hourly / 3600
+
+
+def compute_costs(records: PodRecords, table: np.ndarray, spot: Optional[bool] = None) -> CostReport:
+    """
+    Per-test run and per-organisation costs for a set of pods, computed in a single vectorized pass
+    """
+    costs = pod_costs(records, table, spot)
+    testrun_ids, testrun_idx = np.unique(records.testrun_ids, return_inverse=True)
+    organisation_ids, organisation_idx = np.unique(records.organisation_ids, return_inverse=True)
+    return CostReport(testrun_ids, np.bincount(testrun_idx, weights=costs, minlength=len(testrun_ids)),
+                      organisation_ids,
+                      np.bincount(organisation_idx, weights=costs, minlength=len(organisation_ids)))
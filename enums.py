@@ -176,6 +176,7 @@ class SpecFileStatus(str, enum.Enum):
 
 class AppWebSocketActions(str, enum.Enum):
     testrun = 'testrun'
+    testrun_delta = 'testrun-delta'
     jobstats = 'jobstats'
     status = 'status'
     spec_started = 'spec-started'
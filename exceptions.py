@@ -39,3 +39,6 @@ class InvalidTemplateException(Exception):
 class ServerConnectionFailed(Exception):
     pass
 
+
+class UnknownEventError(Exception):
+    pass
@@ -0,0 +1,166 @@
+import asyncio
+from time import monotonic
+from typing import Awaitable, Callable, Optional, Union
+
+from .enums import JobType
+from .schemas import (BaseProject, KubernetesPlatformPricingModel, PodDuration, PodStatus, TestRunJobStats,
+                      TestRunJobStatsUpdateMessage)
+
+
+# pod phases in which all of the pod's containers have terminated
+FINISHED_POD_PHASES = {'Succeeded', 'Failed'}
+
+
+def pod_resources(project: BaseProject, job_type: Union[JobType, str]) -> tuple[float, float, float]:
+    """
+    vCPU, memory GB and ephemeral storage GB requested by a pod of the given job type
+    """
+    if job_type == JobType.builder:
+        return project.build_cpu, project.build_memory, project.build_ephemeral_storage
+    return project.runner_cpu, project.runner_memory, project.runner_ephemeral_storage
+
+
+class JobStatsAccumulator:
+    """
+    Running resource-usage totals for a single test run, updated in O(1) as each pod finishes
+    """
+
+    def __init__(self, testrun_id: int, project: BaseProject,
+                 pricing: Optional[KubernetesPlatformPricingModel] = None):
+        self.testrun_id = testrun_id
+        self.project = project
+        self.pricing = pricing
+        self.build_seconds = 0
+        self.runner_seconds = 0
+        # [normal, spot]
+        self.cpu_seconds = [0.0, 0.0]
+        self.memory_gb_seconds = [0.0, 0.0]
+        self.ephemeral_gb_seconds = [0.0, 0.0]
+        self._counted: set[str] = set()
+
+    def add(self, pod_name: str, job_type: Union[JobType, str], is_spot: bool, duration: int) -> bool:
+        """
+        Add a finished pod. Each pod is only counted once
+
+        :return: True if the totals changed
+        """
+        if pod_name in self._counted or duration <= 0:
+            return False
+        self._counted.add(pod_name)
+
+        if job_type == JobType.builder:
+            self.build_seconds += duration
+        else:
+            self.runner_seconds += duration
+        cpu, memory, ephemeral = pod_resources(self.project, job_type)
+        idx = 1 if is_spot else 0
+        self.cpu_seconds[idx] += cpu * duration
+        self.memory_gb_seconds[idx] += memory * duration
+        self.ephemeral_gb_seconds[idx] += ephemeral * duration
+        return True
+
+    def add_pod_duration(self, pod: PodDuration) -> bool:
+        return self.add(pod.pod_name, pod.job_type, pod.is_spot, pod.duration)
+
+    def add_pod_status(self, pod: PodStatus) -> bool:
+        """
+        Add a pod from a lifecycle event: ignored until the pod has finished (i.e it has an end time, or is in
+        a terminal phase), as the duration of a running pod is only partial
+        """
+        if not pod.end_time and pod.phase not in FINISHED_POD_PHASES:
+            return False
+        duration = pod.duration
+        if duration is None:
+            if not pod.start_time or not pod.end_time:
+                return False
+            duration = int((pod.end_time - pod.start_time).total_seconds())
+        return self.add(pod.pod_name, pod.job_type, pod.is_spot, duration)
+
+    def cost(self) -> Optional[float]:
+        pricing = self.pricing
+        if not pricing:
+            return None
+        # prices are per hour
+        return (self.cpu_seconds[0] * (pricing.cpu_normal_price or 0) +
+                self.cpu_seconds[1] * (pricing.cpu_spot_price or pricing.cpu_normal_price or 0) +
+                self.memory_gb_seconds[0] * (pricing.memory_normal_price or 0) +
+                self.memory_gb_seconds[1] * (pricing.memory_spot_price or pricing.memory_normal_price or 0) +
+                sum(self.ephemeral_gb_seconds) * (pricing.ephemeral_price or 0)) / 3600
+
+    @property
+    def stats(self) -> TestRunJobStats:
+        return TestRunJobStats(total_build_seconds=self.build_seconds,
+                               total_runner_seconds=self.runner_seconds,
+                               total_cpu_seconds=round(sum(self.cpu_seconds)),
+                               total_memory_gb_seconds=round(sum(self.memory_gb_seconds)),
+                               total_ephemeral_gb_seconds=round(sum(self.ephemeral_gb_seconds)),
+                               cpu_seconds_normal=round(self.cpu_seconds[0]),
+                               memory_gb_seconds_normal=round(self.memory_gb_seconds[0]),
+                               ephemeral_gb_seconds_normal=round(self.ephemeral_gb_seconds[0]),
+                               cpu_seconds_spot=round(self.cpu_seconds[1]),
+                               memory_gb_seconds_spot=round(self.memory_gb_seconds[1]),
+                               ephemeral_gb_seconds_spot=round(self.ephemeral_gb_seconds[1]),
+                               total_cost_usd=self.cost())
+
+
+class JobStatsTracker:
+    """
+    Tracks job stats for all active test runs from pod lifecycle events, sending a
+    TestRunJobStatsUpdateMessage at most once every min_interval seconds per test run. Updates that arrive
+    within the interval are coalesced into a single trailing message, so the latest totals are always sent.
+    """
+
+    def __init__(self, send: Callable[[TestRunJobStatsUpdateMessage], Awaitable], min_interval: float = 5.0):
+        self.send = send
+        self.min_interval = min_interval
+        self.accumulators: dict[int, JobStatsAccumulator] = {}
+        self._last_sent: dict[int, float] = {}
+        self._pending: dict[int, asyncio.Task] = {}
+
+    def add_testrun(self, testrun_id: int, project: BaseProject,
+                    pricing: Optional[KubernetesPlatformPricingModel] = None) -> JobStatsAccumulator:
+        acc = self.accumulators.get(testrun_id)
+        if not acc:
+            acc = self.accumulators[testrun_id] = JobStatsAccumulator(testrun_id, project, pricing)
+        return acc
+
+    async def on_pod_event(self, pod: PodStatus):
+        acc = self.accumulators.get(pod.testrun_id)
+        if acc and acc.add_pod_status(pod):
+            await self._notify(pod.testrun_id)
+
+    async def _notify(self, testrun_id: int):
+        if testrun_id in self._pending:
+            # already have a trailing update scheduled
+            return
+        wait = self._last_sent.get(testrun_id, 0) + self.min_interval - monotonic()
+        if wait <= 0:
+            await self._send(testrun_id)
+        else:
+            self._pending[testrun_id] = asyncio.create_task(self._send_later(testrun_id, wait))
+
+    async def _send_later(self, testrun_id: int, wait: float):
+        await asyncio.sleep(wait)
+        self._pending.pop(testrun_id, None)
+        await self._send(testrun_id)
+
+    async def _send(self, testrun_id: int):
+        acc = self.accumulators.get(testrun_id)
+        if acc:
+            self._last_sent[testrun_id] = monotonic()
+            await self.send(TestRunJobStatsUpdateMessage(testrun_id=testrun_id, stats=acc.stats))
+
+    async def complete(self, testrun_id: int) -> Optional[TestRunJobStats]:
+        """
+        Send the final stats for a test run immediately and stop tracking it
+        """
+        task = self._pending.pop(testrun_id, None)
+        if task:
+            task.cancel()
+        acc = self.accumulators.get(testrun_id)
+        if not acc:
+            return None
+        await self._send(testrun_id)
+        del self.accumulators[testrun_id]
+        self._last_sent.pop(testrun_id, None)
+        return acc.stats
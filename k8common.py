@@ -1,26 +1,164 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import functools
+import inspect
 import os
+import random
+import ssl
+from collections import defaultdict
+from time import monotonic
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional, Union
 
-from kubernetes_asyncio import client, config
-from kubernetes_asyncio.client import ApiClient
 from loguru import logger
 
+if TYPE_CHECKING:
+    from kubernetes_asyncio.client import ApiClient
+
 NAMESPACE = os.environ.get('NAMESPACE', 'cykube')
 
+# connection pool for the shared ApiClient
+K8_CONNECTION_LIMIT = int(os.environ.get('K8_CONNECTION_LIMIT', 100))
+# 0 means no per-host limit, which is what we want as everything goes to the one API server
+K8_CONNECTION_LIMIT_PER_HOST = int(os.environ.get('K8_CONNECTION_LIMIT_PER_HOST', 0))
+K8_KEEPALIVE_TIMEOUT = float(os.environ.get('K8_KEEPALIVE_TIMEOUT', 30))
+# maximum number of concurrent API requests (0 for no limit)
+K8_MAX_CONCURRENCY = int(os.environ.get('K8_MAX_CONCURRENCY', 0))
+
 k8clients = dict()
 
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class LatencyHistogram:
+    """
+    Cumulative-bucket latency histogram, in seconds
+    """
+    def __init__(self, buckets: list[float] = None):
+        self.buckets = buckets or LATENCY_BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def to_dict(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+api_latency: dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+
+
+def get_api_latency_stats() -> dict[str, dict]:
+    """
+    Latency histogram for each API method we've called, keyed on e.g "BatchV1Api.create_namespaced_job"
+    """
+    return {name: hist.to_dict() for name, hist in api_latency.items()}
+
+
+class InstrumentedApi:
+    """
+    Wraps one of the generated API classes, recording the latency of each call and optionally limiting
+    the number of concurrent requests
+    """
+    def __init__(self, api, semaphore: Optional[asyncio.Semaphore] = None):
+        self._api = api
+        self._semaphore = semaphore
+        self._prefix = api.__class__.__name__
+        self._wrapped = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        wrapped = self._wrapped.get(name)
+        if not wrapped:
+            key = f'{self._prefix}.{name}'
+
+            async def call(*args, **kwargs):
+                if self._semaphore:
+                    async with self._semaphore:
+                        return await timed(*args, **kwargs)
+                return await timed(*args, **kwargs)
+
+            async def timed(*args, **kwargs):
+                start = monotonic()
+                try:
+                    return await attr(*args, **kwargs)
+                finally:
+                    api_latency[key].observe(monotonic() - start)
+
+            # keep the docstring, as the Watch class parses it for the return type
+            wrapped = self._wrapped[name] = functools.wraps(attr)(call)
+        return wrapped
+
+
+def _ssl_context(configuration) -> ssl.SSLContext:
+    """
+    SSL context for the API server connection, built from the client configuration in the same way as the
+    generated REST client
+    """
+    context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+    if configuration.cert_file:
+        context.load_cert_chain(configuration.cert_file, keyfile=configuration.key_file)
+    if not configuration.verify_ssl:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if getattr(configuration, 'disable_strict_ssl_verification', False):
+        context.verify_flags &= ~ssl.VERIFY_X509_STRICT
+    return context
+
+
+async def init(connection_limit: int = None, limit_per_host: int = None, keepalive_timeout: float = None,
+               max_concurrency: int = None):
+    """
+    Create the shared API client and APIs. Any parameters not set default to the corresponding
+    K8_ environment variables
+    """
+    # kubernetes_asyncio is slow to import, so defer it until we actually need a client
+    import aiohttp
+    from kubernetes_asyncio import client, config
+    from kubernetes_asyncio.client import ApiClient
 
-async def init():
     if os.path.exists('/var/run/secrets/kubernetes.io'):
         # we're inside a cluster
         config.load_incluster_config()
     else:
         # we're not
         await config.load_kube_config()
-    api = k8clients['api'] = ApiClient()
-    k8clients['batch'] = client.BatchV1Api(api)
-    k8clients['event'] = client.EventsV1Api(api)
-    k8clients['core'] = client.CoreV1Api(api)
-    k8clients['custom'] = client.CustomObjectsApi(api)
+    configuration = client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = K8_CONNECTION_LIMIT if connection_limit is None else connection_limit
+    api = k8clients['api'] = ApiClient(configuration)
+
+    # the generated client doesn't expose the other connector settings, so replace its session with one
+    # that has the same SSL settings
+    rest = api.rest_client
+    old_session = rest.pool_manager
+    connector = aiohttp.TCPConnector(limit=configuration.connection_pool_maxsize,
+                                     limit_per_host=K8_CONNECTION_LIMIT_PER_HOST if limit_per_host is None
+                                     else limit_per_host,
+                                     keepalive_timeout=K8_KEEPALIVE_TIMEOUT if keepalive_timeout is None
+                                     else keepalive_timeout,
+                                     ssl=_ssl_context(configuration))
+    rest.pool_manager = aiohttp.ClientSession(connector=connector, trust_env=True, read_bufsize=2 ** 21)
+    await old_session.close()
+
+    if max_concurrency is None:
+        max_concurrency = K8_MAX_CONCURRENCY
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+    k8clients['batch'] = InstrumentedApi(client.BatchV1Api(api), semaphore)
+    k8clients['event'] = InstrumentedApi(client.EventsV1Api(api), semaphore)
+    k8clients['core'] = InstrumentedApi(client.CoreV1Api(api), semaphore)
+    k8clients['custom'] = InstrumentedApi(client.CustomObjectsApi(api), semaphore)
 
 
 async def close():
@@ -34,17 +172,325 @@ def get_client() -> ApiClient:
     return k8clients['api']
 
 
-def get_batch_api() -> client.BatchV1Api:
+def get_batch_api() -> InstrumentedApi:
     return k8clients['batch']
 
 
-def get_events_api() -> client.EventsV1Api:
+def get_events_api() -> InstrumentedApi:
     return k8clients['event']
 
 
-def get_core_api() -> client.CoreV1Api:
+def get_core_api() -> InstrumentedApi:
     return k8clients['core']
 
 
-def get_custom_api() -> client.CustomObjectsApi:
+def get_custom_api() -> InstrumentedApi:
     return k8clients['custom']
+
+
+#
+# Informers
+#
+
+TESTRUN_LABEL = 'testrun_id'
+JOB_TYPE_LABEL = 'job_type'
+
+
+def pod_phase(pod) -> Optional[str]:
+    return pod.status.phase if pod.status else None
+
+
+def job_phase(job) -> Optional[str]:
+    status = job.status
+    if not status:
+        return None
+    for condition in status.conditions or []:
+        if condition.status == 'True' and condition.type in ('Complete', 'Failed'):
+            return condition.type
+    if status.active:
+        return 'Active'
+    return 'Pending'
+
+
+EventHandler = Callable[[str, Any], Union[Awaitable, None]]
+
+
+class Informer:
+    """
+    Keeps a local, indexed cache of a type of K8 object, so the agent can look up its Jobs and Pods without
+    polling the API server.
+
+    We do an initial list, then watch from the list's resourceVersion. If the watch drops we resume from the
+    last resourceVersion we saw, and only fall back to a full re-list if the API server tells us that
+    version has expired (410 Gone). Objects are indexed by testrun ID and job type (from their labels) and by
+    phase. Handlers are called with the event type (ADDED, MODIFIED or DELETED) and the object.
+    """
+
+    def __init__(self, list_func: Callable[..., Awaitable], phase_func: Callable[[Any], Optional[str]],
+                 namespace: str = None, label_selector: str = None, watch_timeout: int = 300):
+        self.list_func = list_func
+        self.phase_func = phase_func
+        self.namespace = namespace or NAMESPACE
+        self.label_selector = label_selector
+        self.watch_timeout = watch_timeout
+        self.resource_version = None
+        self.store: dict[str, Any] = {}
+        self._indexes: dict[str, dict[str, set[str]]] = {'testrun_id': defaultdict(set),
+                                                         'job_type': defaultdict(set),
+                                                         'phase': defaultdict(set)}
+        self._index_keys: dict[str, dict[str, Optional[str]]] = {}
+        self._handlers: list[EventHandler] = []
+        self._synced = asyncio.Event()
+        self._task = None
+
+    def add_handler(self, handler: EventHandler):
+        self._handlers.append(handler)
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def wait_synced(self):
+        await self._synced.wait()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    #
+    # Lookups
+    #
+
+    def get(self, name: str):
+        return self.store.get(name)
+
+    def list(self) -> list:
+        return list(self.store.values())
+
+    def _lookup(self, index: str, value) -> list:
+        return [self.store[name] for name in self._indexes[index].get(str(value), ())]
+
+    def by_testrun(self, testrun_id: int) -> list:
+        return self._lookup('testrun_id', testrun_id)
+
+    def by_job_type(self, job_type: str) -> list:
+        return self._lookup('job_type', job_type)
+
+    def by_phase(self, phase: str) -> list:
+        return self._lookup('phase', phase)
+
+    #
+    # Store maintenance
+    #
+
+    def _keys(self, obj) -> dict[str, Optional[str]]:
+        labels = obj.metadata.labels or {}
+        return {'testrun_id': labels.get(TESTRUN_LABEL),
+                'job_type': labels.get(JOB_TYPE_LABEL),
+                'phase': self.phase_func(obj)}
+
+    def _remove(self, name: str):
+        self.store.pop(name, None)
+        for index, key in self._index_keys.pop(name, {}).items():
+            if key is not None:
+                names = self._indexes[index][key]
+                names.discard(name)
+                if not names:
+                    del self._indexes[index][key]
+
+    def _put(self, obj):
+        name = obj.metadata.name
+        self._remove(name)
+        self.store[name] = obj
+        keys = self._index_keys[name] = self._keys(obj)
+        for index, key in keys.items():
+            if key is not None:
+                self._indexes[index][key].add(name)
+
+    async def _dispatch(self, event_type: str, obj):
+        for handler in self._handlers:
+            try:
+                ret = handler(event_type, obj)
+                if inspect.isawaitable(ret):
+                    await ret
+            except Exception as ex:
+                logger.exception(f'Informer handler failed for {event_type} {obj.metadata.name}: {ex}')
+
+    async def _list(self):
+        resp = await self.list_func(self.namespace, label_selector=self.label_selector)
+        previous = set(self.store)
+        current = set()
+        for obj in resp.items:
+            name = obj.metadata.name
+            current.add(name)
+            old = self.store.get(name)
+            self._put(obj)
+            if not old:
+                await self._dispatch('ADDED', obj)
+            elif old.metadata.resource_version != obj.metadata.resource_version:
+                await self._dispatch('MODIFIED', obj)
+        for name in previous - current:
+            obj = self.store[name]
+            self._remove(name)
+            await self._dispatch('DELETED', obj)
+        self.resource_version = resp.metadata.resource_version
+        self._synced.set()
+
+    async def _watch(self):
+        from kubernetes_asyncio import watch
+
+        async with watch.Watch() as w:
+            async for event in w.stream(self.list_func, self.namespace, label_selector=self.label_selector,
+                                        resource_version=self.resource_version,
+                                        timeout_seconds=self.watch_timeout,
+                                        allow_watch_bookmarks=True):
+                event_type = event['type']
+                if event_type == 'BOOKMARK':
+                    self.resource_version = w.resource_version
+                    continue
+                obj = event['object']
+                if event_type == 'DELETED':
+                    self._remove(obj.metadata.name)
+                else:
+                    self._put(obj)
+                self.resource_version = obj.metadata.resource_version
+                await self._dispatch(event_type, obj)
+
+    async def _run(self):
+        from kubernetes_asyncio.client.rest import ApiException
+
+        attempt = 0
+        while True:
+            try:
+                if not self.resource_version:
+                    await self._list()
+                await self._watch()
+                # the watch timed out normally: resume it straight away
+                attempt = 0
+                continue
+            except asyncio.CancelledError:
+                raise
+            except ApiException as ex:
+                if ex.status == 410:
+                    # our resourceVersion is too old: start again with a fresh list
+                    logger.info('Informer resource version expired - relisting')
+                    self.resource_version = None
+                    continue
+                logger.warning(f'Informer watch failed: {ex}')
+            except Exception as ex:
+                logger.warning(f'Informer watch failed: {ex}')
+            await asyncio.sleep(min(30, 2 ** attempt))
+            attempt += 1
+
+
+def pod_informer(label_selector: str = None, namespace: str = None) -> Informer:
+    return Informer(get_core_api().list_namespaced_pod, pod_phase, namespace=namespace,
+                    label_selector=label_selector)
+
+
+def job_informer(label_selector: str = None, namespace: str = None) -> Informer:
+    return Informer(get_batch_api().list_namespaced_job, job_phase, namespace=namespace,
+                    label_selector=label_selector)
+
+
+#
+# Bulk server-side apply
+#
+
+FIELD_MANAGER = 'cykubed'
+APPLY_CONTENT_TYPE = 'application/apply-patch+yaml'
+RETRY_STATUSES = {409, 429}
+
+# kind -> API getter and the name of its namespaced patch method. Anything else is treated as a custom object
+APPLY_METHODS = {
+    'Job': (get_batch_api, 'patch_namespaced_job'),
+    'PersistentVolumeClaim': (get_core_api, 'patch_namespaced_persistent_volume_claim'),
+    'Pod': (get_core_api, 'patch_namespaced_pod'),
+    'ConfigMap': (get_core_api, 'patch_namespaced_config_map'),
+    'Secret': (get_core_api, 'patch_namespaced_secret'),
+    'Service': (get_core_api, 'patch_namespaced_service'),
+}
+
+
+class ApplyResult:
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.attempts = 0
+        self.obj = None
+        self.status_code: Optional[int] = None
+        self.error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return f'ApplyResult({self.kind}/{self.name}, ok={self.ok}, attempts={self.attempts})'
+
+
+def _apply(manifest: dict) -> Awaitable:
+    kind = manifest['kind']
+    metadata = manifest['metadata']
+    name = metadata['name']
+    namespace = metadata.get('namespace', NAMESPACE)
+    kwargs = dict(field_manager=FIELD_MANAGER, force=True, _content_type=APPLY_CONTENT_TYPE)
+    if kind in APPLY_METHODS:
+        get_api, method = APPLY_METHODS[kind]
+        return getattr(get_api(), method)(name, namespace, manifest, **kwargs)
+    # e.g VolumeSnapshot
+    group, version = manifest['apiVersion'].split('/')
+    return get_custom_api().patch_namespaced_custom_object(group, version, namespace, f'{kind.lower()}s', name,
+                                                           manifest, **kwargs)
+
+
+def _retry_delay(ex, attempt: int) -> float:
+    retry_after = (ex.headers or {}).get('Retry-After') if ex.status == 429 else None
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return random.uniform(0, min(10.0, 0.25 * 2 ** attempt))
+
+
+async def apply_manifests(manifests: list[dict], max_concurrency: int = 10,
+                          max_attempts: int = 5) -> list[ApplyResult]:
+    """
+    Create or update a batch of objects concurrently using server-side apply. Conflicts (409) and
+    throttling (429) are retried with backoff: any other error fails that object alone.
+
+    :param manifests: object manifests as dicts, each with apiVersion, kind and metadata.name
+    :param max_concurrency: maximum number of requests in flight
+    :param max_attempts: maximum attempts per object
+    :return: one ApplyResult per manifest, in the same order
+    """
+    from kubernetes_asyncio.client.rest import ApiException
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def apply_one(manifest: dict) -> ApplyResult:
+        result = ApplyResult(manifest['kind'], manifest['metadata']['name'])
+        while True:
+            result.attempts += 1
+            try:
+                async with semaphore:
+                    result.obj = await _apply(manifest)
+                result.status_code = 200
+                result.error = None
+                return result
+            except ApiException as ex:
+                result.status_code = ex.status
+                result.error = ex.reason
+                if ex.status not in RETRY_STATUSES or result.attempts >= max_attempts:
+                    logger.error(f'Failed to apply {result.kind} {result.name}: {ex.status} {ex.reason}')
+                    return result
+                await asyncio.sleep(_retry_delay(ex, result.attempts))
+            except Exception as ex:
+                result.error = str(ex)
+                logger.error(f'Failed to apply {result.kind} {result.name}: {ex}')
+                return result
+
+    return await asyncio.gather(*[apply_one(m) for m in manifests])
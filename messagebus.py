@@ -0,0 +1,163 @@
+import socket
+from typing import Awaitable, Callable, Optional, Type
+
+from loguru import logger
+from pydantic import ValidationError
+from redis import ResponseError
+from redis.asyncio import Redis as AsyncRedis
+
+from .exceptions import UnknownEventError
+from .redisutils import async_redis
+from .schemas import AgentEvent
+
+# stream entries are tagged with the class name so we can deserialize to the right model
+_event_classes: dict[str, Type[AgentEvent]] = {}
+
+
+def get_event_class(name: str) -> Type[AgentEvent]:
+    """
+    Find the AgentEvent subclass with the given name, including any defined outside this package
+    """
+    cls = _event_classes.get(name)
+    if not cls:
+        # a class we haven't seen yet: walk the subclasses again
+        todo = [AgentEvent]
+        while todo:
+            event_class = todo.pop()
+            _event_classes[event_class.__name__] = event_class
+            todo += event_class.__subclasses__()
+        cls = _event_classes.get(name)
+        if not cls:
+            raise UnknownEventError(f'Unknown event class {name}')
+    return cls
+
+
+def encode_event(event: AgentEvent) -> dict[str, str]:
+    return {'class': event.__class__.__name__, 'data': event.json()}
+
+
+def decode_event(fields: dict[str, str]) -> AgentEvent:
+    return get_event_class(fields.get('class')).parse_raw(fields['data'])
+
+
+class MessageBus:
+    """
+    Runner -> agent message queue built on a Redis Stream with a consumer group, giving at-least-once
+    delivery: messages stay pending against a consumer until they're acked, and messages left pending
+    by a consumer that's gone away (e.g a runner pod that was killed) can be reclaimed by another.
+
+    Messages that can't be decoded, or that have already been delivered max_deliveries times without being
+    acked (i.e the handler keeps failing), are moved to a dead-letter stream rather than retried forever.
+    """
+
+    def __init__(self, stream: str = 'messages-stream', group: str = 'agent', consumer: str = None,
+                 maxlen: int = 100000, max_deliveries: int = 5, dead_letter_stream: str = None,
+                 redis: AsyncRedis = None):
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or socket.gethostname()
+        self.maxlen = maxlen
+        self.max_deliveries = max_deliveries
+        self.dead_letter_stream = dead_letter_stream or f'{stream}:dead'
+        self._redis = redis
+
+    @property
+    def redis(self) -> AsyncRedis:
+        return self._redis or async_redis()
+
+    async def create_group(self):
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except ResponseError as ex:
+            if 'BUSYGROUP' not in str(ex):
+                raise
+
+    async def publish(self, event: AgentEvent) -> str:
+        """
+        Add an event to the stream, trimming it (approximately) to maxlen entries
+        """
+        return await self.redis.xadd(self.stream, encode_event(event), maxlen=self.maxlen, approximate=True)
+
+    async def dead_letter(self, msgid: str, fields: dict[str, str], reason: str):
+        """
+        Move a message to the dead-letter stream
+        """
+        logger.error(f'Moving message {msgid} to {self.dead_letter_stream}: {reason}')
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xadd(self.dead_letter_stream, {**fields, 'id': msgid, 'reason': reason},
+                      maxlen=self.maxlen, approximate=True)
+            pipe.xack(self.stream, self.group, msgid)
+            await pipe.execute()
+
+    async def _decode(self, messages: list[tuple[str, dict[str, str]]]) -> list[tuple[str, AgentEvent]]:
+        ret = []
+        for msgid, fields in messages:
+            try:
+                ret.append((msgid, decode_event(fields)))
+            except (UnknownEventError, ValidationError) as ex:
+                await self.dead_letter(msgid, fields, f'Failed to decode: {ex}')
+        return ret
+
+    async def read(self, count: int = 100, block: Optional[int] = 5000) -> list[tuple[str, AgentEvent]]:
+        """
+        Read up to count new events for this consumer, blocking for up to block milliseconds
+        """
+        resp = await self.redis.xreadgroup(self.group, self.consumer, {self.stream: '>'}, count=count,
+                                           block=block)
+        return await self._decode([(msgid, fields) for _, messages in resp or [] for msgid, fields in messages])
+
+    async def ack(self, *msgids: str) -> int:
+        if not msgids:
+            return 0
+        return await self.redis.xack(self.stream, self.group, *msgids)
+
+    async def _delivery_counts(self, msgids: list[str]) -> list[int]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for msgid in msgids:
+                pipe.xpending_range(self.stream, self.group, msgid, msgid, 1)
+            resp = await pipe.execute()
+        return [pending[0]['times_delivered'] if pending else 0 for pending in resp]
+
+    async def reclaim(self, min_idle_time: int = 60000, count: int = 100) -> list[tuple[str, AgentEvent]]:
+        """
+        Take ownership of any events that have been pending against another consumer for more than
+        min_idle_time milliseconds. Any that have now been delivered more than max_deliveries times are
+        dead-lettered instead
+        """
+        ret = []
+        start = '0-0'
+        while True:
+            resp = await self.redis.xautoclaim(self.stream, self.group, self.consumer, min_idle_time,
+                                               start_id=start, count=count)
+            start, messages = resp[0], resp[1]
+            # entries deleted by trimming come back as None
+            messages = [(msgid, fields) for msgid, fields in messages if fields]
+            if messages:
+                claimed = []
+                deliveries = await self._delivery_counts([msgid for msgid, _ in messages])
+                for (msgid, fields), delivered in zip(messages, deliveries):
+                    if delivered > self.max_deliveries:
+                        await self.dead_letter(msgid, fields, f'Failed after {delivered - 1} deliveries')
+                    else:
+                        claimed.append((msgid, fields))
+                ret += await self._decode(claimed)
+            if start in ('0-0', b'0-0'):
+                return ret
+
+    async def consume(self, handler: Callable[[AgentEvent], Awaitable], count: int = 100,
+                      block: Optional[int] = 5000, min_idle_time: int = 60000):
+        """
+        Process events forever, acking each once the handler has returned. Events whose handler raises
+        are left pending, and so will be picked up again by reclaim (up to max_deliveries times)
+        """
+        await self.create_group()
+        while True:
+            messages = await self.reclaim(min_idle_time, count) + await self.read(count, block)
+            done = []
+            for msgid, event in messages:
+                try:
+                    await handler(event)
+                    done.append(msgid)
+                except Exception as ex:
+                    logger.exception(f'Failed to handle {event.type} event {msgid}: {ex}')
+            await self.ack(*done)
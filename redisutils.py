@@ -1,10 +1,13 @@
+import asyncio
 import os
+import random
+from collections import defaultdict, OrderedDict
 from functools import cache
-from time import sleep
+from typing import Any, Callable, Optional, Type
+from time import sleep, monotonic
 
-import dns.resolver
 from loguru import logger
-from pydantic import BaseSettings
+from pydantic import BaseModel, BaseSettings
 from redis import Sentinel as SyncSentinel, Redis as SyncRedis, BusyLoadingError, ConnectionError, TimeoutError
 from redis.asyncio import Sentinel as AsyncSentinel, Redis as AsyncRedis
 from redis.asyncio.retry import Retry as AsyncRetry
@@ -21,11 +24,59 @@ class RedisSettings(BaseSettings):
     REDIS_PORT = 6379
     REDIS_SENTINEL_PREFIX: str = ''
     NAMESPACE = 'cykubed'
+    # exponential backoff (with full jitter) while waiting for the sentinel nodes
+    REDIS_BACKOFF_BASE: float = 0.5
+    REDIS_BACKOFF_MAX: float = 30
+    # start in degraded mode after this many seconds if a quorum of sentinels is visible. Set to -1 to
+    # always wait for all of them
+    REDIS_QUORUM_WAIT: float = 60
+    # connection pool
+    REDIS_MAX_CONNECTIONS: Optional[int] = None
+    REDIS_SOCKET_TIMEOUT: Optional[float] = None
+    REDIS_SOCKET_CONNECT_TIMEOUT: Optional[float] = None
+    REDIS_SOCKET_KEEPALIVE: bool = False
+    REDIS_HEALTH_CHECK_INTERVAL: int = 0
+
+    @property
+    def pool_kwargs(self) -> dict:
+        return dict(max_connections=self.REDIS_MAX_CONNECTIONS,
+                    socket_timeout=self.REDIS_SOCKET_TIMEOUT,
+                    socket_connect_timeout=self.REDIS_SOCKET_CONNECT_TIMEOUT,
+                    socket_keepalive=self.REDIS_SOCKET_KEEPALIVE,
+                    health_check_interval=self.REDIS_HEALTH_CHECK_INTERVAL)
+
+    @property
+    def sentinel_srv_name(self):
+        return f'{self.REDIS_SENTINEL_PREFIX}.{self.NAMESPACE}.svc.cluster.local'
+
+    @property
+    def use_sentinel(self) -> bool:
+        return self.K8 and os.path.exists('/var/run/secrets/kubernetes.io/serviceaccount/namespace') \
+            and self.REDIS_NODES > 1
 
     def get_redis_sentinel_hosts(self):
+        # dnspython is only needed inside K8, so don't import it until then
+        import dns.resolver
+        return list(set([(x.target.to_text(), 26379) for x in
+                         dns.resolver.resolve(self.sentinel_srv_name, 'SRV')]))
+
+    async def async_get_redis_sentinel_hosts(self):
+        import dns.asyncresolver
         return list(set([(x.target.to_text(), 26379) for x in
-                         dns.resolver.resolve(
-                             f'{self.REDIS_SENTINEL_PREFIX}.{self.NAMESPACE}.svc.cluster.local', 'SRV')]))
+                         await dns.asyncresolver.resolve(self.sentinel_srv_name, 'SRV')]))
+
+
+class RedisStartupStats(BaseModel):
+    """
+    How long we spent waiting for the Redis sentinels on startup
+    """
+    attempts: int = 0
+    wait_seconds: float = 0
+    hosts: int = 0
+    degraded: bool = False
+
+
+redis_startup_stats = RedisStartupStats()
 
 
 @cache
@@ -34,22 +85,303 @@ def sync_redis() -> SyncRedis:
 
 
 _async_redis = None
+_async_redis_lock = asyncio.Lock()
 
 
 def get_cached_async_redis() -> AsyncRedis:
     global _async_redis
     if not _async_redis:
+        settings = RedisSettings()
+        if settings.use_sentinel and in_event_loop():
+            logger.warning('Waiting for the Redis sentinels will block the event loop: await init_async_redis() '
+                           'on startup to avoid this')
         _async_redis = get_redis(AsyncSentinel, AsyncRedis, AsyncRetry)
     return _async_redis
 
 
+def in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
 def async_redis() -> AsyncRedis:
     """
-    Indirection to make this easier to mock
+    Indirection to make this easier to mock. Async services should await init_async_redis() on startup,
+    otherwise the first call will block the event loop while we wait for the sentinels
     """
     return get_cached_async_redis()
 
 
+async def init_async_redis() -> AsyncRedis:
+    """
+    Create the cached async client without blocking the event loop. Call this on startup, before
+    anything uses async_redis()
+    """
+    global _async_redis
+    if not _async_redis:
+        # make sure that concurrent callers share a single client
+        async with _async_redis_lock:
+            if not _async_redis:
+                _async_redis = await async_get_redis()
+    return _async_redis
+
+
+def get_pool_stats(redis=None) -> dict[str, Optional[int]]:
+    """
+    Connection pool utilization for the given client (defaults to the sync client)
+    """
+    pool = (redis or sync_redis()).connection_pool
+    return {'max': pool.max_connections,
+            'created': pool._created_connections,
+            'available': len(pool._available_connections),
+            'in_use': len(pool._in_use_connections)}
+
+
+class AsyncLogWriter:
+    """
+    Buffers log lines and appends them to Redis in batches, with a single pipelined APPEND per key,
+    rather than a round trip per line.
+
+    Lines are flushed every max_delay seconds, or as soon as max_lines are buffered. If Redis can't keep up
+    and more than max_pending lines are waiting then writers wait for a flush to complete. If a
+    flush fails the lines are kept and retried after retry_delay seconds, but while Redis is unavailable
+    any lines beyond max_pending are dropped (and counted) rather than buffered without limit.
+
+    Lines are appended as-is, so should include their trailing newline.
+    """
+    def __init__(self, redis: AsyncRedis = None, max_lines: int = 500, max_delay: float = 0.2,
+                 max_pending: int = 10000, retry_delay: float = 1):
+        self.redis = redis
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.pending = 0
+        self.dropped = 0
+        self._buffer: dict[str, list[str]] = defaultdict(list)
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._retry_at = 0
+        self._closing = False
+        self._task = None
+
+    def start(self):
+        if not self._task:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._closing or monotonic() >= self._retry_at:
+                await self.flush()
+
+    async def write(self, key: str, line: str):
+        if self.pending >= self.max_pending:
+            if monotonic() >= self._retry_at:
+                # backpressure: wait for Redis to catch up
+                await self.flush()
+            if self.pending >= self.max_pending:
+                # Redis is unavailable
+                self.dropped += 1
+                return
+        self._buffer[key].append(line)
+        self.pending += 1
+        if self.pending >= self.max_lines:
+            self._wakeup.set()
+
+    async def write_spec_log(self, trid: int, file: str, line: str):
+        await self.write(get_specfile_log_key(trid, file), line)
+
+    def _requeue(self, buffer: dict[str, list[str]], pending: int):
+        # put them back in front of anything written in the meantime, so we retry on the next flush
+        for key, lines in self._buffer.items():
+            buffer[key] += lines
+        self._buffer = buffer
+        self.pending += pending
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            buffer, self._buffer = self._buffer, defaultdict(list)
+            pending, self.pending = self.pending, 0
+            try:
+                pipe = (self.redis or async_redis()).pipeline(transaction=False)
+                for key, lines in buffer.items():
+                    pipe.append(key, ''.join(lines))
+                await pipe.execute()
+                self._retry_at = 0
+            except asyncio.CancelledError:
+                self._requeue(buffer, pending)
+                raise
+            except Exception as ex:
+                logger.error(f'Failed to flush {pending} log lines ({self.dropped} dropped so far): {ex}')
+                self._requeue(buffer, pending)
+                self._retry_at = monotonic() + self.retry_delay
+
+    async def close(self):
+        """
+        Stop the background flusher and flush anything that's left
+        """
+        if self._task:
+            # let the flusher finish rather than cancel it, so we don't interrupt a flush
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+class TrackingCache:
+    """
+    Opt-in client-side cache for hot, small string keys, kept coherent with Redis server-assisted
+    invalidation (CLIENT TRACKING in broadcast mode). A dedicated connection subscribes to invalidations for
+    all keys under the given prefixes, and we keep a bounded LRU of decoded values.
+
+    If the invalidation connection drops (e.g on Sentinel failover) we empty the cache and bypass it until
+    tracking has been re-established on the new master, so we never serve a value we might have missed an
+    invalidation for.
+
+    Cached values are shared between callers, so treat them as read-only.
+    """
+    INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+    def __init__(self, prefixes: list[str], maxsize: int = 10000, redis: AsyncRedis = None,
+                 ping_interval: float = 30):
+        self.prefixes = prefixes
+        self.maxsize = maxsize
+        self.ping_interval = ping_interval
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._redis = redis
+        self._cache: OrderedDict[str, Any] = OrderedDict()
+        # bumped on every invalidation, so we don't cache a value fetched while an invalidation came in
+        self._generation = 0
+        self._tracking = False
+        self._task = None
+
+    @property
+    def redis(self) -> AsyncRedis:
+        return self._redis or async_redis()
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._reset()
+
+    def _reset(self):
+        self._tracking = False
+        self._generation += 1
+        self._cache.clear()
+
+    def _invalidate(self, keys: Optional[list[str]]):
+        self._generation += 1
+        if keys is None:
+            # flushdb / flushall
+            self.invalidations += len(self._cache)
+            self._cache.clear()
+            return
+        for key in keys:
+            if self._cache.pop(key, None) is not None:
+                self.invalidations += 1
+
+    async def _run(self):
+        attempt = 0
+        while True:
+            pool = conn = None
+            try:
+                pool = self.redis.connection_pool
+                conn = await pool.get_connection('_')
+                await conn.send_command('CLIENT', 'ID')
+                client_id = await conn.read_response()
+                args = ['CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id, 'BCAST']
+                for prefix in self.prefixes:
+                    args += ['PREFIX', prefix]
+                await conn.send_command(*args)
+                await conn.read_response()
+                await conn.send_command('SUBSCRIBE', self.INVALIDATE_CHANNEL)
+                await conn.read_response()
+                self._tracking = True
+                attempt = 0
+                logger.info(f'Client-side caching enabled for prefixes {self.prefixes}')
+                unanswered_pings = 0
+                while True:
+                    resp = await conn.read_response(timeout=self.ping_interval)
+                    if resp is None:
+                        # timed out: a half-open connection (e.g after a failover) will never deliver
+                        # invalidations, so check it's still alive
+                        if unanswered_pings:
+                            raise ConnectionError('No response from Redis')
+                        unanswered_pings += 1
+                        await conn.send_command('PING')
+                        continue
+                    unanswered_pings = 0
+                    if resp[0] == 'message':
+                        self._invalidate(resp[2])
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.warning(f'Client-side cache invalidation connection failed: {ex}')
+            finally:
+                self._reset()
+                if conn:
+                    await conn.disconnect()
+                    await pool.release(conn)
+            await asyncio.sleep(random.uniform(0, min(30, 0.5 * 2 ** attempt)))
+            attempt += 1
+
+    async def get(self, key: str, decode: Callable[[str], Any] = None) -> Any:
+        """
+        Return the (decoded) value for key, from the local cache if possible
+        """
+        if self._tracking and key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+        generation = self._generation
+        value = await self.redis.get(key)
+        if value is not None and decode:
+            value = decode(value)
+        if self._tracking and generation == self._generation and value is not None \
+                and any(key.startswith(prefix) for prefix in self.prefixes):
+            self._cache[key] = value
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return value
+
+    async def get_model(self, key: str, model_class: Type[BaseModel]) -> Optional[BaseModel]:
+        return await self.get(key, model_class.parse_raw)
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'invalidations': self.invalidations,
+                'size': len(self._cache),
+                'tracking': self._tracking}
+
+
 def ping_redis() -> bool:
     try:
         if sync_redis().ping():
@@ -59,11 +391,81 @@ def ping_redis() -> bool:
         return False
 
 
-def get_redis(sentinel_class, redis_class, retry_class=None):
+class SentinelWaiter:
+    """
+    Tracks our progress waiting for the sentinel SRV records to appear
+    """
+    def __init__(self, settings: RedisSettings):
+        self.settings = settings
+        self.started = monotonic()
+        self.attempt = 0
+        self.quorum = settings.REDIS_NODES // 2 + 1
+
+    def ready(self, hosts: list) -> bool:
+        self.attempt += 1
+        elapsed = monotonic() - self.started
+        degraded = len(hosts) < self.settings.REDIS_NODES
+        if degraded:
+            if len(hosts) < self.quorum or self.settings.REDIS_QUORUM_WAIT < 0 \
+                    or elapsed < self.settings.REDIS_QUORUM_WAIT:
+                logger.info(f'Can only see {len(hosts)} Redis hosts - waiting...')
+                return False
+            logger.warning(f'Only {len(hosts)} of {self.settings.REDIS_NODES} Redis hosts visible: '
+                           f'starting in degraded mode')
+
+        redis_startup_stats.attempts = self.attempt
+        redis_startup_stats.wait_seconds = elapsed
+        redis_startup_stats.hosts = len(hosts)
+        redis_startup_stats.degraded = degraded
+        logger.info(f'Found {len(hosts)} Redis hosts after {elapsed:.1f}s')
+        return True
+
+    def delay(self) -> float:
+        return random.uniform(0, min(self.settings.REDIS_BACKOFF_MAX,
+                                     self.settings.REDIS_BACKOFF_BASE * 2 ** self.attempt))
+
+
+def wait_for_sentinel_hosts(settings: RedisSettings) -> list:
+    waiter = SentinelWaiter(settings)
+    while True:
+        try:
+            hosts = settings.get_redis_sentinel_hosts()
+        except Exception:
+            hosts = []
+        if waiter.ready(hosts):
+            return hosts
+        sleep(waiter.delay())
+
+
+async def async_wait_for_sentinel_hosts(settings: RedisSettings) -> list:
+    waiter = SentinelWaiter(settings)
+    while True:
+        try:
+            hosts = await settings.async_get_redis_sentinel_hosts()
+        except Exception:
+            hosts = []
+        if waiter.ready(hosts):
+            return hosts
+        await asyncio.sleep(waiter.delay())
+
+
+async def async_get_redis() -> AsyncRedis:
+    """
+    As get_redis, but waits for the sentinels without blocking the event loop
+    """
+    settings = RedisSettings()
+    hosts = None
+    if settings.use_sentinel:
+        hosts = await async_wait_for_sentinel_hosts(settings)
+    return get_redis(AsyncSentinel, AsyncRedis, AsyncRetry, hosts=hosts)
+
+
+def get_redis(sentinel_class, redis_class, retry_class=None, hosts=None):
     """
     We use Redis as the glue as the central "database", and the glue that binds runners to agents via the
     "messages" queue. On a clean install it's Redis we're waiting for as it takes a while to spin up the
-    nodes, so we don't start until we can contact all of them.
+    nodes, so we don't start until we can contact all of them (or at least a quorum, after
+    REDIS_QUORUM_WAIT seconds).
 
     The choice of a distributed Redis is because the K8 cluster may decide to move nodes around, particularly
     when scaling up for a large parallel Job. While we _could_ get away with a single Redis standalone deploy,
@@ -72,6 +474,7 @@ def get_redis(sentinel_class, redis_class, retry_class=None):
     :param sentinel_class:
     :param redis_class:
     :param retry_class:
+    :param hosts: sentinel hosts, if we've already found them
     """
     if redis_class:
         retry = retry_class(ConstantBackoff(2), 5)
@@ -80,22 +483,11 @@ def get_redis(sentinel_class, redis_class, retry_class=None):
 
     settings = RedisSettings()
 
-    if settings.K8 and os.path.exists('/var/run/secrets/kubernetes.io/serviceaccount/namespace') \
-            and settings.REDIS_NODES > 1:
+    if settings.use_sentinel:
         logger.info('Assuming replicated Redis with Sentinel')
         # we're running inside K8
-        hosts = []
-        while len(hosts) < settings.REDIS_NODES:
-            try:
-                hosts = settings.get_redis_sentinel_hosts()
-                if len(hosts) == settings.REDIS_NODES:
-                    break
-                logger.info(f'Can only see {len(hosts)} Redis hosts - waiting...')
-                sleep(30)
-            except:
-                logger.info(f'No Redis hosts visible - waiting...')
-                sleep(30)
-                hosts = []
+        if hosts is None:
+            hosts = wait_for_sentinel_hosts(settings)
 
         retry = retry_class(ConstantBackoff(10), 30)
         sentinel = sentinel_class(hosts, sentinel_kwargs=dict(password=settings.REDIS_PASSWORD,
@@ -110,7 +502,8 @@ def get_redis(sentinel_class, redis_class, retry_class=None):
                                    decode_responses=True, db=settings.REDIS_DB,
                                    retry_on_error=[BusyLoadingError, ConnectionError,
                                                    ConnectionRefusedError,
-                                                   TimeoutError])
+                                                   TimeoutError],
+                                   **settings.pool_kwargs)
     else:
         logger.info('Assuming standalone Redis')
         return redis_class(host=settings.REDIS_HOST, db=settings.REDIS_DB,
@@ -119,7 +512,8 @@ def get_redis(sentinel_class, redis_class, retry_class=None):
                            port=settings.REDIS_PORT,
                            retry=retry, retry_on_error=[BusyLoadingError, ConnectionError,
                                                         ConnectionRefusedError,
-                                                        TimeoutError])
+                                                        TimeoutError],
+                           **settings.pool_kwargs)
 
 
 def get_specfile_log_key(trid: int, file: str):
@@ -0,0 +1,125 @@
+import heapq
+import statistics
+from typing import Iterable, Optional
+
+from pydantic import BaseModel
+from redis.asyncio import Redis as AsyncRedis
+
+from .redisutils import async_redis
+from .schemas import SpecFile
+
+# predicted duration (in seconds) for a spec if we have no history at all
+DEFAULT_SPEC_DURATION = 60
+
+
+def get_spec_queue_key(trid: int):
+    return f'testrun:{trid}:specqueue'
+
+
+def get_spec_predictions_key(trid: int):
+    return f'testrun:{trid}:specqueue:predicted'
+
+
+class MakespanReport(BaseModel):
+    """
+    Predicted vs actual wall time (in seconds) for the runner job
+    """
+    parallelism: int
+    predicted: int
+    actual: Optional[int]
+
+
+def predict_durations(specs: Iterable[str], history: dict[str, Optional[int]],
+                      default: int = DEFAULT_SPEC_DURATION) -> dict[str, int]:
+    """
+    Predicted duration for each spec, from its previous duration. New specs are assumed to take the
+    median of the known specs
+    """
+    known = [d for d in history.values() if d]
+    fallback = int(statistics.median(known)) if known else default
+    return {spec: history.get(spec) or fallback for spec in specs}
+
+
+def order_specs(durations: dict[str, int]) -> list[str]:
+    """
+    Longest first
+    """
+    return sorted(durations, key=lambda spec: durations[spec], reverse=True)
+
+
+def predict_makespan(durations: Iterable[int], parallelism: int) -> int:
+    """
+    Simulate pods pulling specs longest-first from a shared queue, and return the time at which the last
+    one finishes
+    """
+    pods = [0] * max(parallelism, 1)
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(pods, pods[0] + duration)
+    return max(pods)
+
+
+def actual_makespan(files: Iterable[SpecFile]) -> Optional[int]:
+    started = [f.started for f in files if f.started]
+    finished = [f.finished for f in files if f.finished]
+    if not started or not finished:
+        return None
+    return int((max(finished) - min(started)).total_seconds())
+
+
+def makespan_report(durations: dict[str, int], parallelism: int, files: Iterable[SpecFile]) -> MakespanReport:
+    return MakespanReport(parallelism=parallelism,
+                          predicted=predict_makespan(durations.values(), parallelism),
+                          actual=actual_makespan(files))
+
+
+class SpecScheduler:
+    """
+    Longest-processing-time-first spec queue for the runner pods.
+
+    Specs are held in a sorted set scored by predicted duration, and each runner pod pops the longest
+    remaining spec when it asks for more work. As every pod pulls from the same queue an idle pod
+    always steals the biggest outstanding piece of work, so the long specs no longer end up at the tail
+    of the job. Specs returned by a pod (e.g a spot pod being terminated) go back into the queue with
+    their original prediction.
+    """
+
+    def __init__(self, redis: AsyncRedis = None):
+        self._redis = redis
+
+    @property
+    def redis(self) -> AsyncRedis:
+        return self._redis or async_redis()
+
+    async def enqueue(self, trid: int, specs: Iterable[str], history: dict[str, Optional[int]]) -> dict[str, int]:
+        """
+        Queue the specs for a test run, given the previous duration of each spec (if known).
+        Returns the predicted durations
+        """
+        durations = predict_durations(specs, history)
+        if durations:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.delete(get_spec_queue_key(trid), get_spec_predictions_key(trid))
+                pipe.zadd(get_spec_queue_key(trid), durations)
+                pipe.hset(get_spec_predictions_key(trid), mapping=durations)
+                await pipe.execute()
+        return durations
+
+    async def next_spec(self, trid: int) -> Optional[str]:
+        """
+        Pop the longest remaining spec, or None if there are none left
+        """
+        resp = await self.redis.zpopmax(get_spec_queue_key(trid))
+        return resp[0][0] if resp else None
+
+    async def return_spec(self, trid: int, file: str):
+        predicted = await self.redis.hget(get_spec_predictions_key(trid), file)
+        await self.redis.zadd(get_spec_queue_key(trid), {file: int(predicted or DEFAULT_SPEC_DURATION)})
+
+    async def remaining(self, trid: int) -> int:
+        return await self.redis.zcard(get_spec_queue_key(trid))
+
+    async def get_predictions(self, trid: int) -> dict[str, int]:
+        return {k: int(v) for k, v in (await self.redis.hgetall(get_spec_predictions_key(trid))).items()}
+
+    async def delete(self, trid: int):
+        await self.redis.delete(get_spec_queue_key(trid), get_spec_predictions_key(trid))
@@ -1,14 +1,16 @@
+import bisect
 import uuid
 from datetime import date, datetime
-from typing import Optional
+from typing import Any, Optional
 
-from pydantic import BaseModel, validator, NonNegativeInt, AnyHttpUrl, root_validator
+from pydantic import BaseModel, validator, NonNegativeInt, AnyHttpUrl, root_validator, PrivateAttr, ValidationError
 from pydantic.fields import Field
 
 from .enums import (PlatformEnum, TestRunStatus, TestRunStatusFilter,
                     TestResultStatus, AppWebSocketActions, LogLevel, AgentEventType, \
                     SpecFileStatus, AppFramework, KubernetesPlatform, PlatformType, JobType, ErrorType, Currency, \
                     OrganisationDeleteReason, OnboardingState, TestFramework)
+from .utils import fast_json_dumps_bytes, fast_json_loads
 
 
 class DummyTestRunStatusFilter(BaseModel):
@@ -361,43 +363,150 @@ class SpecTest(BaseModel):
     results: list[TestResult]
 
 
+def _count_spec_test(test: SpecTest) -> tuple[int, int, int]:
+    """
+    Returns the (total, flakes, failed) contribution of a single test
+    """
+    all_browsers = {r.browser for r in test.results}
+    browsers = {r.browser for r in test.results if r.status == TestResultStatus.failed
+                or (r.status == TestResultStatus.passed and r.retry > 0)}
+    if test.status == TestResultStatus.failed:
+        return len(all_browsers), 0, len(browsers)
+    elif test.status == TestResultStatus.flakey:
+        return len(all_browsers), len(browsers), 0
+    return len(all_browsers), 0, 0
+
+
 class SpecTests(BaseModel):
     tests: list[SpecTest] = []
     video: Optional[str]
     timeout: Optional[bool] = False
 
+    # aggregates, computed on first read and then kept up to date by merge. They're tied to the identity
+    # and length of the tests list, so replacing or appending to it directly is noticed: anything else
+    # that modifies the tests in place (e.g changing a title) should call recount
+    _cache_key: Optional[tuple[int, int]] = PrivateAttr(None)
+    _counts: Optional[list[int]] = PrivateAttr(None)
+    # results of each status in tree order, along with the index of the test each one belongs to, so that
+    # results merged into an earlier test can be inserted in the right place
+    _results_by_status: Optional[dict[TestResultStatus, list[TestResult]]] = PrivateAttr(None)
+    _result_positions: Optional[dict[TestResultStatus, list[int]]] = PrivateAttr(None)
+    # test index on (context, title), as titles can repeat across describe blocks
+    _index: Optional[dict[tuple[Optional[str], str], int]] = PrivateAttr(None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name == 'tests':
+            self.recount()
+
+    def copy(self, **kwargs):
+        spectests = super().copy(**kwargs)
+        spectests.recount()
+        return spectests
+
+    def recount(self):
+        """
+        Drop the cached aggregates, so they're rebuilt on the next read
+        """
+        self._cache_key = None
+
+    def _check_cache(self):
+        key = (id(self.tests), len(self.tests))
+        if self._cache_key != key:
+            self._cache_key = key
+            self._counts = None
+            self._results_by_status = None
+            self._result_positions = None
+            self._index = None
+
+    def _add_counts(self, test: SpecTest, sign: int = 1):
+        for i, value in enumerate(_count_spec_test(test)):
+            self._counts[i] += sign * value
+
+    def _add_results(self, test_idx: int, results: list[TestResult]):
+        for result in results:
+            positions = self._result_positions.setdefault(result.status, [])
+            # after the results from this test and the ones before it: for the last test that's an append
+            i = bisect.bisect_right(positions, test_idx)
+            positions.insert(i, test_idx)
+            self._results_by_status.setdefault(result.status, []).insert(i, result)
+
     def get_filtered_test_results(self, status: TestResultStatus):
-        ret = []
-        for test in self.tests:
-            ret += [result for result in test.results if result.status == status]
-        return ret
+        self._check_cache()
+        if self._results_by_status is None:
+            self._results_by_status = {}
+            self._result_positions = {}
+            for idx, test in enumerate(self.tests):
+                self._add_results(idx, test.results)
+        return list(self._results_by_status.get(status, []))
 
     def count(self):
-        failed = 0
-        flakes = 0
-        total = 0
-        for test in self.tests:
-            all_browsers = {r.browser for r in test.results}
-            total += len(all_browsers)
-            browsers = {r.browser for r in test.results if r.status == TestResultStatus.failed
-                        or (r.status == TestResultStatus.passed and r.retry > 0)}
-            if test.status == TestResultStatus.failed:
-                failed += len(browsers)
-            elif test.status == TestResultStatus.flakey:
-                flakes += len(browsers)
-        return total, flakes, failed
+        self._check_cache()
+        if self._counts is None:
+            self._counts = [0, 0, 0]
+            for test in self.tests:
+                self._add_counts(test)
+        return tuple(self._counts)
+
+    def _append_test(self, test: SpecTest):
+        idx = len(self.tests)
+        self.tests.append(test)
+        if self._index is not None:
+            self._index.setdefault((test.context, test.title), idx)
+        if self._counts is not None:
+            self._add_counts(test)
+        if self._results_by_status is not None:
+            self._add_results(idx, test.results)
+
+    def _update_test(self, idx: int, status: TestResultStatus, results: list[TestResult]):
+        test = self.tests[idx]
+        if self._counts is not None:
+            self._add_counts(test, -1)
+        test.status = status
+        # the results list may be shared with another test (e.g one we copied), so don't extend it in place
+        test.results = test.results + results
+        if self._counts is not None:
+            self._add_counts(test)
+        if self._results_by_status is not None:
+            self._add_results(idx, results)
 
     def merge(self, spectests):
+        # the aggregates are only kept up to date if we already have them
+        self._check_cache()
+        if self._index is None:
+            self._index = {}
+            for idx, existing_test in enumerate(self.tests):
+                self._index.setdefault((existing_test.context, existing_test.title), idx)
+
         for test in spectests.tests:
-            existing_test = [x for x in self.tests if x.title == test.title][0]
+            idx = self._index.get((test.context, test.title))
+            if idx is None:
+                # not in the original run: add a copy, so merging into it later doesn't modify the caller's test
+                self._append_test(test.copy())
+                continue
+            status = self.tests[idx].status
             if test.status != TestResultStatus.passed:
                 if test.status == TestResultStatus.failed:
-                    existing_test.status = TestResultStatus.failed
+                    status = TestResultStatus.failed
                 else:
                     # must be flakey
-                    if existing_test.status != TestResultStatus.failed:
-                        existing_test.status = TestResultStatus.flakey
-            existing_test.results += test.results
+                    if status != TestResultStatus.failed:
+                        status = TestResultStatus.flakey
+            self._update_test(idx, status, test.results)
+
+        self._cache_key = (id(self.tests), len(self.tests))
+
+    def apply_delta(self, delta: 'SpecTestsDelta'):
+        """
+        Add the new tests, results and statuses from a delta in-place. Changed fields are applied by
+        apply_spectests_delta
+        """
+        self._check_cache()
+        for idx in delta.results.keys() | delta.statuses.keys():
+            self._update_test(idx, delta.statuses.get(idx, self.tests[idx].status), delta.results.get(idx, []))
+        for test in delta.tests:
+            self._append_test(test.copy())
+        self._cache_key = (id(self.tests), len(self.tests))
 
 
 class ResultSummary(BaseModel):
@@ -846,6 +955,7 @@ class TestRunDetail(TestRunCommon):
     project: Project
     files: Optional[list[SpecFile]]
     jobstats: Optional[TestRunJobStats] = None
+    version: Optional[int] = Field(description="Incremented on each change, so deltas can be applied safely")
 
     @validator('files', pre=True)
     def _iter_to_list(cls, v):
@@ -861,6 +971,142 @@ class TestRunDetail(TestRunCommon):
         orm_mode = True
 
 
+class SpecTestsDelta(BaseModel):
+    """
+    Changes to a SpecTests: new tests, plus new results and status changes keyed on test index, and any
+    changed fields (video, timeout)
+    """
+    changes: dict[str, Any] = {}
+    tests: list[SpecTest] = []
+    results: dict[int, list[TestResult]] = {}
+    statuses: dict[int, TestResultStatus] = {}
+
+
+class SpecFileDelta(BaseModel):
+    file: str
+    changes: dict[str, Any] = {}
+    result: Optional[SpecTestsDelta]
+
+
+class TestRunDetailDelta(BaseModel):
+    """
+    Structural diff between two versions of a TestRunDetail
+    """
+    testrun_id: int
+    base_version: Optional[int]
+    version: Optional[int]
+    changes: dict[str, Any] = {}
+    files: list[SpecFileDelta] = []
+    removed_files: list[str] = []
+
+
+def _changed_fields(old: BaseModel, new: BaseModel, exclude: set[str]) -> dict[str, Any]:
+    return {name: getattr(new, name) for name in new.__fields__
+            if name not in exclude and getattr(old, name) != getattr(new, name)}
+
+
+def _validate_changes(model_class, changes: dict[str, Any]) -> dict[str, Any]:
+    ret = {}
+    for name, value in changes.items():
+        field = model_class.__fields__[name]
+        ret[name], errors = field.validate(value, {}, loc=name, cls=model_class)
+        if errors:
+            raise ValidationError([errors], model_class)
+    return ret
+
+
+def diff_spectests(old: SpecTests, new: SpecTests) -> Optional[SpecTestsDelta]:
+    """
+    Diff two SpecTests, assuming that new was built from old by merging (so tests and results are only
+    ever appended). Returns None if that's not the case (e.g an existing result was modified), and the
+    whole result should be sent instead
+    """
+    if len(new.tests) < len(old.tests):
+        return None
+    delta = SpecTestsDelta(changes=_changed_fields(old, new, {'tests'}), tests=new.tests[len(old.tests):])
+    for i, (old_test, new_test) in enumerate(zip(old.tests, new.tests)):
+        if (old_test.title != new_test.title or old_test.context != new_test.context
+                or old_test.line != new_test.line):
+            return None
+        num_results = len(old_test.results)
+        if new_test.results[:num_results] != old_test.results:
+            return None
+        if len(new_test.results) > num_results:
+            delta.results[i] = new_test.results[num_results:]
+        if new_test.status != old_test.status:
+            delta.statuses[i] = new_test.status
+    return delta
+
+
+def diff_testrun_detail(old: TestRunDetail, new: TestRunDetail) -> TestRunDetailDelta:
+    """
+    Compute the changes needed to turn old into new. Note that old and new must be distinct objects,
+    not the same instance modified in place
+    """
+    delta = TestRunDetailDelta(testrun_id=new.id, base_version=old.version, version=new.version,
+                               changes=_changed_fields(old, new, {'files', 'version'}))
+    old_files = {f.file: f for f in old.files or []}
+    new_names = set()
+    for new_file in new.files or []:
+        new_names.add(new_file.file)
+        old_file = old_files.get(new_file.file)
+        if not old_file:
+            delta.files.append(SpecFileDelta(file=new_file.file,
+                                             changes=_changed_fields(SpecFile(file=new_file.file), new_file,
+                                                                     set())))
+            continue
+        changes = _changed_fields(old_file, new_file, {'result'})
+        result_delta = None
+        if old_file.result != new_file.result:
+            if old_file.result and new_file.result:
+                result_delta = diff_spectests(old_file.result, new_file.result)
+            if result_delta is None:
+                changes['result'] = new_file.result
+        if changes or result_delta is not None:
+            delta.files.append(SpecFileDelta(file=new_file.file, changes=changes, result=result_delta))
+    delta.removed_files = [name for name in old_files if name not in new_names]
+    return delta
+
+
+def apply_spectests_delta(spectests: SpecTests, delta: SpecTestsDelta):
+    for name, value in _validate_changes(SpecTests, delta.changes).items():
+        setattr(spectests, name, value)
+    spectests.apply_delta(delta)
+
+
+def apply_testrun_detail_delta(detail: TestRunDetail, delta: TestRunDetailDelta) -> TestRunDetail:
+    """
+    Apply a delta in-place
+    """
+    if delta.base_version is not None and detail.version != delta.base_version:
+        raise ValueError(f'Delta is against version {delta.base_version} but we have version {detail.version}')
+
+    for name, value in _validate_changes(TestRunDetail, delta.changes).items():
+        setattr(detail, name, value)
+
+    files = detail.files = detail.files or []
+    index = {f.file: i for i, f in enumerate(files)}
+    for file_delta in delta.files:
+        changes = _validate_changes(SpecFile, file_delta.changes)
+        i = index.get(file_delta.file)
+        if i is None:
+            index[file_delta.file] = len(files)
+            files.append(SpecFile(file=file_delta.file, **changes))
+            continue
+        spec = files[i]
+        for name, value in changes.items():
+            setattr(spec, name, value)
+        if file_delta.result:
+            apply_spectests_delta(spec.result, file_delta.result)
+
+    if delta.removed_files:
+        removed = set(delta.removed_files)
+        detail.files = [f for f in files if f.file not in removed]
+
+    detail.version = delta.version
+    return detail
+
+
 class NewAgentModel(BaseModel):
     organisation_id: int
 
@@ -932,7 +1178,23 @@ class PodStatus(BaseModel):
 # App messages
 #
 
-class BaseAppSocketMessage(BaseModel):
+class FastJsonModel(BaseModel):
+    """
+    Base for all websocket messages. json() is unchanged, but json_bytes() gives a faster encoding using
+    orjson (if installed), and we parse with orjson
+    """
+    class Config:
+        json_loads = fast_json_loads
+
+    def json_bytes(self, **kwargs) -> bytes:
+        """
+        Compact UTF-8 encoded JSON, ready to send down a socket. This is equivalent to json(), but the
+        formatting differs (see fast_json_dumps_bytes)
+        """
+        return fast_json_dumps_bytes(self.dict(**kwargs), default=self.__json_encoder__)
+
+
+class BaseAppSocketMessage(FastJsonModel):
     action: AppWebSocketActions
 
     def __str__(self):
@@ -955,6 +1217,11 @@ class TestRunDetailUpdateMessage(BaseAppSocketMessage):
     testrun: TestRunDetail
 
 
+class TestRunDetailDeltaMessage(BaseAppSocketMessage):
+    action: AppWebSocketActions = AppWebSocketActions.testrun_delta
+    delta: TestRunDetailDelta
+
+
 class SubscriptionUpdatedMessage(BaseAppSocketMessage):
     action: AppWebSocketActions = AppWebSocketActions.subscription_updated
     subscription: Subscription
@@ -1048,7 +1315,7 @@ class AgentSpecStarted(BaseModel):
 # Agent websocket
 #
 
-class AgentEvent(BaseModel):
+class AgentEvent(FastJsonModel):
     type: AgentEventType
     duration: Optional[int]
     testrun_id: int
@@ -0,0 +1,144 @@
+import math
+from datetime import datetime
+from typing import Iterable, Optional
+
+from pydantic import BaseModel
+from redis.asyncio import Redis as AsyncRedis
+
+from .redisutils import async_redis
+from .schemas import AgentSpecCompleted
+
+# number of recent durations we keep per spec
+WINDOW_SIZE = 20
+# weight given to the latest run in the exponentially-decayed flake and failure rates
+RATE_DECAY = 0.1
+
+
+# Atomic read-update-write of the stats for a single spec, mirroring SpecDurationStats.add. Running it
+# server-side means writes only contend with other writes to the same spec (and never need retrying).
+# ARGV: file, duration, flakey (0/1), failed (0/1), window, decay
+ADD_DURATION_SCRIPT = """
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+local stats = value and cjson.decode(value) or {runs = 0, durations = {}, flake_rate = 0, failure_rate = 0}
+local flakey = tonumber(ARGV[3])
+local failed = tonumber(ARGV[4])
+local decay = tonumber(ARGV[6])
+
+local durations = stats['durations']
+table.insert(durations, tonumber(ARGV[2]))
+while #durations > tonumber(ARGV[5]) do
+    table.remove(durations, 1)
+end
+
+local ordered = {}
+for i, duration in ipairs(durations) do
+    ordered[i] = duration
+end
+table.sort(ordered)
+stats['p50'] = ordered[math.max(math.ceil(50 / 100 * #ordered), 1)]
+stats['p90'] = ordered[math.max(math.ceil(90 / 100 * #ordered), 1)]
+
+-- the first run sets the rate outright, rather than being decayed towards from zero
+local weight = decay
+if stats['runs'] == 0 then
+    weight = 1
+end
+stats['flake_rate'] = stats['flake_rate'] + weight * (flakey - stats['flake_rate'])
+stats['failure_rate'] = stats['failure_rate'] + weight * (failed - stats['failure_rate'])
+stats['runs'] = stats['runs'] + 1
+
+value = cjson.encode(stats)
+redis.call('HSET', KEYS[1], ARGV[1], value)
+return value
+"""
+
+
+def get_spec_history_key(project_id: int):
+    return f'project:{project_id}:spechistory'
+
+
+def percentile(values: list[int], p: float) -> int:
+    """
+    Nearest-rank percentile
+    """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+class SpecDurationStats(BaseModel):
+    """
+    Rolling statistics for a single spec file. Durations are in seconds
+    """
+    runs: int = 0
+    durations: list[int] = []
+    p50: Optional[int]
+    p90: Optional[int]
+    flake_rate: float = 0
+    failure_rate: float = 0
+
+    def add(self, duration: int, flakey: bool, failed: bool, window: int = WINDOW_SIZE, decay: float = RATE_DECAY):
+        # keep in step with ADD_DURATION_SCRIPT
+        self.durations = (self.durations + [duration])[-window:]
+        self.p50 = percentile(self.durations, 50)
+        self.p90 = percentile(self.durations, 90)
+        # the first run sets the rate outright, rather than being decayed towards from zero
+        weight = 1 if not self.runs else decay
+        self.flake_rate += weight * (flakey - self.flake_rate)
+        self.failure_rate += weight * (failed - self.failure_rate)
+        self.runs += 1
+
+
+class SpecHistoryStore:
+    """
+    Per-project spec duration history, held in a Redis hash keyed on spec file so any spec can be read in
+    O(1). Memory is bounded by keeping only the last WINDOW_SIZE durations, and exponentially decaying the
+    flake and failure rates.
+    """
+
+    def __init__(self, redis: AsyncRedis = None, window: int = WINDOW_SIZE, decay: float = RATE_DECAY):
+        self._redis = redis
+        self.window = window
+        self.decay = decay
+        self._add_duration = None
+
+    @property
+    def redis(self) -> AsyncRedis:
+        return self._redis or async_redis()
+
+    async def record(self, project_id: int, completed: AgentSpecCompleted, started: datetime) -> SpecDurationStats:
+        """
+        Update the history for a completed spec
+        """
+        duration = max(int((completed.finished - started).total_seconds()), 0)
+        _, flakes, failed = completed.result.count()
+        return await self.add(project_id, completed.file, duration, flakes > 0,
+                              failed > 0 or bool(completed.result.timeout))
+
+    async def add(self, project_id: int, file: str, duration: int, flakey: bool, failed: bool) -> SpecDurationStats:
+        if not self._add_duration:
+            self._add_duration = self.redis.register_script(ADD_DURATION_SCRIPT)
+        value = await self._add_duration(keys=[get_spec_history_key(project_id)],
+                                         args=[file, duration, int(flakey), int(failed), self.window, self.decay])
+        return SpecDurationStats.parse_raw(value)
+
+    async def get(self, project_id: int, file: str) -> Optional[SpecDurationStats]:
+        value = await self.redis.hget(get_spec_history_key(project_id), file)
+        return SpecDurationStats.parse_raw(value) if value else None
+
+    async def get_many(self, project_id: int, files: Iterable[str]) -> dict[str, Optional[SpecDurationStats]]:
+        files = list(files)
+        if not files:
+            return {}
+        values = await self.redis.hmget(get_spec_history_key(project_id), files)
+        return {file: SpecDurationStats.parse_raw(value) if value else None for file, value in zip(files, values)}
+
+    async def get_durations(self, project_id: int, files: Iterable[str],
+                            pct: str = 'p50') -> dict[str, Optional[int]]:
+        """
+        Duration percentile for each spec, in the form expected by SpecScheduler.enqueue
+        """
+        return {file: getattr(stats, pct) if stats else None
+                for file, stats in (await self.get_many(project_id, files)).items()}
+
+    async def remove(self, project_id: int, *files: str):
+        await self.redis.hdel(get_spec_history_key(project_id), *files)
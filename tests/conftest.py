@@ -0,0 +1,66 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# This repo is checked out as a submodule named "common" by the services that use it, so load it under
+# that name regardless of what the checkout directory is called
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'common' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('common', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['common'] = module
+    spec.loader.exec_module(module)
+
+
+def pytest_addoption(parser):
+    parser.addoption('--bench', action='store_true', default=False, help='run the benchmarks')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'bench: benchmark, only run with --bench')
+    # TestResult, TestResultStatus etc aren't test classes
+    config.addinivalue_line('filterwarnings', 'ignore::pytest.PytestCollectionWarning')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--bench'):
+        return
+    skip = pytest.mark.skip(reason='benchmark: use --bench to run')
+    for item in items:
+        if 'bench' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def fake_redis():
+    """
+    Factory for async fakeredis clients that share a single, empty server. Create clients inside the test's
+    event loop
+    """
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    return lambda: fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+
+
+@pytest.fixture
+def redis_server():
+    """
+    As fake_redis, but for a local redis-server (for benchmarks). The test database is emptied before and
+    after the test, and the test is skipped if there's no server
+    """
+    from redis import Redis, ConnectionError
+    from redis.asyncio import Redis as AsyncRedis
+
+    db = int(os.environ.get('REDIS_TEST_DB', 15))
+    redis = Redis(db=db)
+    try:
+        redis.flushdb()
+    except ConnectionError:
+        pytest.skip('No local redis-server')
+    yield lambda: AsyncRedis(db=db, decode_responses=True)
+    redis.flushdb()
+    redis.close()
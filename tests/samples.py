@@ -0,0 +1,110 @@
+import random
+import uuid
+from datetime import datetime
+
+from common.enums import (AppWebSocketActions, AppFramework, TestFramework, PlatformEnum, TestRunStatus,
+                          TestResultStatus, LogLevel)
+from common.schemas import (Project, TestRunDetail, SpecFile, SpecTests, SpecTest, TestResult, TestResultError,
+                            AgentModel, Subscription, SubscriptionPlan, WebhookHistory, TestRunJobStats,
+                            AppLogMessage, TestRunErrorReport, AgentStateMessage, TestRunErrorMessage,
+                            TestRunDetailUpdateMessage, SubscriptionUpdatedMessage, ExceededIncludeBuildCredits,
+                            SpecFileMessage, WebhookNotifiedMessage, SpecFileLogMessage, TestRunStatusUpdateMessage,
+                            TestRunJobStatsUpdateMessage, LogUpdateMessage, AgentTestRunErrorEvent, AgentLogMessage,
+                            AgentErrorMessage)
+
+NOW = datetime(2024, 3, 1, 12, 30, 15, 123456)
+
+
+def make_project() -> Project:
+    return Project(id=1, name='Ünïcode project', repos='cykubed/app', platform=PlatformEnum.GITHUB,
+                   organisation_id=5, default_branch='main', url='https://github.com/cykubed/app',
+                   app_framework=AppFramework.angular, test_framework=TestFramework.cypress)
+
+
+def make_spec_file(idx: int, num_tests: int = 10) -> SpecFile:
+    tests = [SpecTest(title=f'test {i} – “quoted”', context='context', line=i,
+                      status=TestResultStatus.failed if i == 0 else TestResultStatus.passed,
+                      results=[TestResult(browser='chrome', duration=1234,
+                                          status=TestResultStatus.failed if i == 0 else TestResultStatus.passed,
+                                          errors=[TestResultError(message='expected 1e16 to equal 1.5')]
+                                          if i == 0 else None)])
+             for i in range(num_tests)]
+    return SpecFile(file=f'cypress/e2e/spec{idx}.cy.ts', started=NOW, finished=NOW, duration=12,
+                    result=SpecTests(tests=tests))
+
+
+def make_testrun_detail(num_files: int = 20) -> TestRunDetail:
+    return TestRunDetail(id=10, local_id=3, branch='feature/ß', sha='deadbeef', status=TestRunStatus.running,
+                         started=NOW, project=make_project(),
+                         files=[make_spec_file(i) for i in range(num_files)],
+                         jobstats=TestRunJobStats(total_build_seconds=100, total_cost_usd=1e16 / 3))
+
+
+def make_log_message() -> AppLogMessage:
+    return AppLogMessage(source='builder', ts=NOW, level=LogLevel.info, msg='npm install → done ✓', step=2)
+
+
+def make_messages() -> dict[str, object]:
+    """
+    An example of every websocket message type
+    """
+    return {
+        'AgentStateMessage': AgentStateMessage(agent=AgentModel(id=1, organisation_id=5, name='agent',
+                                                                token=uuid.UUID(int=12345))),
+        'TestRunErrorMessage': TestRunErrorMessage(message='Build failed', source='builder'),
+        'TestRunDetailUpdateMessage': TestRunDetailUpdateMessage(testrun=make_testrun_detail()),
+        'SubscriptionUpdatedMessage': SubscriptionUpdatedMessage(
+            subscription=Subscription(active=True, plan=SubscriptionPlan(name='pro'))),
+        'ExceededIncludeBuildCredits': ExceededIncludeBuildCredits(),
+        'SpecFileMessage': SpecFileMessage(action=AppWebSocketActions.spec_finished, testrun_id=10,
+                                           spec=make_spec_file(0, 50)),
+        'WebhookNotifiedMessage': WebhookNotifiedMessage(details=WebhookHistory(hook_id=1, testrun_id=10,
+                                                                                created=NOW, request='{}')),
+        'SpecFileLogMessage': SpecFileLogMessage(file='cypress/e2e/spec.cy.ts', log='Running: spec.cy.ts\n' * 20),
+        'TestRunStatusUpdateMessage': TestRunStatusUpdateMessage(testrun_id=10, status=TestRunStatus.passed),
+        'TestRunJobStatsUpdateMessage': TestRunJobStatsUpdateMessage(
+            testrun_id=10, stats=TestRunJobStats(total_cpu_seconds=100, total_cost_usd=0.1 + 0.2)),
+        'LogUpdateMessage': LogUpdateMessage(testrun_id=10, line_num=100, msg=make_log_message()),
+        'AgentTestRunErrorEvent': AgentTestRunErrorEvent(testrun_id=10, report=TestRunErrorReport(
+            stage='build', msg='No lock file')),
+        'AgentLogMessage': AgentLogMessage(testrun_id=10, msg=make_log_message()),
+        'AgentErrorMessage': AgentErrorMessage(testrun_id=10, source='runner', message='Pod evicted'),
+    }
+
+
+BROWSERS = ['chrome', 'firefox', 'edge']
+STATUSES = [TestResultStatus.passed, TestResultStatus.failed, TestResultStatus.flakey, TestResultStatus.timeout]
+
+
+def count_from_scratch(spectests: SpecTests):
+    failed = 0
+    flakes = 0
+    total = 0
+    for test in spectests.tests:
+        all_browsers = {r.browser for r in test.results}
+        total += len(all_browsers)
+        browsers = {r.browser for r in test.results if r.status == TestResultStatus.failed
+                    or (r.status == TestResultStatus.passed and r.retry > 0)}
+        if test.status == TestResultStatus.failed:
+            failed += len(browsers)
+        elif test.status == TestResultStatus.flakey:
+            flakes += len(browsers)
+    return total, flakes, failed
+
+
+def filtered_from_scratch(spectests: SpecTests, status: TestResultStatus):
+    ret = []
+    for test in spectests.tests:
+        ret += [result for result in test.results if result.status == status]
+    return ret
+
+
+def random_spectests(rnd: random.Random, num_tests: int) -> SpecTests:
+    tests = []
+    for i in range(num_tests):
+        results = [TestResult(browser=rnd.choice(BROWSERS), status=rnd.choice(STATUSES), retry=rnd.randint(0, 2),
+                              duration=rnd.randint(1, 1000))
+                   for _ in range(rnd.randint(0, 3))]
+        tests.append(SpecTest(title=f'test {rnd.randint(0, num_tests)}', context=rnd.choice(['a', 'b', None]),
+                              status=rnd.choice(STATUSES), results=results))
+    return SpecTests(tests=tests)
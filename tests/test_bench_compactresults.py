@@ -0,0 +1,64 @@
+import gc
+import tracemalloc
+from time import perf_counter
+
+import pytest
+
+from common.compactresults import CompactSpecTests
+from common.enums import TestResultStatus
+from common.schemas import SpecTests
+
+BROWSERS = ['chrome', 'firefox', 'edge']
+
+
+def make_results(num_tests: int) -> dict:
+    tests = []
+    for i in range(num_tests):
+        results = []
+        for browser in BROWSERS:
+            failed = i % 20 == 0
+            results.append({'browser': browser,
+                            'status': TestResultStatus.failed if failed else TestResultStatus.passed,
+                            'duration': 100 + i,
+                            'errors': [{'message': 'expected true to be false', 'title': 'AssertionError'}]
+                            if failed else None})
+            if failed:
+                # a retry that passed
+                results.append({'browser': browser, 'status': TestResultStatus.passed, 'retry': 1,
+                                'duration': 100 + i})
+        tests.append({'title': f'test {i}', 'context': f'context {i % 50}', 'line': i,
+                      'status': TestResultStatus.flakey if i % 20 == 0 else TestResultStatus.passed,
+                      'results': results})
+    return {'tests': tests}
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = perf_counter()
+        value = build()
+        elapsed = perf_counter() - start
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return value, size, elapsed
+
+
+@pytest.mark.bench
+def test_bench_compact_memory():
+    num_tests = 20_000
+    data = make_results(num_tests)
+
+    spectests, tree_size, tree_time = measure(lambda: SpecTests.parse_obj(data))
+    compact, compact_size, compact_time = measure(lambda: CompactSpecTests.parse_obj(data))
+
+    print(f'\n{num_tests} tests x {len(BROWSERS)} browsers:'
+          f'\n  model tree: {tree_size / 1e6:.1f}MB, parsed in {tree_time * 1000:.0f}ms'
+          f'\n  compact:    {compact_size / 1e6:.1f}MB, parsed in {compact_time * 1000:.0f}ms')
+    assert compact == spectests
+    assert compact.count() == spectests.count()
+    assert compact_size * 5 < tree_size
+    # parsed straight into the columns, without building the model tree first
+    assert compact_time * 2 < tree_time
@@ -0,0 +1,56 @@
+import math
+import random
+from time import perf_counter
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from common.costengine import PodRecords, compute_costs, pricing_table
+from common.enums import JobType
+from common.jobstats import JobStatsAccumulator
+
+from samples import make_project
+from test_costengine import make_pricing
+
+NUM_PODS = 1_000_000
+NUM_TESTRUNS = 10_000
+
+
+@pytest.mark.bench
+def test_bench_compute_costs_1m():
+    rnd = random.Random(4)
+    models = [make_pricing(rnd) for _ in range(5)]
+    table = pricing_table(models)
+    project = make_project()
+    gen = np.random.default_rng(4)
+    testrun_ids = gen.integers(0, NUM_TESTRUNS, NUM_PODS)
+    pricing_idx = testrun_ids % len(models)
+    durations = gen.integers(1, 3600, NUM_PODS)
+    is_spot = gen.random(NUM_PODS) < 0.5
+    records = PodRecords(testrun_ids, testrun_ids % 100, durations, np.full(NUM_PODS, project.runner_cpu),
+                         np.full(NUM_PODS, project.runner_memory), np.full(NUM_PODS, project.runner_ephemeral_storage),
+                         is_spot, pricing_idx)
+
+    start = perf_counter()
+    report = compute_costs(records, table)
+    elapsed = perf_counter() - start
+
+    # the same thing, a pod at a time
+    start = perf_counter()
+    accumulators = {}
+    for i, (testrun_id, duration, spot) in enumerate(zip(testrun_ids.tolist(), durations.tolist(),
+                                                          is_spot.tolist())):
+        acc = accumulators.get(testrun_id)
+        if not acc:
+            acc = accumulators[testrun_id] = JobStatsAccumulator(testrun_id, project,
+                                                                 models[testrun_id % len(models)])
+        acc.add(str(i), JobType.runner, spot, duration)
+    total = sum(acc.cost() for acc in accumulators.values())
+    baseline = perf_counter() - start
+
+    print(f'\n{NUM_PODS} pods: per-pod accumulators {baseline * 1000:.0f}ms, compute_costs {elapsed * 1000:.0f}ms '
+          f'({baseline / elapsed:.0f}x)')
+    assert math.isclose(report.total, total, rel_tol=1e-9)
+    assert len(report.by_organisation()) == 100
+    assert elapsed < 1
@@ -0,0 +1,16 @@
+from timeit import timeit
+
+import pytest
+
+from samples import make_messages
+
+ITERATIONS = 200
+
+
+@pytest.mark.bench
+def test_bench_message_encoding():
+    print(f'\n{"message":<30} {"json() us":>10} {"json_bytes() us":>16} {"speedup":>8}')
+    for name, msg in make_messages().items():
+        baseline = timeit(lambda: msg.json().encode(), number=ITERATIONS) / ITERATIONS
+        fast = timeit(msg.json_bytes, number=ITERATIONS) / ITERATIONS
+        print(f'{name:<30} {baseline * 1e6:>10.1f} {fast * 1e6:>16.1f} {baseline / fast:>7.1f}x')
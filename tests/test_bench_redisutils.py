@@ -0,0 +1,48 @@
+import asyncio
+from time import perf_counter
+
+import pytest
+
+from common.redisutils import AsyncLogWriter
+
+NUM_LINES = 20_000
+NUM_KEYS = 10
+
+
+def log_lines():
+    for i in range(NUM_LINES):
+        yield f'testrun:1:spec:spec{i % NUM_KEYS}.cy.ts:logs', f'line {i}: Running test {i}\n'
+
+
+@pytest.mark.bench
+def test_bench_log_writer(redis_server):
+    async def append_per_line():
+        redis = redis_server()
+        start = perf_counter()
+        for key, line in log_lines():
+            await redis.append(key, line)
+        elapsed = perf_counter() - start
+        await redis.flushdb()
+        await redis.close()
+        return elapsed
+
+    async def batched():
+        redis = redis_server()
+        writer = AsyncLogWriter(redis)
+        writer.start()
+        start = perf_counter()
+        for key, line in log_lines():
+            await writer.write(key, line)
+        await writer.close()
+        elapsed = perf_counter() - start
+        total = sum([await redis.strlen(f'testrun:1:spec:spec{i}.cy.ts:logs') for i in range(NUM_KEYS)])
+        await redis.close()
+        return elapsed, total
+
+    baseline = asyncio.run(append_per_line())
+    elapsed, total = asyncio.run(batched())
+
+    print(f'\n{NUM_LINES} lines: APPEND per line {baseline * 1000:.1f}ms, AsyncLogWriter {elapsed * 1000:.1f}ms '
+          f'({baseline / elapsed:.1f}x)')
+    assert total == sum(len(line) for key, line in log_lines())
+    assert elapsed < baseline
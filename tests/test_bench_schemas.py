@@ -0,0 +1,59 @@
+from time import perf_counter
+
+import pytest
+
+from common.enums import TestResultStatus
+from common.schemas import SpecTests, SpecTest, TestResult
+
+
+def make_spectests(num_tests: int, browser: str = 'chrome', retry: int = 0) -> SpecTests:
+    status = TestResultStatus.flakey if retry else TestResultStatus.passed
+    return SpecTests(tests=[SpecTest(title=f'test {i}', context=f'context {i % 50}', line=i, status=status,
+                                     results=[TestResult(browser=browser, status=TestResultStatus.passed,
+                                                         retry=retry, duration=100)])
+                            for i in range(num_tests)])
+
+
+@pytest.mark.bench
+def test_bench_merge_10k():
+    num_tests = 10_000
+    spectests = make_spectests(num_tests)
+    retries = [make_spectests(num_tests, browser, retry=1)
+               for browser in ('firefox', 'edge')]
+
+    start = perf_counter()
+    for retry in retries:
+        spectests.merge(retry)
+    elapsed = perf_counter() - start
+
+    print(f'\nmerged {len(retries)} x {num_tests} tests in {elapsed * 1000:.1f}ms')
+    assert len(spectests.tests) == num_tests
+    assert spectests.count() == (num_tests * 3, num_tests * 2, 0)
+    # the old list scan took minutes for this: linear merge should be well under a second
+    assert elapsed < 1
+
+
+@pytest.mark.bench
+def test_bench_streaming_merge_and_read():
+    num_tests = 10_000
+    spectests = make_spectests(num_tests)
+    spectests.count()
+    spectests.get_filtered_test_results(TestResultStatus.failed)
+    # one retried test at a time, each followed by a read, as the agent does while results stream in
+    retries = [SpecTests(tests=[SpecTest(title=f'test {i}', context=f'context {i % 50}',
+                                         status=TestResultStatus.failed,
+                                         results=[TestResult(browser='firefox', status=TestResultStatus.failed)])])
+               for i in range(0, num_tests, 10)]
+
+    start = perf_counter()
+    for retry in retries:
+        spectests.merge(retry)
+        spectests.count()
+        spectests.get_filtered_test_results(TestResultStatus.failed)
+    elapsed = perf_counter() - start
+
+    print(f'\nmerged and read {len(retries)} times in {elapsed * 1000:.1f}ms')
+    assert spectests.count() == (num_tests + len(retries), 0, len(retries))
+    assert len(spectests.get_filtered_test_results(TestResultStatus.failed)) == len(retries)
+    # re-walking the tree on every read took around 10s
+    assert elapsed < 1
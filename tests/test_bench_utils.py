@@ -0,0 +1,39 @@
+import hashlib
+import os
+from timeit import timeit
+
+import pytest
+
+from common.utils import get_lock_hash, hash_file
+
+SIZES_MB = [0.1, 1, 10, 100]
+ITERATIONS = 5
+
+
+def read_and_hash(path) -> str:
+    # what we used to do
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@pytest.mark.bench
+def test_bench_lock_hash(tmp_path):
+    cache_file = tmp_path / 'lockhash.json'
+    print(f'\n{"size MB":>8} {"read() ms":>10} {"chunked ms":>11} {"cached ms":>10}')
+    for size in SIZES_MB:
+        build_dir = tmp_path / f'build{size}'
+        os.makedirs(build_dir)
+        lockfile = build_dir / 'package-lock.json'
+        with open(lockfile, 'wb') as f:
+            f.write(os.urandom(int(size * 1024 * 1024)))
+
+        expected = read_and_hash(lockfile)
+        assert hash_file(lockfile) == expected
+        assert get_lock_hash(build_dir, cache_file) == expected
+
+        baseline = timeit(lambda: read_and_hash(lockfile), number=ITERATIONS) / ITERATIONS
+        chunked = timeit(lambda: hash_file(lockfile), number=ITERATIONS) / ITERATIONS
+        cached = timeit(lambda: get_lock_hash(build_dir, cache_file), number=ITERATIONS) / ITERATIONS
+        print(f'{size:>8} {baseline * 1000:>10.2f} {chunked * 1000:>11.2f} {cached * 1000:>10.2f}')
+        if size >= 1:
+            assert cached < chunked
@@ -0,0 +1,50 @@
+import asyncio
+
+from common.broadcast import BroadcastEncoder, broadcast
+from common.enums import TestRunStatus
+from common.schemas import TestRunStatusUpdateMessage
+
+
+def test_unversioned_messages_not_cached():
+    encoder = BroadcastEncoder()
+    msg = TestRunStatusUpdateMessage(testrun_id=1, status=TestRunStatus.running)
+    encoder.encode(msg)
+    msg.status = TestRunStatus.passed
+    assert b'passed' in encoder.encode(msg)
+    assert encoder.stats() == {'hits': 0, 'misses': 2, 'entries': 0, 'bytes': 0}
+
+
+def test_versioned_messages_cached():
+    encoder = BroadcastEncoder()
+    msg = TestRunStatusUpdateMessage(testrun_id=1, status=TestRunStatus.running)
+    payload = encoder.encode(msg, 1)
+    assert encoder.encode(msg, 1) is payload
+    msg.status = TestRunStatus.passed
+    assert b'passed' in encoder.encode(msg, 2)
+    assert encoder.hits == 1 and encoder.misses == 2
+
+
+def test_cache_bounded_by_bytes():
+    msgs = [TestRunStatusUpdateMessage(testrun_id=i, status=TestRunStatus.running) for i in range(10)]
+    size = len(msgs[0].json_bytes())
+    encoder = BroadcastEncoder(max_bytes=size * 3)
+    for msg in msgs:
+        encoder.encode(msg, 1)
+    assert encoder.stats()['entries'] == 3
+    assert encoder.size <= encoder.max_bytes
+    # the most recent are kept
+    encoder.encode(msgs[-1], 1)
+    assert encoder.hits == 1
+
+
+def test_broadcast_encodes_once():
+    encoder = BroadcastEncoder()
+    received = []
+
+    async def send(payload: bytes):
+        received.append(payload)
+
+    msg = TestRunStatusUpdateMessage(testrun_id=1, status=TestRunStatus.running)
+    asyncio.run(broadcast(msg, [send] * 5, encoder=encoder))
+    assert len(received) == 5 and len({id(p) for p in received}) == 1
+    assert encoder.misses == 1
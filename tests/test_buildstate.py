@@ -0,0 +1,73 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from pydantic import ValidationError
+
+from common.buildstate import BuildStateStore
+from common.schemas import TestRunBuildState
+
+
+def make_state() -> TestRunBuildState:
+    return TestRunBuildState(testrun_id=10, specs=['a.cy.ts', 'b.cy.ts', 'c.cy.ts'], cache_key='v1-n18',
+                             runner_deadline=datetime(2024, 3, 1, 12, tzinfo=timezone.utc))
+
+
+def test_save_and_load(fake_redis):
+    async def run():
+        store = BuildStateStore(fake_redis())
+        assert await store.load(10) is None
+        state = make_state()
+        await store.save(state)
+
+        loaded = await store.load(10)
+        assert loaded == state.copy(update={'specs': []})
+        assert await store.load(10, with_specs=True) == state
+
+        # save replaces everything
+        await store.save(TestRunBuildState(testrun_id=10))
+        assert await store.load(10, with_specs=True) == TestRunBuildState(testrun_id=10)
+
+        await store.delete(10)
+        assert await store.load(10) is None
+
+    asyncio.run(run())
+
+
+def test_update(fake_redis):
+    async def run():
+        store = BuildStateStore(fake_redis())
+        state = make_state()
+        await store.save(state)
+        await store.update(10, run_job='runner-10', rw_build_pvc='pvc-rw')
+        assert await store.incr_run_job_index(10) == 1
+        assert await store.incr_run_job_index(10, 2) == 3
+        await store.remove_spec(10, 'b.cy.ts')
+
+        loaded = await store.load(10, with_specs=True)
+        assert loaded == state.copy(update={'run_job': 'runner-10', 'rw_build_pvc': 'pvc-rw', 'run_job_index': 3,
+                                            'specs': ['a.cy.ts', 'c.cy.ts']})
+
+        with pytest.raises(ValidationError):
+            await store.update(10, runner_deadline='not a date')
+        with pytest.raises(ValueError):
+            await store.update(10, specs=['d.cy.ts'])
+        assert await store.get_specs(10) == ['a.cy.ts', 'c.cy.ts']
+
+        await store.set_specs(10, ['d.cy.ts'])
+        assert await store.get_specs(10) == ['d.cy.ts']
+        await store.set_specs(10, [])
+        assert await store.get_specs(10) == []
+
+    asyncio.run(run())
+
+
+def test_mark_completed(fake_redis):
+    async def run():
+        store = BuildStateStore(fake_redis())
+        await store.save(make_state())
+        results = await asyncio.gather(*[store.mark_completed(10) for _ in range(5)])
+        assert sorted(results) == [False] * 4 + [True]
+        assert (await store.load(10)).completed
+
+    asyncio.run(run())
@@ -0,0 +1,259 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+import httpx
+import pytest
+from loguru import logger
+
+from common import cloudlogging
+from common.cloudlogging import (BatchingStackDriverSink, LogRateLimiter, OverflowPolicy, StackDriverSink,
+                                 _check_metadata_response, _detect_gcp_locally, async_is_running_on_gcp,
+                                 is_running_on_gcp)
+
+
+def make_record(message: str, level: str = 'INFO') -> dict:
+    return {'message': message, 'level': logger.level(level)}
+
+
+def test_burst_reported_after_window():
+    limiter = LogRateLimiter(dedupe_window=0.05)
+    results = [limiter.check(make_record('Waiting for build')) for _ in range(5)]
+    assert results == [True, False, False, False, False]
+    assert limiter.summaries() == []
+    time.sleep(0.06)
+    # the burst has stopped, but we still hear about it
+    assert limiter.summaries() == [('INFO', 'Waiting for build', 4)]
+    assert limiter.summaries() == []
+
+
+def test_evicted_repeats_reported():
+    limiter = LogRateLimiter(max_tracked=1)
+    assert limiter.check(make_record('first'))
+    assert not limiter.check(make_record('first'))
+    assert limiter.check(make_record('second'))
+    assert limiter.summaries() == [('INFO', 'first', 1)]
+    assert not limiter.check(make_record('second'))
+    assert limiter.summaries(flush=True) == [('INFO', 'second', 1)]
+
+
+def test_warnings_always_pass():
+    limiter = LogRateLimiter()
+    assert all(limiter.check(make_record('Disk full', 'WARNING')) for _ in range(5))
+    assert limiter.summaries(flush=True) == []
+
+
+class FakeBatch:
+    def __init__(self, logger: 'FakeLogger'):
+        self.logger = logger
+        self.entries = []
+
+    def log_struct(self, info: dict, **kwargs):
+        self.entries.append(info['message'])
+
+    def commit(self):
+        if self.logger.fail:
+            raise RuntimeError('Cloud Logging unavailable')
+        self.logger.batches.append(self.entries)
+
+
+class FakeLogger:
+    """
+    Stands in for a Cloud Logging logger, recording the messages in each committed batch
+    """
+    def __init__(self):
+        self.batches: list[list[str]] = []
+        self.fail = False
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+
+def make_message(message: str, level: str = 'INFO') -> SimpleNamespace:
+    record = dict(make_record(message, level), exception=None, module='test', name='tests.test_cloudlogging',
+                  file=SimpleNamespace(name='test_cloudlogging.py'), function='test', line=1, extra={})
+    return SimpleNamespace(record=record)
+
+
+def wait_for(condition, timeout: float = 1) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+@pytest.fixture
+def make_sink(monkeypatch):
+    """
+    Create BatchingStackDriverSinks that log to a FakeLogger rather than the Cloud Logging client
+    """
+    def init(self, logger_name='cykube', rate_limiter=None):
+        self.rate_limiter = rate_limiter
+        self.logger = FakeLogger()
+        self.hostname = 'test-pod'
+
+    monkeypatch.setattr(StackDriverSink, '__init__', init)
+    sinks = []
+
+    def make(**kwargs) -> BatchingStackDriverSink:
+        sinks.append(BatchingStackDriverSink(**kwargs))
+        return sinks[-1]
+
+    yield make
+    for sink in sinks:
+        sink.stop()
+
+
+def test_flush_on_batch_size(make_sink):
+    sink = make_sink(batch_size=3, flush_interval=0.5)
+    start = time.monotonic()
+    for i in range(3):
+        sink.write(make_message(f'message {i}'))
+    assert wait_for(lambda: sink.logger.batches)
+    # a full batch doesn't wait for the interval
+    assert time.monotonic() - start < 0.5
+    assert sink.logger.batches == [['message 0', 'message 1', 'message 2']]
+    assert sink.sent == 3
+
+
+def test_flush_on_interval(make_sink):
+    sink = make_sink(batch_size=100, flush_interval=0.05)
+    sink.write(make_message('first'))
+    sink.write(make_message('second'))
+    assert wait_for(lambda: sink.logger.batches)
+    assert sink.logger.batches == [['first', 'second']]
+    assert sink.metrics() == {'queue_depth': 0, 'dropped': 0, 'sampled_out': 0, 'sent': 2, 'failed': 0}
+
+
+def test_failed_batches_counted(make_sink):
+    sink = make_sink(flush_interval=0.05)
+    sink.logger.fail = True
+    sink.write(make_message('lost'))
+    assert wait_for(lambda: sink.failed)
+    assert (sink.sent, sink.failed) == (0, 1)
+
+
+def test_drop_when_full(make_sink):
+    sink = make_sink(max_queue=2, flush_interval=0.01)
+    # with the flusher stopped nothing leaves the queue until we drain it
+    sink.stop()
+    for i in range(5):
+        sink.write(make_message(f'message {i}'))
+    assert (sink.queue_depth, sink.dropped) == (2, 3)
+    sink.stop()
+    assert sink.logger.batches == [['message 0', 'message 1']]
+    assert (sink.queue_depth, sink.sent) == (0, 2)
+
+
+def test_sample_when_half_full(make_sink):
+    sink = make_sink(max_queue=10, flush_interval=0.01, overflow=OverflowPolicy.sample, sample_rate=3)
+    sink.stop()
+    for i in range(5):
+        sink.write(make_message(f'message {i}'))
+    assert sink.sampled_out == 0
+    # half full: keep one in three
+    for i in range(5, 11):
+        sink.write(make_message(f'message {i}'))
+    assert (sink.queue_depth, sink.sampled_out) == (7, 4)
+    # warnings are never sampled, only dropped once the queue is full
+    for i in range(4):
+        sink.write(make_message(f'warning {i}', 'WARNING'))
+    assert sink.metrics() == {'queue_depth': 10, 'dropped': 1, 'sampled_out': 4, 'sent': 0, 'failed': 0}
+    sink.stop()
+    assert sink.logger.batches == [[f'message {i}' for i in (0, 1, 2, 3, 4, 7, 10)] +
+                                   ['warning 0', 'warning 1', 'warning 2']]
+
+
+def test_stop_drains_queue(make_sink):
+    sink = make_sink(batch_size=2, flush_interval=0.05, rate_limiter=LogRateLimiter())
+    for i in range(5):
+        sink.write(make_message(f'message {i}'))
+    sink.write(make_message('message 0'))
+    sink.stop()
+    sent = [message for batch in sink.logger.batches for message in batch]
+    assert sent == [f'message {i}' for i in range(5)] + ['message 0 [repeated 1 times]']
+    assert max(len(batch) for batch in sink.logger.batches) <= 2
+    assert (sink.queue_depth, sink.sent) == (0, 6)
+
+
+@pytest.fixture
+def gcp_detection(monkeypatch, tmp_path):
+    """
+    Isolate GCP detection from the environment we're running in
+    """
+    monkeypatch.delenv('ON_GCP', raising=False)
+    monkeypatch.setattr(cloudlogging, 'GCP_DETECT_CACHE', str(tmp_path / 'gcp-detected'))
+    monkeypatch.setattr(cloudlogging, 'DMI_PRODUCT_NAME', str(tmp_path / 'product_name'))
+    return tmp_path
+
+
+def metadata_response(status_code: int = 200, flavor: Optional[str] = 'Google',
+                      text: str = '123-compute@developer.gserviceaccount.com') -> httpx.Response:
+    return httpx.Response(status_code, headers={'Metadata-Flavor': flavor} if flavor else {}, text=text)
+
+
+def cached_detection(tmp_path) -> Optional[str]:
+    path = tmp_path / 'gcp-detected'
+    return path.read_text() if path.exists() else None
+
+
+def test_detect_gcp_locally(gcp_detection, monkeypatch):
+    assert _detect_gcp_locally() is None
+
+    (gcp_detection / 'product_name').write_text('Google Compute Engine\n')
+    assert _detect_gcp_locally() is None
+    (gcp_detection / 'product_name').write_text('Standard PC (Q35 + ICH9, 2009)\n')
+    assert _detect_gcp_locally() is False
+
+    (gcp_detection / 'gcp-detected').write_text('1')
+    assert _detect_gcp_locally() is True
+
+    monkeypatch.setenv('ON_GCP', 'false')
+    assert _detect_gcp_locally() is False
+
+
+def test_check_metadata_response(gcp_detection):
+    assert _check_metadata_response(metadata_response())
+    assert cached_detection(gcp_detection) == '1'
+
+    # an error from the metadata server itself isn't cached
+    (gcp_detection / 'gcp-detected').unlink()
+    assert not _check_metadata_response(metadata_response(503, text='starting'))
+    assert cached_detection(gcp_detection) is None
+
+    # but something that isn't the metadata server at all is
+    assert not _check_metadata_response(metadata_response(404, flavor=None, text='Not found'))
+    assert cached_detection(gcp_detection) == '0'
+
+
+@pytest.mark.parametrize('error, cached', [(httpx.ConnectError('Name or service not known'), '0'),
+                                           (httpx.ConnectTimeout('timed out'), None),
+                                           (httpx.ReadTimeout('timed out'), None)])
+def test_metadata_server_errors(gcp_detection, monkeypatch, error, cached):
+    def get(*args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(httpx, 'get', get)
+    assert not is_running_on_gcp()
+    assert cached_detection(gcp_detection) == cached
+
+
+@pytest.mark.parametrize('error, cached', [(httpx.ConnectError('Name or service not known'), '0'),
+                                           (httpx.ReadTimeout('timed out'), None),
+                                           (None, '1')])
+def test_async_metadata_server_errors(gcp_detection, monkeypatch, error, cached):
+    def handler(request):
+        if error:
+            raise error
+        return metadata_response()
+
+    class MockClient(httpx.AsyncClient):
+        def __init__(self, **kwargs):
+            super().__init__(transport=httpx.MockTransport(handler), **kwargs)
+
+    monkeypatch.setattr(httpx, 'AsyncClient', MockClient)
+    assert asyncio.run(async_is_running_on_gcp()) == (error is None)
+    assert cached_detection(gcp_detection) == cached
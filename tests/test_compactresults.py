@@ -0,0 +1,60 @@
+import random
+
+import pytest
+
+from common.compactresults import CompactSpecTests
+from common.enums import TestResultStatus
+from common.schemas import SpecFile, SpecTests
+
+from samples import random_spectests, count_from_scratch, filtered_from_scratch
+
+
+def check_matches(compact: CompactSpecTests, spectests):
+    assert compact == spectests
+    assert compact.json() == spectests.json()
+    assert compact.count() == count_from_scratch(spectests)
+    for status in TestResultStatus:
+        assert compact.get_filtered_test_results(status) == filtered_from_scratch(spectests, status)
+
+
+def test_compact_matches_model_tree():
+    rnd = random.Random(5)
+    for _ in range(200):
+        spectests = random_spectests(rnd, rnd.randint(0, 15))
+        compact = CompactSpecTests.from_spectests(spectests)
+        check_matches(compact, spectests)
+        for _ in range(2):
+            other = random_spectests(rnd, rnd.randint(0, 15))
+            # merge either a model tree or another compact store
+            compact.merge(CompactSpecTests.from_spectests(other) if rnd.random() < 0.5 else other)
+            spectests.merge(other)
+            check_matches(compact, spectests)
+
+
+def test_compact_as_spec_file_result():
+    spectests = random_spectests(random.Random(9), 10)
+    compact = CompactSpecTests.from_spectests(spectests)
+    spec = SpecFile(file='cypress/e2e/test.cy.ts', result=compact)
+    assert isinstance(spec.result, CompactSpecTests)
+    assert SpecFile.parse_raw(spec.json()).result == spectests
+    assert CompactSpecTests.parse_raw(spectests.json()) == spectests
+    assert compact.tests[-1] == spectests.tests[-1]
+    assert compact.to_spectests() == spectests
+
+
+def test_compact_parsed_from_dicts():
+    data = {'tests': [{'title': 'logs in', 'context': 'login', 'line': 12, 'status': 'flakey',
+                       'results': [{'browser': 'chrome', 'status': 'failed', 'duration': 1200,
+                                    'failure_screenshots': ['login.png'],
+                                    'errors': [{'message': 'expected true to be false', 'title': 'AssertionError',
+                                                'code_frame': {'line': 12, 'column': 4}}]},
+                                   {'browser': 'chrome', 'status': 'passed', 'retry': 1}]},
+                      {'title': 'logs out', 'status': TestResultStatus.passed, 'results': []}]}
+    compact = CompactSpecTests.parse_obj(data)
+    spectests = SpecTests.parse_obj(data)
+    check_matches(compact, spectests)
+    assert compact.tests[0].results[0].errors[0].code_frame.column == 4
+
+    data['tests'][1]['status'] = 'skipped'
+    with pytest.raises(ValueError, match='skipped'):
+        CompactSpecTests.parse_obj(data)
@@ -0,0 +1,103 @@
+import math
+import random
+from collections import defaultdict
+from datetime import datetime
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from common.costengine import PodRecords, compute_costs, pricing_table
+from common.enums import JobType, KubernetesPlatform
+from common.jobstats import JobStatsAccumulator
+from common.schemas import KubernetesPlatformPricingModel, PodDuration
+
+from samples import make_project
+
+
+def make_pricing(rnd: random.Random, spot: bool = True) -> KubernetesPlatformPricingModel:
+    return KubernetesPlatformPricingModel(platform=KubernetesPlatform.gke, updated=datetime(2024, 1, 1),
+                                          region='europe-west2',
+                                          cpu_normal_price=rnd.uniform(0.02, 0.05),
+                                          cpu_spot_price=rnd.uniform(0.005, 0.02) if spot else None,
+                                          memory_normal_price=rnd.uniform(0.002, 0.005),
+                                          memory_spot_price=rnd.uniform(0.0005, 0.002) if spot else None,
+                                          ephemeral_price=rnd.uniform(0.0001, 0.0002))
+
+
+def test_pricing_table_spot_fallback():
+    rnd = random.Random(1)
+    with_spot = make_pricing(rnd)
+    without_spot = make_pricing(rnd, spot=False)
+    empty = KubernetesPlatformPricingModel(platform=KubernetesPlatform.gke, updated=datetime(2024, 1, 1),
+                                           region='europe-west2')
+    table = pricing_table([with_spot, without_spot, empty])
+    assert table.tolist() == [
+        [with_spot.cpu_normal_price, with_spot.cpu_spot_price, with_spot.memory_normal_price,
+         with_spot.memory_spot_price, with_spot.ephemeral_price],
+        [without_spot.cpu_normal_price, without_spot.cpu_normal_price, without_spot.memory_normal_price,
+         without_spot.memory_normal_price, without_spot.ephemeral_price],
+        [0, 0, 0, 0, 0]]
+    assert pricing_table([]).shape == (0, 5)
+
+
+def test_costs_match_job_stats():
+    rnd = random.Random(2)
+    models = [make_pricing(rnd), make_pricing(rnd, spot=False)]
+    table = pricing_table(models)
+    projects = [make_project().copy(update={'organisation_id': org, 'runner_cpu': rnd.choice([1, 2, 4]),
+                                            'runner_memory': rnd.choice([2, 5]), 'build_cpu': rnd.choice([2, 4])})
+                for org in (5, 5, 6)]
+
+    pods = []
+    for testrun_id in range(1, 11):
+        project = rnd.choice(projects)
+        pricing_idx = rnd.randrange(len(models))
+        for i in range(rnd.randint(0, 20)):
+            pod = PodDuration(pod_name=f'pod-{i}', job_type=JobType.builder if i == 0 else JobType.runner,
+                              is_spot=rnd.random() < 0.5, duration=rnd.randint(1, 3600))
+            pods.append((testrun_id, project, pod, pricing_idx))
+    records = PodRecords.from_pods(pods)
+    assert len(records) == len(pods)
+
+    for spot in (None, True, False):
+        accumulators = {}
+        for testrun_id, project, pod, pricing_idx in pods:
+            acc = accumulators.get(testrun_id)
+            if not acc:
+                acc = accumulators[testrun_id] = JobStatsAccumulator(testrun_id, project, models[pricing_idx])
+            acc.add(pod.pod_name, pod.job_type, pod.is_spot if spot is None else spot, pod.duration)
+        by_organisation = defaultdict(float)
+        for acc in accumulators.values():
+            by_organisation[acc.project.organisation_id] += acc.cost()
+
+        report = compute_costs(records, table, spot)
+        by_testrun = report.by_testrun()
+        assert by_testrun.keys() == accumulators.keys()
+        for testrun_id, acc in accumulators.items():
+            assert math.isclose(by_testrun[testrun_id], acc.cost(), rel_tol=1e-9)
+        assert report.by_organisation().keys() == by_organisation.keys()
+        for org, cost in by_organisation.items():
+            assert math.isclose(report.by_organisation()[org], cost, rel_tol=1e-9)
+        assert math.isclose(report.total, sum(by_organisation.values()), rel_tol=1e-9)
+
+
+def test_spot_what_if():
+    rnd = random.Random(3)
+    table = pricing_table([make_pricing(rnd)])
+    project = make_project()
+    records = PodRecords.from_pods([(1, project, PodDuration(pod_name='a', job_type=JobType.runner, is_spot=True,
+                                                             duration=60), 0),
+                                    (1, project, PodDuration(pod_name='b', job_type=JobType.runner, duration=60), 0)])
+    actual = compute_costs(records, table).total
+    all_spot = compute_costs(records, table, spot=True).total
+    all_normal = compute_costs(records, table, spot=False).total
+    assert all_spot < actual < all_normal
+    assert math.isclose(actual, (all_spot + all_normal) / 2)
+
+
+def test_no_pods():
+    report = compute_costs(PodRecords.from_pods([]), pricing_table([]))
+    assert report.total == 0
+    assert report.by_testrun() == {}
+    assert report.by_organisation() == {}
@@ -0,0 +1,94 @@
+import random
+
+from common.compactresults import CompactSpecTests
+from common.enums import TestResultStatus, SpecFileStatus
+from common.schemas import (TestRunDetail, TestRunDetailDeltaMessage, TestResult, TestResultError, SpecTest,
+                            SpecTests, diff_testrun_detail, apply_testrun_detail_delta)
+
+from samples import make_testrun_detail, make_spec_file
+
+
+def round_trip(old: TestRunDetail, new: TestRunDetail) -> TestRunDetail:
+    delta = diff_testrun_detail(old, new)
+    msg = TestRunDetailDeltaMessage.parse_raw(TestRunDetailDeltaMessage(delta=delta).json())
+    return apply_testrun_detail_delta(old.copy(deep=True), msg.delta)
+
+
+def modify(rnd: random.Random, detail: TestRunDetail):
+    detail.version = (detail.version or 0) + 1
+    for _ in range(rnd.randint(1, 4)):
+        spec = rnd.choice(detail.files)
+        result = spec.result
+        change = rnd.randint(0, 9)
+        if change in (2, 3) and not result.tests:
+            change = 4
+        if change == 0:
+            result.video = f'video{rnd.randint(0, 100)}.mp4'
+        elif change == 1:
+            result.timeout = not result.timeout
+        elif change == 2:
+            # edit an existing result in place
+            existing = rnd.choice(rnd.choice(result.tests).results)
+            existing.errors = [TestResultError(message='boom')]
+            existing.failure_screenshots = ['screenshot.png']
+            existing.duration = rnd.randint(1, 1000)
+        elif change == 3:
+            result.merge(SpecTests(tests=[SpecTest(title=rnd.choice(result.tests).title, context='context',
+                                                   status=TestResultStatus.flakey,
+                                                   results=[TestResult(browser='firefox', retry=1,
+                                                                       status=TestResultStatus.passed)])]))
+        elif change == 4:
+            result.merge(SpecTests(tests=[SpecTest(title=f'new test {rnd.randint(0, 100)}',
+                                                   status=TestResultStatus.failed,
+                                                   results=[TestResult(browser='chrome',
+                                                                       status=TestResultStatus.failed)])]))
+        elif change == 5:
+            spec.status = SpecFileStatus.cancelled
+        elif change == 6:
+            spec.result = None
+        elif change == 7:
+            detail.files.append(make_spec_file(rnd.randint(100, 1000)))
+        elif change == 8:
+            detail.files.remove(spec)
+        else:
+            detail.total_tests = rnd.randint(0, 1000)
+        if not detail.files:
+            detail.files.append(make_spec_file(0))
+        for spec in detail.files:
+            if spec.result is None:
+                spec.result = SpecTests()
+
+
+def test_apply_diff_gives_new():
+    rnd = random.Random(11)
+    for _ in range(100):
+        old = make_testrun_detail(5)
+        old.version = 1
+        new = old.copy(deep=True)
+        modify(rnd, new)
+        assert round_trip(old, new) == new
+
+
+def test_apply_diff_to_compact_results():
+    rnd = random.Random(12)
+    applied_deltas = 0
+    for _ in range(100):
+        old = make_testrun_detail(5)
+        old.version = 1
+        for spec in old.files:
+            spec.result = CompactSpecTests.from_spectests(spec.result)
+        new = old.copy(deep=True)
+        modify(rnd, new)
+        applied_deltas += sum(1 for f in diff_testrun_detail(old, new).files if f.result)
+        applied = round_trip(old, new)
+        assert applied == new
+        for spec, expected in zip(applied.files, new.files):
+            assert spec.result.count() == expected.result.count()
+    # make sure we actually applied some deltas to the compact results, rather than replacing them
+    assert applied_deltas > 10
+
+
+def test_apply_diff_with_no_changes():
+    old = make_testrun_detail(3)
+    delta = diff_testrun_detail(old, old.copy(deep=True))
+    assert not delta.files and not delta.changes and not delta.removed_files
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# cumulative import time budgets in seconds, including pydantic
+IMPORT_BUDGETS = {'common.enums': 0.05, 'common.schemas': 0.5}
+
+# only needed by cloudlogging, k8common and redisutils
+HEAVY_MODULES = ['google.cloud.logging', 'kubernetes_asyncio', 'dns.resolver', 'redis', 'httpx', 'numpy']
+
+IMPORT_SCRIPT = f'''
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location('common', {os.path.join(ROOT, '__init__.py')!r},
+                                              submodule_search_locations=[{ROOT!r}])
+module = importlib.util.module_from_spec(spec)
+sys.modules['common'] = module
+spec.loader.exec_module(module)
+import common.enums
+import common.schemas
+print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))
+'''
+
+
+def test_schemas_import_time():
+    # run in a fresh interpreter, so nothing has been imported already
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT], capture_output=True,
+                          text=True, check=True)
+    assert proc.stdout.strip() == '', f'heavy modules imported: {proc.stdout.strip()}'
+
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:'):
+            _, total, name = line.split('|')
+            if total.strip().isdigit():
+                cumulative[name.strip()] = int(total) / 1e6
+    for name, budget in IMPORT_BUDGETS.items():
+        assert cumulative[name] < budget, f'{name} took {cumulative[name]:.3f}s to import (budget {budget}s)'
@@ -0,0 +1,79 @@
+import asyncio
+import datetime
+
+from common.enums import JobType
+from common.jobstats import JobStatsAccumulator, JobStatsTracker
+from common.schemas import PodStatus, TestRunJobStatsUpdateMessage
+
+from samples import NOW, make_project
+
+
+def make_pod_status(phase: str, duration: int = None, end_time: datetime.datetime = None,
+                    pod_name: str = 'runner-1') -> PodStatus:
+    return PodStatus(pod_name=pod_name, project_id=1, testrun_id=10, phase=phase, start_time=NOW,
+                     end_time=end_time, is_spot=False, duration=duration, job_type=JobType.runner.value)
+
+
+def test_running_pod_not_counted():
+    acc = JobStatsAccumulator(10, make_project())
+    # a partial duration for a running pod mustn't stop us counting it once it's finished
+    assert not acc.add_pod_status(make_pod_status('Running', duration=30))
+    assert acc.runner_seconds == 0
+
+    assert acc.add_pod_status(make_pod_status('Succeeded', duration=120))
+    assert acc.runner_seconds == 120
+    # only counted once
+    assert not acc.add_pod_status(make_pod_status('Succeeded', duration=120))
+    assert acc.runner_seconds == 120
+
+
+def test_pod_counted_from_end_time():
+    acc = JobStatsAccumulator(10, make_project())
+    assert acc.add_pod_status(make_pod_status('Unknown', end_time=NOW + datetime.timedelta(seconds=90)))
+    assert acc.runner_seconds == 90
+
+
+def make_tracker(min_interval: float) -> tuple[JobStatsTracker, list[TestRunJobStatsUpdateMessage]]:
+    sent = []
+
+    async def send(msg: TestRunJobStatsUpdateMessage):
+        sent.append(msg)
+
+    tracker = JobStatsTracker(send, min_interval=min_interval)
+    tracker.add_testrun(10, make_project())
+    return tracker, sent
+
+
+def test_tracker_coalesces_updates():
+    async def run():
+        tracker, sent = make_tracker(0.05)
+        for i in range(4):
+            await tracker.on_pod_event(make_pod_status('Succeeded', duration=10, pod_name=f'runner-{i}'))
+        # the first is sent straight away, the rest wait for the interval
+        assert [msg.stats.total_runner_seconds for msg in sent] == [10]
+        await asyncio.sleep(0.1)
+        # ...and are sent together as a single trailing update with the latest totals
+        assert [msg.stats.total_runner_seconds for msg in sent] == [10, 40]
+        assert not tracker._pending
+
+    asyncio.run(run())
+
+
+def test_tracker_complete_cancels_pending():
+    async def run():
+        tracker, sent = make_tracker(0.05)
+        await tracker.on_pod_event(make_pod_status('Succeeded', duration=10, pod_name='runner-1'))
+        await tracker.on_pod_event(make_pod_status('Succeeded', duration=20, pod_name='runner-2'))
+        pending = tracker._pending[10]
+
+        stats = await tracker.complete(10)
+        assert stats.total_runner_seconds == 30
+        assert [msg.stats.total_runner_seconds for msg in sent] == [10, 30]
+        await asyncio.sleep(0.1)
+        # the trailing update was cancelled rather than sent after the final stats
+        assert pending.cancelled()
+        assert len(sent) == 2
+        assert 10 not in tracker.accumulators
+        assert await tracker.complete(10) is None
+
+    asyncio.run(run())
@@ -0,0 +1,299 @@
+import asyncio
+import ssl
+from time import perf_counter
+
+import pytest
+
+kubernetes_asyncio = pytest.importorskip('kubernetes_asyncio')
+
+from kubernetes_asyncio import client, watch
+from kubernetes_asyncio.client.rest import ApiException
+
+from common import k8common
+from common.k8common import (APPLY_CONTENT_TYPE, FIELD_MANAGER, Informer, InstrumentedApi, LatencyHistogram,
+                             _retry_delay, _ssl_context, api_latency, apply_manifests, get_api_latency_stats,
+                             pod_phase)
+
+
+def make_pod(name: str, resource_version: str, testrun_id: int = 1, job_type: str = 'runner',
+             phase: str = 'Running') -> client.V1Pod:
+    return client.V1Pod(metadata=client.V1ObjectMeta(name=name, resource_version=resource_version,
+                                                     labels={'testrun_id': str(testrun_id), 'job_type': job_type}),
+                        status=client.V1PodStatus(phase=phase))
+
+
+def make_pod_list(resource_version: str, *pods) -> client.V1PodList:
+    return client.V1PodList(items=list(pods), metadata=client.V1ListMeta(resource_version=resource_version))
+
+
+class FakeLister:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    async def __call__(self, namespace, label_selector=None, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+class FakeWatch:
+    """
+    Replays a scripted list of watch sessions: each is a list of events, or an exception to raise. Once
+    they've all been used, the watch blocks
+    """
+    sessions = []
+    resource_versions = []
+    done = None
+
+    def __init__(self):
+        self.resource_version = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def stream(self, func, namespace, resource_version=None, **kwargs):
+        FakeWatch.resource_versions.append(resource_version)
+        if not FakeWatch.sessions:
+            FakeWatch.done.set()
+            await asyncio.Event().wait()
+        session = FakeWatch.sessions.pop(0)
+        if isinstance(session, Exception):
+            raise session
+        for event in session:
+            if event['type'] == 'BOOKMARK':
+                self.resource_version = event['object'].metadata.resource_version
+            yield event
+
+
+@pytest.fixture
+def fake_watch(monkeypatch):
+    monkeypatch.setattr(watch, 'Watch', FakeWatch)
+    FakeWatch.sessions = []
+    FakeWatch.resource_versions = []
+    return FakeWatch
+
+
+async def run_informer(informer: Informer) -> list[tuple[str, str]]:
+    events = []
+
+    async def async_handler(event_type, obj):
+        events.append((event_type, obj.metadata.name))
+
+    informer.add_handler(async_handler)
+    # sync handlers work too, and a failing handler doesn't stop the others
+    informer.add_handler(lambda event_type, obj: 1 / 0)
+    FakeWatch.done = asyncio.Event()
+    informer.start()
+    await asyncio.wait_for(FakeWatch.done.wait(), 5)
+    await informer.stop()
+    return events
+
+
+def names(objs) -> list[str]:
+    return sorted(obj.metadata.name for obj in objs)
+
+
+def test_informer_list_then_watch(fake_watch):
+    fake_watch.sessions = [
+        [{'type': 'MODIFIED', 'object': make_pod('b', '11', job_type='builder', phase='Running')},
+         {'type': 'ADDED', 'object': make_pod('c', '12', testrun_id=2, phase='Pending')},
+         {'type': 'BOOKMARK', 'object': client.V1Pod(metadata=client.V1ObjectMeta(resource_version='15'))}],
+        # the first watch timed out: we resume from the bookmark
+        [{'type': 'DELETED', 'object': make_pod('a', '16')}],
+    ]
+    lister = FakeLister(make_pod_list('10', make_pod('a', '1'), make_pod('b', '2', job_type='builder',
+                                                                         phase='Pending')))
+    informer = Informer(lister, pod_phase, namespace='test')
+
+    start = perf_counter()
+    events = asyncio.run(run_informer(informer))
+    # no backoff between watches that end normally
+    assert perf_counter() - start < 0.5
+    assert events == [('ADDED', 'a'), ('ADDED', 'b'), ('MODIFIED', 'b'), ('ADDED', 'c'), ('DELETED', 'a')]
+    assert lister.calls == 1
+    assert fake_watch.resource_versions == ['10', '15', '16']
+
+    assert names(informer.list()) == ['b', 'c']
+    assert names(informer.by_testrun(1)) == ['b']
+    assert names(informer.by_testrun(2)) == ['c']
+    assert names(informer.by_job_type('builder')) == ['b']
+    assert names(informer.by_job_type('runner')) == ['c']
+    assert names(informer.by_phase('Running')) == ['b']
+    assert names(informer.by_phase('Pending')) == ['c']
+    # empty index entries are dropped
+    assert set(informer._indexes['job_type']) == {'builder', 'runner'}
+    assert informer.get('b').metadata.resource_version == '11'
+
+
+def test_informer_relists_when_expired(fake_watch):
+    fake_watch.sessions = [ApiException(status=410, reason='Gone')]
+    lister = FakeLister(make_pod_list('10', make_pod('a', '1'), make_pod('b', '2')),
+                        # a was deleted, b modified and c added while we weren't watching
+                        make_pod_list('22', make_pod('b', '20', phase='Succeeded'), make_pod('c', '21')))
+    informer = Informer(lister, pod_phase, namespace='test')
+
+    events = asyncio.run(run_informer(informer))
+    assert events == [('ADDED', 'a'), ('ADDED', 'b'), ('MODIFIED', 'b'), ('ADDED', 'c'), ('DELETED', 'a')]
+    assert lister.calls == 2
+    assert fake_watch.resource_versions == ['10', '22']
+    assert names(informer.list()) == ['b', 'c']
+    assert names(informer.by_phase('Running')) == ['c']
+    assert names(informer.by_phase('Succeeded')) == ['b']
+
+
+def test_latency_histogram():
+    hist = LatencyHistogram([0.1, 1])
+    for seconds in (0.05, 0.1, 0.5, 2, 3):
+        hist.observe(seconds)
+    assert hist.to_dict() == {'count': 5, 'sum': pytest.approx(5.65), 'buckets': {'0.1': 2, '1': 3, 'inf': 5}}
+
+
+class FakeCoreApi:
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.api_client = 'client'
+
+    async def list_namespaced_pod(self, namespace, **kwargs):
+        """
+        List pods
+
+        :rtype: V1PodList
+        """
+        self.active += 1
+        self.max_active = max(self.active, self.max_active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        return namespace
+
+
+def test_instrumented_api():
+    async def run():
+        api = FakeCoreApi()
+        instrumented = InstrumentedApi(api, asyncio.Semaphore(2))
+        results = await asyncio.gather(*[instrumented.list_namespaced_pod(f'ns{i}') for i in range(6)])
+        # Watch relies on the docstring to find the type to deserialize to
+        assert watch.Watch().get_return_type(instrumented.list_namespaced_pod) == 'V1Pod'
+        return api, instrumented, results
+
+    api_latency.pop('FakeCoreApi.list_namespaced_pod', None)
+    api, instrumented, results = asyncio.run(run())
+    assert results == [f'ns{i}' for i in range(6)]
+    assert api.max_active == 2
+    stats = get_api_latency_stats()['FakeCoreApi.list_namespaced_pod']
+    assert stats['count'] == 6
+    assert stats['sum'] >= 0.06
+
+    # attributes are passed through, and the wrapper is only built once
+    assert instrumented.api_client == 'client'
+    assert instrumented.list_namespaced_pod is instrumented.list_namespaced_pod
+
+
+def test_instrumented_api_unbounded():
+    async def run():
+        api = FakeCoreApi()
+        await asyncio.gather(*[InstrumentedApi(api).list_namespaced_pod('ns') for i in range(6)])
+        return api
+
+    assert asyncio.run(run()).max_active == 6
+
+
+def test_ssl_context():
+    configuration = client.Configuration()
+    context = _ssl_context(configuration)
+    assert context.verify_mode == ssl.CERT_REQUIRED and context.check_hostname
+
+    configuration.verify_ssl = False
+    context = _ssl_context(configuration)
+    assert context.verify_mode == ssl.CERT_NONE and not context.check_hostname
+
+
+def make_manifest(name: str, kind: str = 'Job', api_version: str = 'batch/v1') -> dict:
+    return {'apiVersion': api_version, 'kind': kind, 'metadata': {'name': name}}
+
+
+def api_exception(status: int, retry_after: str = None) -> ApiException:
+    ex = ApiException(status=status, reason=f'Error {status}')
+    if retry_after is not None:
+        ex.headers = {'Retry-After': retry_after}
+    return ex
+
+
+def test_retry_delay():
+    assert _retry_delay(api_exception(429, '3'), 1) == 3
+    for attempt in range(1, 10):
+        # Retry-After is only honoured for 429s, and must be in seconds
+        for ex in (api_exception(429), api_exception(429, 'Wed, 21 Oct 2015 07:28:00 GMT'),
+                   api_exception(409, '3')):
+            assert 0 <= _retry_delay(ex, attempt) <= min(10, 0.25 * 2 ** attempt)
+
+
+def test_apply_manifests(monkeypatch):
+    # name -> errors to raise on successive attempts
+    errors = {'conflict': [api_exception(409)],
+              'throttled': [api_exception(429, '0'), api_exception(429, '0')],
+              'forbidden': [api_exception(403)],
+              'always-conflicts': [api_exception(409)] * 10,
+              'broken': [ValueError('bad manifest')]}
+    active = []
+    max_active = []
+
+    async def apply(manifest):
+        name = manifest['metadata']['name']
+        active.append(name)
+        max_active.append(len(active))
+        # finish in a different order to the one we started in
+        await asyncio.sleep(0.01 * (len(name) % 3))
+        active.remove(name)
+        if errors.get(name):
+            raise errors[name].pop(0)
+        return {'applied': name}
+
+    monkeypatch.setattr(k8common, '_apply', apply)
+    names = ['ok-1', 'conflict', 'throttled', 'forbidden', 'always-conflicts', 'broken', 'ok-2']
+    results = asyncio.run(apply_manifests([make_manifest(name) for name in names], max_concurrency=2,
+                                          max_attempts=3))
+    assert [r.name for r in results] == names
+    assert max(max_active) == 2
+    summary = {r.name: (r.ok, r.attempts, r.status_code) for r in results}
+    assert summary == {'ok-1': (True, 1, 200),
+                       'conflict': (True, 2, 200),
+                       'throttled': (True, 3, 200),
+                       'forbidden': (False, 1, 403),
+                       'always-conflicts': (False, 3, 409),
+                       'broken': (False, 1, None),
+                       'ok-2': (True, 1, 200)}
+    assert results[0].obj == {'applied': 'ok-1'}
+    assert results[5].error == 'bad manifest'
+
+
+class FakePatchApi:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return name
+        return call
+
+
+def test_apply_routes_by_kind(monkeypatch):
+    apis = {name: FakePatchApi() for name in ('batch', 'core', 'custom')}
+    for name, api in apis.items():
+        monkeypatch.setitem(k8common.k8clients, name, api)
+    snapshot = make_manifest('snap', 'VolumeSnapshot', 'snapshot.storage.k8s.io/v1')
+    snapshot['metadata']['namespace'] = 'other'
+    results = asyncio.run(apply_manifests([make_manifest('job'), make_manifest('pvc', 'PersistentVolumeClaim', 'v1'),
+                                           snapshot]))
+    assert [r.obj for r in results] == ['patch_namespaced_job', 'patch_namespaced_persistent_volume_claim',
+                                        'patch_namespaced_custom_object']
+    kwargs = dict(field_manager=FIELD_MANAGER, force=True, _content_type=APPLY_CONTENT_TYPE)
+    assert apis['batch'].calls == [('patch_namespaced_job', ('job', k8common.NAMESPACE, make_manifest('job')),
+                                    kwargs)]
+    assert apis['custom'].calls == [('patch_namespaced_custom_object',
+                                     ('snapshot.storage.k8s.io', 'v1', 'other', 'volumesnapshots', 'snap', snapshot),
+                                     kwargs)]
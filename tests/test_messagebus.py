@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from common.enums import AgentEventType
+from common.exceptions import UnknownEventError
+from common.messagebus import MessageBus, decode_event, encode_event
+from common.schemas import AgentEvent, AgentErrorMessage
+
+
+class CustomEvent(AgentEvent):
+    extra: str
+
+
+def test_decode_event_subclasses():
+    for event in [AgentErrorMessage(testrun_id=1, source='runner', message='Pod evicted'),
+                  CustomEvent(type=AgentEventType.log, testrun_id=2, extra='defined outside the package')]:
+        decoded = decode_event(encode_event(event))
+        assert type(decoded) is type(event)
+        assert decoded == event
+
+
+def test_decode_unknown_event():
+    with pytest.raises(UnknownEventError):
+        decode_event({'class': 'NoSuchEvent', 'data': '{}'})
+
+
+def make_event(i: int) -> AgentErrorMessage:
+    return AgentErrorMessage(testrun_id=i, source='runner', message=f'Error {i}')
+
+
+def test_publish_and_read(fake_redis):
+    async def run():
+        bus = MessageBus(consumer='agent-1', redis=fake_redis())
+        await bus.create_group()
+        # idempotent
+        await bus.create_group()
+        ids = [await bus.publish(make_event(i)) for i in range(3)]
+        messages = await bus.read(block=None)
+        assert messages == [(msgid, make_event(i)) for i, msgid in enumerate(ids)]
+        assert await bus.read(block=None) == []
+        assert await bus.ack(*ids) == 3
+        assert await bus.reclaim(min_idle_time=0) == []
+
+    asyncio.run(run())
+
+
+def test_reclaim_and_dead_letter(fake_redis):
+    async def run():
+        redis = fake_redis()
+        bus1 = MessageBus(consumer='runner-1', max_deliveries=2, redis=redis)
+        bus2 = MessageBus(consumer='runner-2', max_deliveries=2, redis=redis)
+        await bus1.create_group()
+        msgid = await bus1.publish(make_event(1))
+        # delivered to runner-1, which never acks it (e.g its pod was killed)
+        assert [m for m, _ in await bus1.read(block=None)] == [msgid]
+        # not idle for long enough yet
+        assert await bus2.reclaim(min_idle_time=60000) == []
+        # second delivery
+        assert await bus2.reclaim(min_idle_time=0) == [(msgid, make_event(1))]
+        # a third delivery is too many: the message is dead-lettered
+        assert await bus1.reclaim(min_idle_time=0) == []
+
+        dead = await redis.xrange(bus1.dead_letter_stream)
+        assert len(dead) == 1
+        fields = dead[0][1]
+        assert fields['id'] == msgid
+        assert fields['reason'] == 'Failed after 2 deliveries'
+        assert decode_event(fields) == make_event(1)
+        # and no longer pending
+        assert (await redis.xpending(bus1.stream, bus1.group))['pending'] == 0
+
+    asyncio.run(run())
+
+
+def test_undecodable_messages_dead_lettered(fake_redis):
+    async def run():
+        redis = fake_redis()
+        bus = MessageBus(consumer='agent-1', redis=redis)
+        await bus.create_group()
+        await redis.xadd(bus.stream, {'class': 'NoSuchEvent', 'data': '{}'})
+        await redis.xadd(bus.stream, {'class': 'AgentErrorMessage', 'data': '{"testrun_id": "not a number"}'})
+        msgid = await bus.publish(make_event(1))
+        assert await bus.read(block=None) == [(msgid, make_event(1))]
+
+        dead = await redis.xrange(bus.dead_letter_stream)
+        assert [fields['class'] for _, fields in dead] == ['NoSuchEvent', 'AgentErrorMessage']
+        assert all(fields['reason'].startswith('Failed to decode') for _, fields in dead)
+        # only the good message is left pending
+        assert (await redis.xpending(bus.stream, bus.group))['pending'] == 1
+
+    asyncio.run(run())
+
+
+def test_consume_retries_failed_handler(fake_redis):
+    async def run():
+        bus = MessageBus(consumer='agent-1', max_deliveries=2, redis=fake_redis())
+        await bus.create_group()
+        await bus.publish(make_event(1))
+        await bus.publish(make_event(2))
+        handled = []
+
+        async def handler(event):
+            handled.append(event.testrun_id)
+            if event.testrun_id == 1:
+                raise ValueError('boom')
+
+        task = asyncio.create_task(bus.consume(handler, block=10, min_idle_time=0))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # the failed event is delivered twice, then dead-lettered
+        assert handled == [1, 2, 1]
+        assert len(await bus.redis.xrange(bus.dead_letter_stream)) == 1
+
+    asyncio.run(run())
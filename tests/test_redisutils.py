@@ -0,0 +1,277 @@
+import asyncio
+
+import pytest
+
+from common import redisutils
+from common.redisutils import (AsyncLogWriter, TrackingCache, RedisSettings, SentinelWaiter, async_get_redis,
+                               get_cached_async_redis, redis_startup_stats)
+
+
+class FakePipeline:
+    def __init__(self, redis: 'FakeRedis'):
+        self.redis = redis
+        self.commands = []
+
+    def append(self, key: str, value: str):
+        self.commands.append((key, value))
+
+    async def execute(self):
+        self.redis.executed += 1
+        await asyncio.sleep(self.redis.delay)
+        if self.redis.down:
+            raise ConnectionError('Redis is down')
+        for key, value in self.commands:
+            self.redis.data[key] = self.redis.data.get(key, '') + value
+
+
+class FakeRedis:
+    def __init__(self, delay: float = 0, down: bool = False):
+        self.delay = delay
+        self.down = down
+        self.executed = 0
+        self.data = {}
+
+    def pipeline(self, transaction: bool = True):
+        return FakePipeline(self)
+
+
+def test_close_waits_for_flush_in_progress():
+    async def run():
+        redis = FakeRedis(delay=0.5)
+        writer = AsyncLogWriter(redis, max_delay=0.01)
+        writer.start()
+        for i in range(5):
+            await writer.write('key', f'line {i}\n')
+        # let the flusher start the slow pipeline
+        await asyncio.sleep(0.05)
+        await writer.close()
+        return redis, writer
+
+    redis, writer = asyncio.run(run())
+    assert redis.data['key'] == ''.join(f'line {i}\n' for i in range(5))
+    assert writer.pending == 0
+
+
+def test_cancelled_flush_keeps_lines():
+    async def run():
+        redis = FakeRedis(delay=0.5)
+        writer = AsyncLogWriter(redis)
+        await writer.write('key', 'line\n')
+        task = asyncio.create_task(writer.flush())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return writer
+
+    writer = asyncio.run(run())
+    assert writer.pending == 1
+
+
+def test_lines_dropped_while_redis_down():
+    async def run():
+        redis = FakeRedis(down=True)
+        writer = AsyncLogWriter(redis, max_pending=100, retry_delay=60)
+        for i in range(1000):
+            await writer.write('key', f'line {i}\n')
+        assert writer.pending <= 200
+        assert writer.dropped >= 800
+        # one failed flush, then we back off rather than retrying on every write
+        assert redis.executed == 1
+
+        redis.down = False
+        await writer.close()
+        return redis, writer
+
+    redis, writer = asyncio.run(run())
+    assert writer.pending == 0
+    assert redis.data['key'].startswith('line 0\n')
+
+
+class FakeConnection:
+    """
+    Replies to the tracking setup commands, then only sends what's pushed. Set silent to simulate a half-open
+    connection
+    """
+    REPLIES = {'CLIENT ID': 7, 'CLIENT TRACKING': 'OK', 'SUBSCRIBE': ['subscribe', TrackingCache.INVALIDATE_CHANNEL, 1],
+               'PING': ['pong', '']}
+
+    def __init__(self):
+        self.responses = asyncio.Queue()
+        self.commands = []
+        self.silent = False
+        self.disconnected = False
+
+    async def send_command(self, *args):
+        command = ' '.join(str(arg) for arg in args[:2]) if args[0] == 'CLIENT' else args[0]
+        self.commands.append(command)
+        if not self.silent:
+            self.responses.put_nowait(self.REPLIES[command])
+
+    async def read_response(self, timeout=None):
+        # like redis-py, return None if we time out
+        try:
+            return await asyncio.wait_for(self.responses.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def disconnect(self):
+        self.disconnected = True
+
+
+class FakePool:
+    def __init__(self):
+        self.connections = []
+        self.silent = False
+
+    async def get_connection(self, name):
+        conn = FakeConnection()
+        conn.silent = self.silent
+        self.connections.append(conn)
+        return conn
+
+    async def release(self, conn):
+        pass
+
+
+class FakeTrackingRedis:
+    def __init__(self):
+        self.connection_pool = FakePool()
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+
+def test_tracking_cache_invalidation():
+    async def run():
+        redis = FakeTrackingRedis()
+        redis.data['hot:1'] = 'a'
+        cache = TrackingCache(['hot:'], redis=redis)
+        cache.start()
+        await asyncio.sleep(0.01)
+        assert await cache.get('hot:1') == 'a'
+        redis.data['hot:1'] = 'b'
+        assert await cache.get('hot:1') == 'a'
+
+        conn = redis.connection_pool.connections[0]
+        conn.responses.put_nowait(['message', TrackingCache.INVALIDATE_CHANNEL, ['hot:1']])
+        await asyncio.sleep(0.01)
+        assert await cache.get('hot:1') == 'b'
+        await cache.close()
+        return cache
+
+    cache = asyncio.run(run())
+    assert (cache.hits, cache.misses, cache.invalidations) == (1, 2, 1)
+
+
+def test_tracking_cache_silent_connection():
+    async def run():
+        redis = FakeTrackingRedis()
+        cache = TrackingCache(['hot:'], redis=redis, ping_interval=0.05)
+        cache.start()
+        await asyncio.sleep(0.01)
+        assert cache.stats()['tracking']
+        conn = redis.connection_pool.connections[0]
+
+        # an idle connection that answers the heartbeat stays up
+        await asyncio.sleep(0.12)
+        assert 'PING' in conn.commands
+        assert cache.stats()['tracking']
+        assert not conn.disconnected
+
+        # but one that has gone quiet is dropped, and we stop serving from the cache
+        conn.silent = redis.connection_pool.silent = True
+        await asyncio.sleep(0.3)
+        assert conn.disconnected
+        assert not cache.stats()['tracking']
+        await cache.close()
+
+    asyncio.run(run())
+
+
+HOSTS = [('redis-0', 26379), ('redis-1', 26379), ('redis-2', 26379)]
+
+
+@pytest.fixture
+def sentinels(monkeypatch):
+    """
+    Pretend we're in K8 with 3 sentinels, which appear one at a time
+    """
+    monkeypatch.setenv('REDIS_NODES', '3')
+    monkeypatch.setenv('REDIS_BACKOFF_BASE', '0.001')
+    monkeypatch.setenv('REDIS_BACKOFF_MAX', '0.01')
+    monkeypatch.setattr(RedisSettings, 'use_sentinel', property(lambda self: True))
+    lookups = []
+
+    def get_hosts(self):
+        lookups.append(len(lookups))
+        if len(lookups) == 1:
+            raise OSError('NXDOMAIN')
+        return HOSTS[:len(lookups) - 1]
+
+    async def async_get_hosts(self):
+        return get_hosts(self)
+
+    monkeypatch.setattr(RedisSettings, 'get_redis_sentinel_hosts', get_hosts)
+    monkeypatch.setattr(RedisSettings, 'async_get_redis_sentinel_hosts', async_get_hosts)
+    monkeypatch.setattr(redisutils, '_async_redis', None)
+    return lookups
+
+
+def sentinel_hosts(redis) -> list[str]:
+    return [sentinel.connection_pool.connection_kwargs['host']
+            for sentinel in redis.connection_pool.sentinel_manager.sentinels]
+
+
+def test_sentinel_waiter_quorum(monkeypatch):
+    monkeypatch.setenv('REDIS_NODES', '3')
+    waiter = SentinelWaiter(RedisSettings())
+    assert waiter.quorum == 2
+    assert not waiter.ready([])
+    assert not waiter.ready(HOSTS[:2])
+
+    # we'll settle for a quorum once REDIS_QUORUM_WAIT has passed
+    waiter.started -= 61
+    assert not waiter.ready(HOSTS[:1])
+    assert waiter.ready(HOSTS[:2])
+    assert redis_startup_stats.degraded
+    assert (redis_startup_stats.attempts, redis_startup_stats.hosts) == (4, 2)
+
+    assert waiter.ready(HOSTS)
+    assert not redis_startup_stats.degraded
+
+
+def test_sentinel_waiter_no_degraded_mode(monkeypatch):
+    monkeypatch.setenv('REDIS_NODES', '3')
+    monkeypatch.setenv('REDIS_QUORUM_WAIT', '-1')
+    waiter = SentinelWaiter(RedisSettings())
+    waiter.started -= 3600
+    assert not waiter.ready(HOSTS[:2])
+    assert waiter.ready(HOSTS)
+
+
+def test_sentinel_waiter_backoff(monkeypatch):
+    monkeypatch.setenv('REDIS_BACKOFF_BASE', '0.5')
+    monkeypatch.setenv('REDIS_BACKOFF_MAX', '4')
+    waiter = SentinelWaiter(RedisSettings())
+    for attempt in range(10):
+        waiter.attempt = attempt
+        assert 0 <= waiter.delay() <= min(4, 0.5 * 2 ** attempt)
+
+
+def test_async_get_redis_waits_for_sentinels(sentinels):
+    redis = asyncio.run(async_get_redis())
+    # a failed lookup, then 1, 2 and 3 hosts
+    assert len(sentinels) == 4
+    assert sorted(sentinel_hosts(redis)) == [host for host, port in HOSTS]
+    assert not redis_startup_stats.degraded
+
+
+def test_cached_async_redis_from_event_loop(sentinels):
+    async def run():
+        # blocks the loop, but still works
+        return get_cached_async_redis()
+
+    redis = asyncio.run(run())
+    assert sorted(sentinel_hosts(redis)) == [host for host, port in HOSTS]
+    assert get_cached_async_redis() is redis
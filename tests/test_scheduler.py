@@ -0,0 +1,71 @@
+import asyncio
+from datetime import timedelta
+
+from common.scheduler import (DEFAULT_SPEC_DURATION, SpecScheduler, makespan_report, order_specs,
+                              predict_durations, predict_makespan)
+from common.schemas import SpecFile
+
+from samples import NOW
+
+
+def test_predict_durations():
+    history = {'a.cy.ts': 10, 'b.cy.ts': 30, 'c.cy.ts': 100, 'd.cy.ts': None}
+    # new specs (and ones with no duration) get the median of the known ones
+    assert predict_durations(['a.cy.ts', 'c.cy.ts', 'd.cy.ts', 'new.cy.ts'], history) == {
+        'a.cy.ts': 10, 'c.cy.ts': 100, 'd.cy.ts': 30, 'new.cy.ts': 30}
+    assert predict_durations(['new.cy.ts'], {}) == {'new.cy.ts': DEFAULT_SPEC_DURATION}
+    assert predict_durations(['new.cy.ts'], {}, default=5) == {'new.cy.ts': 5}
+
+
+def test_order_specs():
+    assert order_specs({'a': 10, 'b': 30, 'c': 20}) == ['b', 'c', 'a']
+
+
+def test_predict_makespan():
+    assert predict_makespan([], 3) == 0
+    assert predict_makespan([10, 20, 30], 1) == 60
+    assert predict_makespan([10, 20, 30], 5) == 30
+    # longest first: 7 | 5 | 4+3 | 3+3 -> 7
+    assert predict_makespan([3, 3, 3, 4, 5, 7], 4) == 7
+    # no parallelism is treated as 1
+    assert predict_makespan([10, 20], 0) == 30
+
+
+def test_makespan_report():
+    files = [SpecFile(file='a.cy.ts', started=NOW, finished=NOW + timedelta(seconds=40)),
+             SpecFile(file='b.cy.ts', started=NOW + timedelta(seconds=5), finished=NOW + timedelta(seconds=50)),
+             SpecFile(file='c.cy.ts')]
+    report = makespan_report({'a.cy.ts': 40, 'b.cy.ts': 45, 'c.cy.ts': 10}, 2, files)
+    assert (report.parallelism, report.predicted, report.actual) == (2, 50, 50)
+    assert makespan_report({}, 2, []).actual is None
+
+
+def test_queue_order(fake_redis):
+    async def run():
+        scheduler = SpecScheduler(fake_redis())
+        history = {'a.cy.ts': 10, 'b.cy.ts': 300, 'c.cy.ts': 60}
+        durations = await scheduler.enqueue(1, ['a.cy.ts', 'b.cy.ts', 'c.cy.ts', 'new.cy.ts'], history)
+        assert durations['new.cy.ts'] == 60
+        assert await scheduler.get_predictions(1) == durations
+        assert await scheduler.remaining(1) == 4
+
+        assert await scheduler.next_spec(1) == 'b.cy.ts'
+        second = await scheduler.next_spec(1)
+        assert second in ('c.cy.ts', 'new.cy.ts')
+        # a pod gave up the longest spec: it goes back to the front of the queue
+        await scheduler.return_spec(1, 'b.cy.ts')
+        assert await scheduler.next_spec(1) == 'b.cy.ts'
+
+        remaining = [await scheduler.next_spec(1) for _ in range(2)]
+        assert remaining[-1] == 'a.cy.ts'
+        assert {second, *remaining} == {'c.cy.ts', 'new.cy.ts', 'a.cy.ts'}
+        assert await scheduler.next_spec(1) is None
+
+        # re-queueing replaces the old queue
+        await scheduler.enqueue(1, ['a.cy.ts'], history)
+        assert await scheduler.remaining(1) == 1
+        await scheduler.delete(1)
+        assert await scheduler.remaining(1) == 0
+        assert await scheduler.get_predictions(1) == {}
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+import json
+import random
+
+from common.enums import TestResultStatus
+from common.schemas import SpecTests, SpecTest, TestResult
+
+from samples import make_messages, random_spectests, count_from_scratch, filtered_from_scratch
+
+def check_aggregates(spectests: SpecTests):
+    assert spectests.count() == count_from_scratch(spectests)
+    for status in TestResultStatus:
+        assert spectests.get_filtered_test_results(status) == filtered_from_scratch(spectests, status)
+
+
+def test_aggregates_match_from_scratch():
+    rnd = random.Random(42)
+    for _ in range(300):
+        spectests = random_spectests(rnd, rnd.randint(0, 20))
+        check_aggregates(spectests)
+        for _ in range(rnd.randint(1, 3)):
+            spectests.merge(random_spectests(rnd, rnd.randint(0, 20)))
+            check_aggregates(spectests)
+
+
+def test_aggregates_with_merge_before_first_read():
+    rnd = random.Random(1)
+    for _ in range(50):
+        spectests = random_spectests(rnd, 10)
+        spectests.merge(random_spectests(rnd, 10))
+        check_aggregates(spectests)
+
+
+def test_merge_appends_missing_tests():
+    spectests = SpecTests(tests=[SpecTest(title='t1', context='a', status=TestResultStatus.passed,
+                                          results=[TestResult(browser='chrome', status=TestResultStatus.passed)])])
+    spectests.merge(SpecTests(tests=[
+        SpecTest(title='t1', context='b', status=TestResultStatus.failed,
+                 results=[TestResult(browser='firefox', status=TestResultStatus.failed)]),
+        SpecTest(title='t1', context='a', status=TestResultStatus.flakey,
+                 results=[TestResult(browser='firefox', status=TestResultStatus.passed, retry=1)])]))
+    assert [(t.context, t.status, len(t.results)) for t in spectests.tests] == [
+        ('a', TestResultStatus.flakey, 2), ('b', TestResultStatus.failed, 1)]
+    check_aggregates(spectests)
+
+
+def test_merge_leaves_source_unchanged():
+    a = SpecTests(tests=[SpecTest(title='t1', status=TestResultStatus.passed,
+                                  results=[TestResult(browser='chrome', status=TestResultStatus.passed)])])
+    b = SpecTests(tests=[SpecTest(title='t2', status=TestResultStatus.passed,
+                                  results=[TestResult(browser='chrome', status=TestResultStatus.passed)])])
+    c = SpecTests(tests=[SpecTest(title=title, status=TestResultStatus.failed,
+                                  results=[TestResult(browser='firefox', status=TestResultStatus.failed)])
+                         for title in ('t1', 't2')])
+    expected_b = b.copy(deep=True)
+    expected_c = c.copy(deep=True)
+    a.merge(b)
+    a.merge(c)
+    assert b == expected_b
+    assert c == expected_c
+    assert [(t.status, len(t.results)) for t in a.tests] == [(TestResultStatus.failed, 2)] * 2
+
+
+def test_aggregates_follow_direct_changes():
+    rnd = random.Random(7)
+    spectests = random_spectests(rnd, 10)
+    check_aggregates(spectests)
+
+    # replaced
+    spectests.tests = random_spectests(rnd, 5).tests
+    check_aggregates(spectests)
+
+    # appended to
+    spectests.tests.append(random_spectests(rnd, 1).tests[0])
+    check_aggregates(spectests)
+    spectests.tests += random_spectests(rnd, 3).tests
+    check_aggregates(spectests)
+
+    # modified in place
+    spectests.tests[0].results.append(TestResult(browser='chrome', status=TestResultStatus.failed))
+    spectests.tests[0].status = TestResultStatus.failed
+    spectests.recount()
+    check_aggregates(spectests)
+
+
+def test_aggregates_on_copy_and_construct():
+    rnd = random.Random(3)
+    spectests = random_spectests(rnd, 10)
+    check_aggregates(spectests)
+
+    check_aggregates(spectests.copy(update={'tests': []}))
+    check_aggregates(spectests.copy(update={'tests': random_spectests(rnd, 4).tests}))
+    check_aggregates(spectests.copy(deep=True))
+    check_aggregates(SpecTests.construct(tests=spectests.tests))
+    check_aggregates(SpecTests.parse_raw(spectests.json()))
+
+
+def test_message_json_unchanged():
+    for name, msg in make_messages().items():
+        # exactly what pydantic produces with the stdlib encoder
+        expected = json.dumps(msg.dict(), default=msg.__json_encoder__)
+        assert msg.json() == expected, name
+        assert json.loads(msg.json_bytes()) == json.loads(expected), name
+        assert type(msg).parse_raw(msg.json_bytes()) == msg, name
@@ -0,0 +1,57 @@
+import asyncio
+import math
+import random
+from datetime import timedelta
+
+from common.enums import TestResultStatus
+from common.schemas import AgentSpecCompleted, SpecTests, SpecTest, TestResult
+from common.spechistory import SpecDurationStats, SpecHistoryStore
+
+from samples import NOW
+
+
+def assert_stats_equal(stats: SpecDurationStats, expected: SpecDurationStats):
+    assert (stats.runs, stats.durations, stats.p50, stats.p90) == \
+        (expected.runs, expected.durations, expected.p50, expected.p90)
+    # cjson only encodes 14 significant digits
+    assert math.isclose(stats.flake_rate, expected.flake_rate, rel_tol=1e-12, abs_tol=1e-12)
+    assert math.isclose(stats.failure_rate, expected.failure_rate, rel_tol=1e-12, abs_tol=1e-12)
+
+
+def test_script_matches_model(fake_redis):
+    async def run():
+        rnd = random.Random(6)
+        store = SpecHistoryStore(fake_redis(), window=5)
+        files = [f'cypress/e2e/spec{i}.cy.ts' for i in range(3)]
+        expected = {file: SpecDurationStats() for file in files}
+        for _ in range(100):
+            file = rnd.choice(files)
+            duration, flakey, failed = rnd.randint(0, 600), rnd.random() < 0.2, rnd.random() < 0.1
+            expected[file].add(duration, flakey, failed, window=5)
+            assert_stats_equal(await store.add(1, file, duration, flakey, failed), expected[file])
+
+        stored = await store.get_many(1, files + ['unknown.cy.ts'])
+        assert stored['unknown.cy.ts'] is None
+        for file in files:
+            assert_stats_equal(stored[file], expected[file])
+        assert await store.get_durations(1, files, 'p90') == {file: expected[file].p90 for file in files}
+        # other projects are separate
+        assert await store.get(2, files[0]) is None
+
+    asyncio.run(run())
+
+
+def test_record(fake_redis):
+    async def run():
+        store = SpecHistoryStore(fake_redis())
+        result = SpecTests(tests=[SpecTest(title='t1', status=TestResultStatus.flakey,
+                                           results=[TestResult(browser='chrome', status=TestResultStatus.passed,
+                                                               retry=1)])])
+        completed = AgentSpecCompleted(file='spec.cy.ts', finished=NOW, result=result)
+        stats = await store.record(1, completed, NOW - timedelta(seconds=90))
+        assert (stats.runs, stats.durations, stats.flake_rate, stats.failure_rate) == (1, [90], 1, 0)
+
+        await store.remove(1, 'spec.cy.ts')
+        assert await store.get(1, 'spec.cy.ts') is None
+
+    asyncio.run(run())
@@ -0,0 +1,78 @@
+import datetime
+import hashlib
+import json
+import os
+
+from common import utils
+from common.schemas import CacheItem
+from common.utils import get_cache_key, find_best_cache_item, get_lock_hash, utcnow
+
+from samples import make_project
+
+
+def make_item(name: str, days: int = 1) -> CacheItem:
+    return CacheItem(name=name, organisation_id=1, storage_size=1, expires=utcnow() + datetime.timedelta(days=days))
+
+
+def test_find_best_cache_item():
+    project = make_project()
+    key = get_cache_key(None, project, lock_hash='a' * 64)
+
+    other_build = project.copy(update={'build_cmd': 'ng build --prod'})
+    partial = make_item(get_cache_key(None, other_build, lock_hash='a' * 64))
+    other_lockfile = make_item(get_cache_key(None, project, lock_hash='b' * 64))
+    exact = make_item(key)
+    expired = make_item(key, days=-1)
+
+    assert find_best_cache_item(key, [other_lockfile, partial, exact]) == (exact, True)
+    assert find_best_cache_item(key, [other_lockfile, partial, expired]) == (partial, False)
+    # node_modules from a different lockfile are never reused
+    assert find_best_cache_item(key, [other_lockfile, expired]) is None
+
+
+def write_lockfile(build_dir, content: str):
+    os.makedirs(build_dir, exist_ok=True)
+    with open(os.path.join(build_dir, 'package-lock.json'), 'w') as f:
+        f.write(content)
+
+
+def sha256(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def test_lock_hash_cache_invalidated(tmp_path):
+    build_dir = tmp_path / 'build'
+    cache_file = tmp_path / 'lockhash.json'
+    lockfile = build_dir / 'package-lock.json'
+    write_lockfile(build_dir, '{"a": 1}')
+    assert get_lock_hash(build_dir, cache_file) == sha256('{"a": 1}')
+    # cached
+    assert get_lock_hash(build_dir, cache_file) == sha256('{"a": 1}')
+
+    # same size but a new mtime
+    st = os.stat(lockfile)
+    write_lockfile(build_dir, '{"a": 2}')
+    os.utime(lockfile, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert get_lock_hash(build_dir, cache_file) == sha256('{"a": 2}')
+
+    # new size, with the original mtime
+    st = os.stat(lockfile)
+    write_lockfile(build_dir, '{"a": 10}')
+    os.utime(lockfile, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert get_lock_hash(build_dir, cache_file) == sha256('{"a": 10}')
+
+
+def test_lock_hash_cache_evicts_oldest(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'LOCK_HASH_CACHE_SIZE', 3)
+    cache_file = tmp_path / 'lockhash.json'
+    dirs = [tmp_path / f'build{i}' for i in range(5)]
+    for build_dir in dirs:
+        write_lockfile(build_dir, str(build_dir))
+        get_lock_hash(build_dir, cache_file)
+    # hashing one again makes it the most recent
+    os.utime(dirs[2] / 'package-lock.json', ns=(0, 0))
+    get_lock_hash(dirs[2], cache_file)
+
+    with open(cache_file) as f:
+        cache = json.load(f)
+    assert list(cache) == [os.path.realpath(build_dir / 'package-lock.json') for build_dir in dirs[3:] + dirs[2:3]]
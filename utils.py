@@ -1,11 +1,17 @@
 import datetime
 import hashlib
+import json
 import logging
 import os
 from decimal import Decimal
 from json import JSONEncoder
 from uuid import UUID
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from .enums import TestRunStatus
 from .exceptions import BuildFailedException
 
@@ -23,6 +29,29 @@ class DateTimeEncoder(JSONEncoder):
         return super().default(obj)
 
 
+# let dicts with int or enum keys through, as the stdlib json module does
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def fast_json_dumps_bytes(v, *, default=None) -> bytes:
+    """
+    Encode to compact UTF-8 JSON bytes, using orjson if it's available. Datetimes, UUIDs and str enums are
+    handled natively: anything else is passed to default (e.g the Pydantic encoder).
+
+    Note that this isn't byte-identical to json.dumps: there's no whitespace between items, non-ASCII
+    characters aren't escaped and floats may be formatted differently (e.g 1e+16 rather than 1e16)
+    """
+    if orjson:
+        return orjson.dumps(v, default=default, option=ORJSON_OPTIONS)
+    return json.dumps(v, default=default, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def fast_json_loads(v):
+    if orjson:
+        return orjson.loads(v)
+    return json.loads(v)
+
+
 class MaxBodySizeException(Exception):
     def __init__(self, body_len: str):
         self.body_len = body_len
@@ -60,21 +89,140 @@ def get_hostname():
         return f.read().strip()
 
 
-def get_lock_hash(build_dir):
-    m = hashlib.sha256()
-    lockfile = os.path.join(build_dir, 'package-lock.json')
-    if not os.path.exists(lockfile):
-        lockfile = os.path.join(build_dir, 'yarn.lock')
+LOCKFILES = ['package-lock.json', 'yarn.lock', 'pnpm-lock.yaml', 'bun.lockb']
+HASH_CHUNK_SIZE = 1024 * 1024
+LOCK_HASH_CACHE = os.environ.get('LOCK_HASH_CACHE',
+                                 os.path.join(os.path.expanduser('~'), '.cache', 'cykubed', 'lockhash.json'))
+# maximum number of lockfiles in the hash cache: the least recently hashed are evicted first
+LOCK_HASH_CACHE_SIZE = int(os.environ.get('LOCK_HASH_CACHE_SIZE', 100))
+
+
+def find_lockfile(build_dir) -> str:
+    for name in LOCKFILES:
+        lockfile = os.path.join(build_dir, name)
+        if os.path.exists(lockfile):
+            return lockfile
+    raise BuildFailedException(msg="No lock file")
 
-    if not os.path.exists(lockfile):
-        raise BuildFailedException("No lock file")
 
-    # hash the lock
-    with open(lockfile, 'rb') as f:
-        m.update(f.read())
+def hash_file(path) -> str:
+    """
+    SHA256 of a file, read in fixed-size chunks so we don't pull large lockfiles into memory
+    """
+    m = hashlib.sha256()
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while n := f.readinto(buf):
+            m.update(view[:n])
     return m.hexdigest()
 
 
+def _read_hash_cache(cache_file) -> dict:
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_hash_cache(cache_file, cache: dict):
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmpfile = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmpfile, cache_file)
+    except OSError:
+        # the cache is just an optimisation
+        pass
+
+
+def get_lock_hash(build_dir, cache_file=LOCK_HASH_CACHE):
+    """
+    Hash the lockfile. The result is memoized on disk against the file's inode, size and mtime, so
+    repeated calls on an unchanged checkout don't need to read it at all. The cache holds the
+    LOCK_HASH_CACHE_SIZE most recently hashed lockfiles. Pass cache_file=None to disable it
+    """
+    lockfile = os.path.realpath(find_lockfile(build_dir))
+    if not cache_file:
+        return hash_file(lockfile)
+
+    st = os.stat(lockfile)
+    stamp = [st.st_ino, st.st_size, st.st_mtime_ns]
+    cache = _read_hash_cache(cache_file)
+    entry = cache.get(lockfile)
+    if entry and entry.get('stamp') == stamp:
+        return entry['hash']
+
+    digest = hash_file(lockfile)
+    # keep the entries in the order they were hashed, so we can drop the oldest
+    cache.pop(lockfile, None)
+    cache[lockfile] = {'stamp': stamp, 'hash': digest}
+    for path in list(cache)[:-LOCK_HASH_CACHE_SIZE]:
+        del cache[path]
+    _write_hash_cache(cache_file, cache)
+    return digest
+
+
+# bump this to invalidate all existing caches e.g if we change what goes into them
+CACHE_KEY_VERSION = 1
+# number of leading cache key parts (version, node version, test framework, lockfile) that must match for a
+# cache to be usable at all: only the build command can differ, as the node_modules are still valid
+CACHE_KEY_REQUIRED_PARTS = 4
+
+
+def _short_digest(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
+
+
+def get_cache_key(build_dir, project, lock_hash: str = None) -> str:
+    """
+    Deterministic key for the node_modules / build cache. The parts go from most to least general
+    (schema version, Node major version, test framework, lockfile, build command). A key that only differs
+    in the build command identifies a cache whose node_modules can be reused, although it'll need rebuilding.
+
+    :param build_dir: checkout directory containing the lockfile
+    :param project: the Project
+    :param lock_hash: lockfile digest, if already known
+    """
+    lock_hash = lock_hash or get_lock_hash(build_dir)
+    return '-'.join([f'v{CACHE_KEY_VERSION}',
+                     f'n{project.node_major_version}',
+                     project.test_framework.value,
+                     lock_hash[:16],
+                     _short_digest(project.build_cmd or '')])
+
+
+def find_best_cache_item(cache_key: str, items, now: datetime.datetime = None):
+    """
+    Find the unexpired CacheItem whose name shares the most leading parts with the given key. Returns None
+    if none match at least CACHE_KEY_REQUIRED_PARTS parts.
+
+    :return: tuple of (CacheItem, True if it's an exact match), or None
+    """
+    now = now or utcnow()
+    parts = cache_key.split('-')
+    best = None
+    best_score = CACHE_KEY_REQUIRED_PARTS - 1
+    for item in items:
+        expires = item.expires
+        if expires and expires.tzinfo is None:
+            expires = expires.replace(tzinfo=datetime.timezone.utc)
+        if expires and expires < now:
+            continue
+        score = 0
+        for a, b in zip(parts, item.name.split('-')):
+            if a != b:
+                break
+            score += 1
+        if score > best_score:
+            best, best_score = item, score
+    if not best:
+        return None
+    return best, best.name == cache_key
+
+
 def utcnow() -> datetime.datetime:
     return datetime.datetime.now(tz=datetime.timezone.utc)
 